@@ -1,12 +1,17 @@
 import os
+import copy
+import hashlib
 import logging
 import time
+import uuid
 from typing import Union, List, Optional
 
 from openbrokerapi.catalog import ServicePlan
+from openbrokerapi.helper import to_json_response
+from openbrokerapi.response import CatalogResponse
 from openbrokerapi.errors import ErrInstanceAlreadyExists, ErrAsyncRequired, \
     ErrBindingAlreadyExists, ErrBadRequest, ErrInstanceDoesNotExist, \
-    ServiceException
+    ErrConcurrentInstanceAccess, ServiceException
 from openbrokerapi.service_broker import ServiceBroker, Service, \
     ProvisionDetails, ProvisionedServiceSpec, ProvisionState, GetBindingSpec, \
     BindDetails, Binding, BindState, UnbindDetails, UnbindSpec, \
@@ -14,12 +19,17 @@ from openbrokerapi.service_broker import ServiceBroker, Service, \
     DeprovisionServiceSpec, LastOperation, OperationState
 
 from .utils import verify_parameters, new_instance_lock
+from .lock import LockTimeout
+from .config import LOCK_API_TIMEOUT, TASK_SERIALIZER
 from .database.fetch import fetch_chart_plan
 from .database.query import get_instance_path, get_chart_path, get_plan_path, \
     get_addon_updateable, get_addon_bindable, get_addon_allow_params, \
     get_addon_archive, get_binding_file, get_instance_file
-from .database.metadata import load_instance_meta, load_binding_meta, load_addons_meta, \
-    save_instance_meta
+from .database.metadata import load_instance_meta, load_binding_meta, load_addons_catalog, \
+    save_instance_meta, load_instance_last_operation, load_binding_last_operation, \
+    load_instance_status, save_instance_status, load_binding_status, save_binding_status, \
+    push_pending_update, drop_pending_update, cancel_pending_update
+from .database.models import OperationDetails
 from .tasks import provision, bind, deprovision, update, unbind
 
 logger = logging.getLogger(__name__)
@@ -27,16 +37,35 @@ logger = logging.getLogger(__name__)
 
 class HelmServiceBroker(ServiceBroker):
 
+    def __init__(self):
+        # (generation, services, etag, data) of the last built catalog
+        self._catalog = (None, None, None, None)
+
     def catalog(self) -> Union[Service, List[Service]]:
-        services = load_addons_meta()
-        service_objs = []
-        for _, addons in services.items():
-            plans_objs = []
-            for plan in addons['plans']:
-                plans_objs.append(ServicePlan(**plan))
-            addons['plans'] = plans_objs
-            service_objs.append(Service(**addons))
-        return service_objs
+        return self._load_catalog()[1]
+
+    def catalog_response(self):
+        """
+        Return the etag and the serialized /v2/catalog body,
+        both are built once per addons catalog generation.
+        """
+        generation, services, etag, data = self._load_catalog()
+        if data is None:
+            data = to_json_response(CatalogResponse(services)).get_data()
+            etag = hashlib.sha256(data).hexdigest()
+            self._catalog = (generation, services, etag, data)
+        return etag, data
+
+    def _load_catalog(self):
+        addons_catalog = load_addons_catalog()
+        if self._catalog[0] != addons_catalog.generation:
+            service_objs = []
+            for _, addons in addons_catalog.addons_meta.items():
+                addons = copy.deepcopy(addons)
+                addons['plans'] = [ServicePlan(**plan) for plan in addons['plans']]
+                service_objs.append(Service(**addons))
+            self._catalog = (addons_catalog.generation, service_objs, None, None)
+        return self._catalog
 
     def provision(self,
                   instance_id: str,
@@ -64,7 +93,7 @@ class HelmServiceBroker(ServiceBroker):
         os.makedirs(instance_path, exist_ok=True)
         chart_path, plan_path = get_chart_path(instance_id), get_plan_path(instance_id)
         fetch_chart_plan(details.service_id, chart_path, details.plan_id, plan_path)
-        provision.delay(instance_id, details)
+        provision.delay(instance_id, _task_details(details))
         return ProvisionedServiceSpec(state=ProvisionState.IS_ASYNC)
 
     def get_binding(self,
@@ -89,15 +118,18 @@ class HelmServiceBroker(ServiceBroker):
         if not is_addon_bindable:
             raise ErrBadRequest(
                 msg="Instance %s does not bindable" % instance_id)
-        instance_meta = load_instance_meta(instance_id)
-        if not (instance_meta and
-                instance_meta['last_operation']['state'] == 'succeeded'):
+        last_operation = load_instance_last_operation(instance_id)
+        if last_operation.get('state') != 'succeeded':
             raise ErrBadRequest(
                 msg="This instance %s is not ready" % instance_id)
         instance_path = get_instance_path(instance_id)
         if os.path.exists(f'{instance_path}/bind.json'):
             raise ErrBindingAlreadyExists()
-        bind(instance_id, binding_id, details, async_allowed, **kwargs)
+        try:
+            bind(instance_id, binding_id, OperationDetails.from_details(details).to_dict(),
+                 async_allowed, lock_timeout=LOCK_API_TIMEOUT, **kwargs)
+        except LockTimeout:
+            raise ErrConcurrentInstanceAccess()
         data = load_binding_meta(instance_id)
         if data["last_operation"]["state"] == OperationState.SUCCEEDED.value:
             return Binding(state=BindState.SUCCESSFUL_BOUND,
@@ -151,7 +183,18 @@ class HelmServiceBroker(ServiceBroker):
         data['last_operation']["description"] = (
             f"update {instance_id} in progress at {time.time()}")
         save_instance_meta(instance_id, data)
-        update.delay(instance_id, details)
+        if TASK_SERIALIZER == "pickle":
+            # the workers of the previous release take the details as argument
+            update.delay(instance_id, details)
+            return UpdateServiceSpec(is_async=True)
+        task_id = str(uuid.uuid4())
+        if push_pending_update(
+                instance_id, OperationDetails.from_details(details).to_dict(), task_id):
+            try:
+                update.apply_async((instance_id, ), task_id=task_id)
+            except Exception:
+                drop_pending_update(instance_id, task_id)
+                raise
         return UpdateServiceSpec(is_async=True)
 
     def deprovision(self,
@@ -162,16 +205,19 @@ class HelmServiceBroker(ServiceBroker):
         logger.debug(f"*** deprovision instance {instance_id}")
         if not os.path.exists(get_instance_path(instance_id)):
             raise ErrInstanceDoesNotExist()
-        with new_instance_lock(instance_id):
-            data = load_instance_meta(instance_id)
-            operation = data["last_operation"]["operation"]
-            if operation == "provision":
-                if not async_allowed:
-                    raise ErrAsyncRequired()
-                deprovision.delay(instance_id)
-            elif operation == "deprovision":
-                return DeprovisionServiceSpec(
-                    is_async=True, operation=operation)
+        try:
+            with new_instance_lock(instance_id, timeout=LOCK_API_TIMEOUT):
+                operation = load_instance_last_operation(instance_id)["operation"]
+                if operation == "provision":
+                    if not async_allowed:
+                        raise ErrAsyncRequired()
+                    cancel_pending_update(instance_id)
+                    deprovision.delay(instance_id)
+                elif operation == "deprovision":
+                    return DeprovisionServiceSpec(
+                        is_async=True, operation=operation)
+        except LockTimeout:
+            raise ErrConcurrentInstanceAccess()
         return DeprovisionServiceSpec(is_async=True)
 
     def last_operation(self,
@@ -180,11 +226,15 @@ class HelmServiceBroker(ServiceBroker):
                        **kwargs
                        ) -> LastOperation:
         logger.debug(f"*** last_operation instance {instance_id}")
+        status = load_instance_status(instance_id)
+        if status is not None:
+            return LastOperation(OperationState(status[0]), status[1])
         if os.path.exists(get_instance_file(instance_id)):
-            data = load_instance_meta(instance_id)
+            last_operation = load_instance_last_operation(instance_id)
+            save_instance_status(instance_id, last_operation)
             return LastOperation(
-                OperationState(data["last_operation"]["state"]),
-                data["last_operation"]["description"]
+                OperationState(last_operation["state"]),
+                last_operation["description"]
             )
         return LastOperation(OperationState.IN_PROGRESS)
 
@@ -195,10 +245,21 @@ class HelmServiceBroker(ServiceBroker):
                                **kwargs
                                ) -> LastOperation:
         logger.debug(f"*** last_binding_operation instance {instance_id}")
+        status = load_binding_status(instance_id)
+        if status is not None:
+            return LastOperation(OperationState(status[0]), status[1])
         if os.path.exists(get_binding_file(instance_id)):
-            data = load_binding_meta(instance_id)
+            last_operation = load_binding_last_operation(instance_id)
+            save_binding_status(instance_id, last_operation)
             return LastOperation(
-                OperationState(data["last_operation"]["state"]),
-                data["last_operation"]["description"]
+                OperationState(last_operation["state"]),
+                last_operation["description"]
             )
         return LastOperation(OperationState.IN_PROGRESS)
+
+
+def _task_details(details):
+    """the task payload of the details, the object itself for the previous release"""
+    if TASK_SERIALIZER == "pickle":
+        return details
+    return OperationDetails.from_details(details).to_dict()
@@ -2,21 +2,24 @@ import os
 from urllib.parse import urlparse, parse_qs, urlencode
 from kombu import Exchange, Queue
 from celery import Celery
-from .config import VALKEY_URL
+from .config import VALKEY_URL, TASK_TIME_LIMIT, TASK_SERIALIZER
 
 
 class Config(object):
     # Celery Configuration Options
     enable_utc = True
-    task_serializer = 'pickle'
+    task_serializer = TASK_SERIALIZER
+    result_serializer = 'json'
+    # pickle is only accepted while the messages are sent as pickle, for the
+    # rolling deploy from the previous release, a pickle message can run any code
     accept_content = frozenset([
         'application/data',
         'application/text',
         'application/json',
-        'application/x-python-serialize',
-    ])
-    task_track_started = True
-    task_time_limit = 30 * 60
+    ] + (['application/x-python-serialize'] if TASK_SERIALIZER == 'pickle' else []))
+    # the state of the operations is kept in the instance meta, not in task results
+    task_ignore_result = True
+    task_time_limit = TASK_TIME_LIMIT
     worker_max_tasks_per_child = 200
     worker_prefetch_multiplier = 1
     result_expires = 24 * 60 * 60
@@ -48,6 +51,10 @@ app.conf.update(
             'queue': 'helmbroker.high',
             'exchange': 'helmbroker.priority', 'routing_key': 'helmbroker.priority.high',
         },
+        'helmbroker.tasks.check_rollout': {
+            'queue': 'helmbroker.low',
+            'exchange': 'helmbroker.priority', 'routing_key': 'helmbroker.priority.low',
+        },
         'helmbroker.tasks.deprovision': {
             'queue': 'helmbroker.middle',
             'exchange': 'helmbroker.priority', 'routing_key': 'helmbroker.priority.middle',
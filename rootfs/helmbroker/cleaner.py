@@ -2,36 +2,92 @@ import os
 import time
 import logging
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 
 from openbrokerapi.service_broker import OperationState
 
-from .config import INSTANCES_PATH
+from .utils import get_valkey_client
+from .config import INSTANCES_PATH, CLEANER_WORKERS
 from .database.query import get_instance_file
-from .database.metadata import load_instance_meta
+from .database.metadata import load_instances_meta, delete_instances_cache, \
+    index_instances_meta
+from .database.models import InstanceMeta
 
 logger = logging.getLogger(__name__)
+BATCH_SIZE = 100
+# the last instance id of the cleaned batches, an interrupted run resumes after it
+CHECKPOINT_KEY = "helmbroker:cleaner:checkpoint"
+CHECKPOINT_TTL = 2 * 24 * 3600
 
 
 def clean_instance():
+    """
+    Remove the deprovisioned and broken instances, return the run stats.
+
+    Instances are examined in batches in the order of their ids, their
+    directories are removed by a pool of CLEANER_WORKERS threads.
+    """
+    start = time.monotonic()
+    stats = {"examined": 0, "deleted": 0, "skipped": 0, "duration": 0.0}
     if not os.path.exists(INSTANCES_PATH):
-        return
-    for instance_id in os.listdir(INSTANCES_PATH):
-        if os.path.exists(get_instance_file(instance_id)):
-            data = load_instance_meta(instance_id)
-            interval = time.time() - data["last_modified_time"]
-            state = data["last_operation"]["state"]
-            operation = data["last_operation"]["operation"]
+        return stats
+    valkey = get_valkey_client()
+    checkpoint = valkey.get(CHECKPOINT_KEY)
+    checkpoint = checkpoint.decode() if checkpoint else ""
+    if checkpoint:
+        logger.info(f"clean instance resume after {checkpoint}")
+    with os.scandir(INSTANCES_PATH) as entries:
+        instance_ids = sorted(
+            entry.name for entry in entries if entry.is_dir() and entry.name > checkpoint)
+    with ThreadPoolExecutor(max_workers=CLEANER_WORKERS) as executor:
+        for index in range(0, len(instance_ids), BATCH_SIZE):
+            batch = instance_ids[index:index + BATCH_SIZE]
+            deleted = _clean_instances(executor, batch)
+            stats["examined"] += len(batch)
+            stats["deleted"] += deleted
+            stats["skipped"] += len(batch) - deleted
+            valkey.set(CHECKPOINT_KEY, batch[-1], ex=CHECKPOINT_TTL)
+    valkey.delete(CHECKPOINT_KEY)
+    stats["duration"] = time.monotonic() - start
+    logger.info(
+        "clean instance examined {examined}, deleted {deleted}, skipped {skipped} "
+        "in {duration:.3f}s".format(**stats))
+    return stats
+
+
+def _clean_instances(executor, instance_ids):
+    instances_meta = load_instances_meta(
+        [instance_id for instance_id in instance_ids
+         if os.path.exists(get_instance_file(instance_id))])
+    removed_ids = []
+    for instance_id in instance_ids:
+        if instance_id in instances_meta:
+            meta = InstanceMeta.from_dict(instances_meta[instance_id])
+            interval = time.time() - meta.last_modified_time
+            state = meta.last_operation.state
+            operation = meta.last_operation.operation
             if operation == "deprovision":
                 if state == OperationState.SUCCEEDED or (
                     interval > 3600 * 24
                         and state != OperationState.SUCCEEDED):
-                    shutil.rmtree(
-                        os.path.join(INSTANCES_PATH, instance_id),
-                        ignore_errors=True)
+                    removed_ids.append(instance_id)
         else:
-            shutil.rmtree(
-                os.path.join(INSTANCES_PATH, instance_id), ignore_errors=True)
+            removed_ids.append(instance_id)
+    futures = [
+        executor.submit(
+            shutil.rmtree, os.path.join(INSTANCES_PATH, instance_id), ignore_errors=True)
+        for instance_id in removed_ids
+    ]
+    for future in futures:
+        future.result()
+    delete_instances_cache(removed_ids)
+    index_instances_meta({
+        instance_id: data for instance_id, data in instances_meta.items()
+        if instance_id not in removed_ids
+    })
+    return len(removed_ids)
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     clean_instance()
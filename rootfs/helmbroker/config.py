@@ -5,12 +5,73 @@ CONFIG_ROOT = os.environ.get("HELMBROKER_CONFIG_ROOT", '/etc/helmbroker')
 ADDONS_PATH = os.path.join(CONFIG_ROOT, 'addons')
 CONFIG_PATH = os.path.join(CONFIG_ROOT, 'config')
 INSTANCES_PATH = os.path.join(CONFIG_ROOT, 'instances')
+CACHE_PATH = os.path.join(CONFIG_ROOT, 'cache')
 
 
 USERNAME = os.environ.get('HELMBROKER_USERNAME')
 PASSWORD = os.environ.get('HELMBROKER_PASSWORD')
 
 VALKEY_URL = os.environ.get("HELMBROKER_VALKEY_URL", 'redis://localhost:6379/0')
+VALKEY_MAX_CONNECTIONS = int(os.environ.get("HELMBROKER_VALKEY_MAX_CONNECTIONS", 64))
+# seconds a command waits for a free connection when all of them are in use
+VALKEY_POOL_TIMEOUT = float(os.environ.get("HELMBROKER_VALKEY_POOL_TIMEOUT", 5))
+
+FETCH_WORKERS = int(os.environ.get("HELMBROKER_FETCH_WORKERS", 8))
+FETCH_TIMEOUT = float(os.environ.get("HELMBROKER_FETCH_TIMEOUT", 60))
+FETCH_RETRIES = int(os.environ.get("HELMBROKER_FETCH_RETRIES", 3))
+
+# extracted addon archives cache, the size is in bytes, 0 disables it
+ARCHIVES_CACHE_SIZE = int(os.environ.get("HELMBROKER_ARCHIVES_CACHE_SIZE", 1024 ** 3))
+# resolved chart dependencies cache, the size is in bytes, 0 disables it
+DEPENDENCIES_CACHE_SIZE = int(os.environ.get("HELMBROKER_DEPENDENCIES_CACHE_SIZE", 1024 ** 3))
+# how instance files are filled from the cache: reflink, hardlink or copy
+ARCHIVES_CACHE_LINK = os.environ.get("HELMBROKER_ARCHIVES_CACHE_LINK", "reflink")
+
+# sync metadata files and their directory when replacing them, the concurrent
+# writers of a process share the syncs, it is off unless the volume may lose writes
+FSYNC = os.environ.get("HELMBROKER_FSYNC", "false").lower() == "true"
+
+# snapshots kept in the backups of each instance, 0 keeps all of them
+BACKUP_RETENTION = int(os.environ.get("HELMBROKER_BACKUP_RETENTION", 10))
+
+# seconds a helm or kubectl command may run, and the bytes of its output kept in memory
+COMMAND_TIMEOUT = float(os.environ.get("HELMBROKER_COMMAND_TIMEOUT", 30 * 60))
+COMMAND_OUTPUT_LIMIT = int(os.environ.get("HELMBROKER_COMMAND_OUTPUT_LIMIT", 8 * 1024 ** 2))
+
+# seconds a task may run before its worker process is killed
+TASK_TIME_LIMIT = int(os.environ.get("HELMBROKER_TASK_TIME_LIMIT", 30 * 60))
+# the serializer of the task messages, "pickle" sends them as the previous release
+# did, so that its workers can run them during a rolling deploy, and accepts them
+TASK_SERIALIZER = os.environ.get("HELMBROKER_TASK_SERIALIZER", "json")
+
+# seconds an instance lock lease lasts without renewal, and the seconds a task or
+# an api request waits for a locked instance, a task must still have the time to
+# roll its release out after the wait within TASK_TIME_LIMIT
+LOCK_TTL = float(os.environ.get("HELMBROKER_LOCK_TTL", 60))
+LOCK_TIMEOUT = float(os.environ.get("HELMBROKER_LOCK_TIMEOUT", 5 * 60))
+LOCK_API_TIMEOUT = float(os.environ.get("HELMBROKER_LOCK_API_TIMEOUT", 2))
+# seconds after which a task which waited LOCK_TIMEOUT in vain is queued again,
+# it retries until the operation holding the instance is done
+LOCK_RETRY_INTERVAL = float(os.environ.get("HELMBROKER_LOCK_RETRY_INTERVAL", 30))
+
+# how install and upgrade wait for the release to be ready: "wait" runs helm --wait,
+# "poll" returns once it is applied and checks it every ROLLOUT_CHECK_INTERVAL
+# seconds, the post hooks then run once the release is ready or has failed
+ROLLOUT_MODE = os.environ.get("HELMBROKER_ROLLOUT_MODE", "wait")
+ROLLOUT_TIMEOUT = int(os.environ.get("HELMBROKER_ROLLOUT_TIMEOUT", 25 * 60))
+ROLLOUT_CHECK_INTERVAL = float(os.environ.get("HELMBROKER_ROLLOUT_CHECK_INTERVAL", 10))
+
+# the kubernetes api reading the credentials of the bindings
+KUBERNETES_TIMEOUT = float(os.environ.get("HELMBROKER_KUBERNETES_TIMEOUT", 30))
+KUBERNETES_MAX_CONNECTIONS = int(os.environ.get("HELMBROKER_KUBERNETES_MAX_CONNECTIONS", 8))
+
+CLEANER_WORKERS = int(os.environ.get("HELMBROKER_CLEANER_WORKERS", 8))
+
+# seconds the instance and binding cache is kept after its last write, 0 keeps it forever
+CACHE_TTL = int(os.environ.get("HELMBROKER_CACHE_TTL", 7 * 24 * 3600))
+
+# seconds the api workers cache the last_operation status, 0 disables it
+STATUS_CACHE_TTL = float(os.environ.get("HELMBROKER_STATUS_CACHE_TTL", 0))
 
 
 class Config:
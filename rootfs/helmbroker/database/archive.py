@@ -0,0 +1,202 @@
+import os
+import json
+import stat
+import time
+import fcntl
+import shutil
+import hashlib
+import logging
+import tempfile
+import contextlib
+
+from ..config import CACHE_PATH, ARCHIVES_CACHE_SIZE, ARCHIVES_CACHE_LINK
+
+logger = logging.getLogger(__name__)
+
+ARCHIVES_CACHE_PATH = os.path.join(CACHE_PATH, "archives")
+ARCHIVE_INDEX_FILE = ".index.json"
+# linux ioctl cloning a file, supported by btrfs, xfs and others
+FICLONE = 0x40049409
+# the files helm rewrites in place, they are copied rather than hardlinked
+REWRITTEN_FILES = frozenset(["Chart.lock"])
+
+
+def get_archive_key(url, digest):
+    return hashlib.sha256(f"{url}\n{digest}".encode()).hexdigest()
+
+
+@contextlib.contextmanager
+def open_addon_archive(url, digest=None, members=None):
+    """
+    Yield the directory of the extracted addon archive.
+
+    The archive is extracted once into the content-addressed cache keyed by
+    url and digest, the directory is shared and must not be modified, it is
+    not evicted before the block exits. Without cache or digest only the
+    given members are extracted into a temp dir.
+    """
+    if ARCHIVES_CACHE_SIZE <= 0 or not digest:
+        # without digest a changed archive would be served from the cache
+        from .fetch import _fetch_addon
+        with tempfile.TemporaryDirectory() as temp:
+            _fetch_addon(url, temp, members)
+            yield temp
+        return
+    path = os.path.join(ARCHIVES_CACHE_PATH, get_archive_key(url, digest))
+    while True:
+        with lock_cache_entry(path) as found:
+            if found:
+                os.utime(os.path.join(path, ARCHIVE_INDEX_FILE))
+                yield path
+                return
+        _save_addon_archive(url, digest, path)
+        evict_addon_archives(keep=path)
+
+
+@contextlib.contextmanager
+def lock_cache_entry(path):
+    """
+    Hold a shared lock on the cache entry path, yield whether it exists.
+
+    The lock is taken on the index file of the entry, an eviction takes it
+    exclusively, so an entry is never removed while it is read.
+    """
+    index_file = os.path.join(path, ARCHIVE_INDEX_FILE)
+    try:
+        fd = os.open(index_file, os.O_RDONLY)
+    except FileNotFoundError:
+        yield False
+        return
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH)
+        try:
+            # the entry may have been evicted while waiting for the lock
+            found = os.path.samestat(os.fstat(fd), os.stat(index_file))
+        except FileNotFoundError:
+            found = False
+        yield found
+    finally:
+        os.close(fd)
+
+
+def copy_archive_tree(src, dst):
+    """fill dst from the cache, by reflink or hardlink when it is supported"""
+    return shutil.copytree(src, dst, copy_function=link_file)
+
+
+def evict_addon_archives(keep=None):
+    """remove the least recently used archives until the cache fits its size"""
+    evict_cache(ARCHIVES_CACHE_PATH, ARCHIVES_CACHE_SIZE, keep)
+
+
+def evict_cache(cache_path, cache_size, keep=None):
+    """remove the least recently used entries of cache_path until it fits cache_size"""
+    if not os.path.exists(cache_path):
+        return
+    entries, total_size = [], 0
+    for entry in os.scandir(cache_path):
+        if entry.name.startswith("."):
+            # unfinished entries left by crashed processes
+            if time.time() - entry.stat().st_mtime > 3600:
+                shutil.rmtree(entry.path, ignore_errors=True)
+            continue
+        try:
+            index_file = os.path.join(entry.path, ARCHIVE_INDEX_FILE)
+            with open(index_file) as f:
+                size = json.load(f)["size"]
+            entries.append((os.stat(index_file).st_mtime, size, entry.path))
+            total_size += size
+        except (OSError, ValueError, KeyError):
+            continue
+    for _, size, path in sorted(entries):
+        if total_size <= cache_size:
+            break
+        if path == keep or not _remove_cache_entry(path):
+            continue
+        total_size -= size
+
+
+def _remove_cache_entry(path):
+    """remove the cache entry unless it is being read, return True when it is gone"""
+    try:
+        fd = os.open(os.path.join(path, ARCHIVE_INDEX_FILE), os.O_RDWR)
+    except FileNotFoundError:
+        return True
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logger.debug(f"keep cache entry {path} in use")
+            return False
+        logger.debug(f"evict cache entry {path}")
+        # out of sight of the readers first, a crash leaves an unfinished entry
+        trash = os.path.join(
+            os.path.dirname(path), f".{os.path.basename(path)}.{os.urandom(4).hex()}")
+        os.rename(path, trash)
+        shutil.rmtree(trash, ignore_errors=True)
+        return True
+    finally:
+        os.close(fd)
+
+
+def save_cache_entry(temp, path, index):
+    """
+    Publish the directory temp as the cache entry path.
+
+    The index is saved with the size of the entry, a concurrent process
+    saving the same entry first wins and temp is removed.
+    """
+    try:
+        size = 0
+        for root, _, files in os.walk(temp):
+            for name in files:
+                file = os.path.join(root, name)
+                size += os.path.getsize(file)
+                if ARCHIVES_CACHE_LINK == "hardlink":
+                    # hardlinked instance files must never be modified in place
+                    os.chmod(file, 0o444)
+        with open(os.path.join(temp, ARCHIVE_INDEX_FILE), "w") as f:
+            json.dump(dict(index, size=size), f)
+        try:
+            os.rename(temp, path)
+        except OSError:
+            # another process has already saved the same entry
+            if not os.path.exists(os.path.join(path, ARCHIVE_INDEX_FILE)):
+                raise
+    finally:
+        shutil.rmtree(temp, ignore_errors=True)
+
+
+def _save_addon_archive(url, digest, path):
+    from .fetch import _fetch_addon
+    os.makedirs(ARCHIVES_CACHE_PATH, exist_ok=True)
+    temp = tempfile.mkdtemp(prefix=".", dir=ARCHIVES_CACHE_PATH)
+    try:
+        _fetch_addon(url, temp)
+    except BaseException:
+        shutil.rmtree(temp, ignore_errors=True)
+        raise
+    save_cache_entry(temp, path, {"url": url, "digest": digest})
+
+
+def link_file(src, dst):
+    """
+    Fill dst with the cache file src, by reflink or hardlink when it is supported.
+
+    The REWRITTEN_FILES are never hardlinked and copies are writable, so the
+    cache is not modified through the instance files.
+    """
+    try:
+        if ARCHIVES_CACHE_LINK == "hardlink" and os.path.basename(src) not in REWRITTEN_FILES:
+            os.link(src, dst)
+            return dst
+        elif ARCHIVES_CACHE_LINK == "reflink":
+            with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            shutil.copystat(src, dst)
+            return dst
+    except OSError:
+        pass
+    shutil.copy2(src, dst)
+    os.chmod(dst, os.stat(dst).st_mode | stat.S_IWUSR)
+    return dst
@@ -0,0 +1,120 @@
+import os
+import json
+import yaml
+import fcntl
+import shutil
+import hashlib
+import logging
+import tempfile
+import contextlib
+
+from ..config import CACHE_PATH, DEPENDENCIES_CACHE_SIZE
+from ..utils import helm
+from .archive import ARCHIVE_INDEX_FILE, copy_archive_tree, evict_cache, link_file, \
+    lock_cache_entry, save_cache_entry
+
+logger = logging.getLogger(__name__)
+
+DEPENDENCIES_CACHE_PATH = os.path.join(CACHE_PATH, "dependencies")
+REPOSITORY_CACHE_PATH = os.path.join(CACHE_PATH, "helm", "repository")
+LOCKS_PATH = os.path.join(CACHE_PATH, "locks")
+
+
+def get_dependencies_digest(chart_path):
+    """
+    Return the digest of the chart dependencies, None when they can not be shared.
+
+    The dependencies of Chart.lock are used when it exists, otherwise those
+    of Chart.yaml. Charts without dependencies or depending on local charts
+    have no digest.
+    """
+    dependencies = None
+    for name in ("Chart.lock", "Chart.yaml"):
+        file = os.path.join(chart_path, name)
+        if os.path.exists(file):
+            with open(file) as f:
+                dependencies = (yaml.safe_load(f) or {}).get("dependencies")
+            break
+    if not dependencies or any(
+            str(dependency.get("repository", "")).startswith("file://")
+            for dependency in dependencies):
+        return None
+    data = json.dumps(dependencies, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def update_dependencies(instance_id, chart_path):
+    """
+    Fill the charts dir of the instance chart, return (status, output).
+
+    Dependencies are resolved by `helm dependency update` once per digest
+    and shared from the cache by the later charts with the same digest.
+    """
+    if not os.path.exists(os.path.join(chart_path, "Chart.yaml")):
+        return 0, f"skip dependencies of {chart_path}"
+    digest = get_dependencies_digest(chart_path)
+    if digest is None or DEPENDENCIES_CACHE_SIZE <= 0:
+        return _helm_dependency_update(instance_id, chart_path)
+    path = os.path.join(DEPENDENCIES_CACHE_PATH, digest)
+    index_file = os.path.join(path, ARCHIVE_INDEX_FILE)
+    with _file_lock(f"dependencies-{digest}"):
+        with lock_cache_entry(path) as found:
+            if found:
+                os.utime(index_file)
+                _restore_dependencies(path, chart_path)
+                logger.debug(f"dependencies of {chart_path} restored from {path}")
+                return 0, f"dependencies {digest} restored from cache"
+        status, output = _helm_dependency_update(instance_id, chart_path)
+        if status == 0:
+            _save_dependencies(digest, path, chart_path)
+    evict_cache(DEPENDENCIES_CACHE_PATH, DEPENDENCIES_CACHE_SIZE, keep=path)
+    return status, output
+
+
+def _helm_dependency_update(instance_id, chart_path):
+    os.makedirs(REPOSITORY_CACHE_PATH, exist_ok=True)
+    # helm does not guard the repository indexes it downloads
+    with _file_lock("repository"):
+        return helm(
+            instance_id, "dependency", "update", chart_path,
+            repository_cache=REPOSITORY_CACHE_PATH)
+
+
+def _save_dependencies(digest, path, chart_path):
+    os.makedirs(DEPENDENCIES_CACHE_PATH, exist_ok=True)
+    temp = tempfile.mkdtemp(prefix=".", dir=DEPENDENCIES_CACHE_PATH)
+    try:
+        charts_path = os.path.join(chart_path, "charts")
+        if os.path.exists(charts_path):
+            shutil.copytree(charts_path, os.path.join(temp, "charts"))
+        lock_file = os.path.join(chart_path, "Chart.lock")
+        if os.path.exists(lock_file):
+            shutil.copy2(lock_file, temp)
+    except BaseException:
+        shutil.rmtree(temp, ignore_errors=True)
+        raise
+    save_cache_entry(temp, path, {"digest": digest})
+
+
+def _restore_dependencies(path, chart_path):
+    charts_path = os.path.join(chart_path, "charts")
+    shutil.rmtree(charts_path, ignore_errors=True)
+    if os.path.exists(os.path.join(path, "charts")):
+        copy_archive_tree(os.path.join(path, "charts"), charts_path)
+    if os.path.exists(os.path.join(path, "Chart.lock")):
+        lock_file = os.path.join(chart_path, "Chart.lock")
+        if os.path.exists(lock_file):
+            os.remove(lock_file)
+        link_file(os.path.join(path, "Chart.lock"), lock_file)
+
+
+@contextlib.contextmanager
+def _file_lock(name):
+    """an exclusive lock shared by the processes of this host"""
+    os.makedirs(LOCKS_PATH, exist_ok=True)
+    with open(os.path.join(LOCKS_PATH, f"{name}.lock"), "a") as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
@@ -4,61 +4,174 @@ import requests
 import yaml
 import json
 import glob
+import fnmatch
 import shutil
 import tempfile
+import logging
+import threading
+import contextlib
 import collections
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+from ..config import ADDONS_PATH, FETCH_WORKERS, FETCH_TIMEOUT, FETCH_RETRIES
 
-def fetch_addons(repository):
+logger = logging.getLogger(__name__)
+
+# archives are spooled in memory up to SPOOL_MAX_SIZE, then on disk
+SPOOL_MAX_SIZE = 8 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+# the members needed to read the addons meta during catalog sync
+META_MEMBERS = ("meta.yaml", "plans/*/meta.yaml")
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(url):
+    """return the pooled http session of the url host"""
+    host = urlparse(url).netloc
+    with _sessions_lock:
+        session = _sessions.get(host)
+        if session is None:
+            retry = Retry(
+                total=FETCH_RETRIES, backoff_factor=0.5,
+                status_forcelist=(429, 500, 502, 503, 504),
+            )
+            adapter = HTTPAdapter(
+                max_retries=retry, pool_connections=1, pool_maxsize=FETCH_WORKERS)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sessions[host] = session
+    return session
+
+
+def fetch_addons(repository, executor=None, manifest=None):
+    """
+    Fetch the addons meta of a repository.
+
+    When a sync manifest of the repository is given, index.yaml is requested
+    conditionally and only the charts whose digest changed are downloaded,
+    the manifest is updated in place.
+    """
     if not repository:
         return
+    manifest = manifest if manifest is not None else {}
     temp = tempfile.TemporaryDirectory()
     try:
         index_name = repository['url'].split('/')[-1]
         # download index.yaml
-        remote_index = requests.get(repository['url']).content.decode(encoding="utf-8")
+        headers = {}
+        if manifest.get("etag"):
+            headers["If-None-Match"] = manifest["etag"]
+        if manifest.get("last_modified"):
+            headers["If-Modified-Since"] = manifest["last_modified"]
+        response = get_session(repository['url']).get(
+            repository['url'], headers=headers, timeout=FETCH_TIMEOUT)
+        if response.status_code == 304:
+            logger.info(f"repository {repository['url']} not modified")
+            return _charts_addons_meta(manifest.get("charts", {}))
+        response.raise_for_status()
+        remote_index = response.content.decode(encoding="utf-8")
         # new index
         with open(f"{temp.name}/{index_name}", 'w') as f:
             f.write(remote_index)
         remote_index = yaml.load(remote_index, Loader=yaml.Loader)
-        # save index.yaml addons
-        download_urls = {}
-        for addon_name, addon_metas in remote_index.get('entries', {}).items():
-            download_urls[addon_name] = {}
-            for addon_meta in addon_metas:
-                url = "/".join(repository["url"].split("/")[0:-1])
-                meta_name = f'{addon_name}-{addon_meta["version"]}'
-                addon_tgz_url = f'{url}/{meta_name}.tgz'
-                _fetch_addon(addon_tgz_url, f'{temp.name}/{meta_name}')
-        return _read_addons_meta(temp.name)
+        # download new or changed index.yaml addons concurrently
+        charts, cached_charts = collections.OrderedDict(), manifest.get("charts", {})
+        url = "/".join(repository["url"].split("/")[0:-1])
+        with _executor(executor) as pool:
+            futures = {}
+            for addon_name, addon_metas in remote_index.get('entries', {}).items():
+                for addon_meta in addon_metas:
+                    meta_name = f'{addon_name}-{addon_meta["version"]}'
+                    digest = addon_meta.get("digest")
+                    cached_chart = cached_charts.get(meta_name)
+                    if digest and cached_chart and cached_chart["digest"] == digest:
+                        charts[meta_name] = cached_chart
+                        continue
+                    addon_tgz_url = f'{url}/{meta_name}.tgz'
+                    charts[meta_name] = {"digest": digest}
+                    futures[meta_name] = pool.submit(
+                        _fetch_addon, addon_tgz_url, f'{temp.name}/{meta_name}', META_MEMBERS)
+            for meta_name, future in futures.items():
+                future.result()
+                meta = _read_addon_meta(f'{temp.name}/{meta_name}')
+                if charts[meta_name]["digest"]:
+                    meta["digest"] = charts[meta_name]["digest"]
+                charts[meta_name]["meta"] = meta
+        logger.info(
+            f"repository {repository['url']} fetched {len(futures)} of {len(charts)} charts")
+        manifest.update({
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "charts": charts,
+        })
+        return _charts_addons_meta(charts)
     finally:
         temp.cleanup()
 
 
+def load_sync_manifest():
+    file = os.path.join(ADDONS_PATH, "sync.json")
+    if not os.path.exists(file):
+        return {}
+    with open(file) as f:
+        return json.load(f)
+
+
+def save_sync_manifest(manifest):
+    from .storage import write_file
+    os.makedirs(ADDONS_PATH, exist_ok=True)
+    write_file(os.path.join(ADDONS_PATH, "sync.json"), json.dumps(manifest))
+
+
 def fetch_chart_plan(addon_id, chart_path, plan_id, plan_path):
-    from .query import get_addon_meta
+    from .query import get_addon_meta, get_addon_plan
+    from .archive import open_addon_archive, copy_archive_tree
     addon_meta = get_addon_meta(addon_id)
-    addon_plan = [plan for plan in addon_meta['plans'] if plan['id'] == plan_id][0]
-    temp = tempfile.TemporaryDirectory()
-    try:
-        _fetch_addon(addon_meta['url'], temp.name)
+    addon_plan = get_addon_plan(addon_id, plan_id)
+    chart_member = f"chart/{addon_meta['name']}"
+    plan_member = f"plans/{addon_plan['name']}"
+    with open_addon_archive(
+        addon_meta['url'], addon_meta.get('digest'), members=(chart_member, plan_member)
+    ) as archive_path:
         shutil.rmtree(chart_path, ignore_errors=True)
         shutil.rmtree(plan_path, ignore_errors=True)
-        shutil.copytree(os.path.join(temp.name, "chart", addon_meta["name"]), chart_path)
-        shutil.copytree(os.path.join(temp.name, "plans", addon_plan['name']), plan_path)
-    finally:
-        temp.cleanup()
+        copy_archive_tree(os.path.join(archive_path, chart_member), chart_path)
+        copy_archive_tree(os.path.join(archive_path, plan_member), plan_path)
+
+
+def _executor(executor):
+    """use the shared executor if given, otherwise a private one"""
+    if executor is None:
+        return ThreadPoolExecutor(max_workers=FETCH_WORKERS)
+    return contextlib.nullcontext(executor)
 
 
-def _fetch_addon(url, dest):
-    with tempfile.TemporaryFile(suffix=".tgz") as tgz_file:
-        tgz_file.write(requests.get(url).content)
+def _fetch_addon(url, dest, members=None):
+    """
+    Download and extract the addon archive into dest.
+
+    When members is given only the members matching one of its patterns,
+    or inside one of its directories, are extracted, meta.yaml always is.
+    """
+    logger.debug(f"fetch addon {url}")
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE, suffix=".tgz") as tgz_file:
+        with get_session(url).get(url, stream=True, timeout=FETCH_TIMEOUT) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                tgz_file.write(chunk)
         tgz_file.flush()
         tgz_file.seek(0)
         os.makedirs(dest, exist_ok=True)
         with tarfile.open(fileobj=tgz_file, mode="r:gz") as tarobj:
             for tarinfo in tarobj:
-                tarobj.extract(tarinfo.name, dest, filter='data')
+                if members is None or _match_member(tarinfo.name, members):
+                    tarobj.extract(tarinfo, dest, filter='data')
         filename1 = os.path.join(dest, "meta.yaml")
         with open(filename1, "r") as f1:
             meta = yaml.load(stream=f1, Loader=yaml.Loader)
@@ -70,18 +183,39 @@ def _fetch_addon(url, dest):
         os.remove(filename1)
 
 
+def _match_member(name, members):
+    name = os.path.normpath(name)
+    if name == "meta.yaml":
+        return True
+    for member in members:
+        if name == member or name.startswith(f"{member}/") or fnmatch.fnmatch(name, member):
+            return True
+    return False
+
+
 def _read_addons_meta(addons_path):
     addons_meta = collections.OrderedDict()
     for metafile in glob.glob(os.path.join(addons_path, "*", "meta.json")):
-        with open(metafile) as f1:
-            meta = json.load(f1)
-            meta['plans'] = []
-            metapath = os.path.join(os.path.dirname(metafile))
-            for planfile in glob.glob(os.path.join(metapath, "plans", "*", "meta.yaml")):
-                with open(planfile, 'r') as f2:
-                    plan = yaml.load(f2.read(), Loader=yaml.Loader)
-                    meta["plans"].append(plan)
-            addons_meta[meta['displayName']] = meta
+        meta = _read_addon_meta(os.path.dirname(metafile))
+        addons_meta[meta['displayName']] = meta
+    return addons_meta
+
+
+def _read_addon_meta(metapath):
+    with open(os.path.join(metapath, "meta.json")) as f1:
+        meta = json.load(f1)
+        meta['plans'] = []
+        for planfile in glob.glob(os.path.join(metapath, "plans", "*", "meta.yaml")):
+            with open(planfile, 'r') as f2:
+                plan = yaml.load(f2.read(), Loader=yaml.Loader)
+                meta["plans"].append(plan)
+    return meta
+
+
+def _charts_addons_meta(charts):
+    addons_meta = collections.OrderedDict()
+    for chart in charts.values():
+        addons_meta[chart["meta"]['displayName']] = chart["meta"]
     return addons_meta
 
 
@@ -90,10 +224,33 @@ def main():
     from .metadata import save_addons_meta
     addons_meta = collections.OrderedDict()
     with open(f'{CONFIG_PATH}/repositories', 'r') as f:
-        repositories = yaml.load(f.read(), Loader=yaml.Loader)
-        for repository in repositories:
-            addons_meta.update(fetch_addons(repository))
-    save_addons_meta(addons_meta)
+        repositories = yaml.load(f.read(), Loader=yaml.Loader) or []
+    sync_manifest = load_sync_manifest()
+    manifest = {repository["url"]: sync_manifest.get(repository["url"], {})
+                for repository in repositories}
+    # repositories are fetched concurrently, their addons share one download pool
+    with (
+        ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor,
+        ThreadPoolExecutor(max_workers=max(len(repositories), 1)) as repository_executor,
+    ):
+        futures = [
+            repository_executor.submit(
+                fetch_addons, repository, executor, manifest[repository["url"]])
+            for repository in repositories
+        ]
+        for future in futures:
+            addons_meta.update(future.result() or {})
+    addons_file = os.path.join(ADDONS_PATH, "addons.json")
+    if os.path.exists(addons_file):
+        with open(addons_file) as f:
+            unchanged = f.read() == json.dumps(addons_meta, sort_keys=True, indent=2)
+    else:
+        unchanged = False
+    if unchanged:
+        logger.info("addons meta unchanged, skip saving")
+    else:
+        save_addons_meta(addons_meta)
+    save_sync_manifest(manifest)
 
 
 if __name__ == '__main__':
@@ -2,13 +2,52 @@ import os
 import json
 import time
 import logging
-import jsonschema
+from jsonschema.exceptions import best_match
+from jsonschema.validators import validator_for
+from redis.exceptions import RedisError
 
 from ..utils import get_valkey_client
-from ..config import ADDONS_PATH
+from .models import Model
+from .storage import write_file
+from ..config import ADDONS_PATH, CACHE_TTL, STATUS_CACHE_TTL, TASK_TIME_LIMIT
 
 logger = logging.getLogger(__name__)
 
+# the instance and binding meta as hashes, see _encode_cache
+INSTANCE_CACHE_KEY = "helmbroker:instance:{}:meta"
+BINDING_CACHE_KEY = "helmbroker:binding:{}:meta"
+# the releases before cached the meta as json strings under the cache key without
+# its ":meta" suffix, their pods still use them during a rolling deploy: they are
+# read as a fallback, expire LEGACY_CACHE_TTL seconds after being read and are
+# deleted by the saves
+LEGACY_CACHE_SUFFIX = ":meta"
+LEGACY_CACHE_TTL = 24 * 3600
+ADDONS_CACHE_KEY = "helmbroker:addons"
+INSTANCE_STATUS_KEY = "helmbroker:instance:{}:status"
+BINDING_STATUS_KEY = "helmbroker:binding:{}:status"
+CACHE_STATS_KEY = "helmbroker:cache:stats"
+# the last rendered credential template of the instance and the digest of its inputs
+INSTANCE_RENDER_KEY = "helmbroker:instance:{}:render"
+# the details of the update waiting for a task and the id of that task, later
+# updates are merged into it
+INSTANCE_PENDING_UPDATE_KEY = "helmbroker:instance:{}:pending_update"
+# seconds a pending update is kept once its task runs, a task which crashed or was
+# killed at its time limit leaves it, the next update then queues a task again,
+# it has no ttl while the task waits in the queue
+PENDING_UPDATE_TTL = TASK_TIME_LIMIT
+# sets of instance ids by field value and a sorted set by last_modified_time,
+# the index keys of each instance are kept in its own set to update them
+INSTANCE_INDEX_KEY = "helmbroker:index:instance:{}:{}"
+INSTANCE_TIME_INDEX_KEY = "helmbroker:index:instance:last_modified_time"
+INSTANCE_INDEXES_KEY = "helmbroker:instance:{}:indexes"
+LAST_OPERATION_PREFIX = "last_operation."
+LAST_OPERATION_FIELDS = ("state", "operation", "description")
+ADDONS_GENERATION_KEY = "helmbroker:addons:generation"
+
+# status records cached by the process, {status_key: (expires, status)}
+_status_cache = {}
+STATUS_CACHE_SIZE = 10000
+
 INSTANCE_META_SCHEMA = {
     "type": "object",
     "properties": {
@@ -66,6 +105,7 @@ ADDONS_META_SCHEMA = {
                 "id": {"type": "string"},
                 "name": {"type": "string"},
                 "version": {"type": "string"},
+                "digest": {"type": "string"},
                 "bindable": {"type": "boolean"},
                 "instances_retrievable": {"type": "boolean"},
                 "bindings_retrievable": {"type": "boolean"},
@@ -106,79 +146,579 @@ ADDONS_META_SCHEMA = {
 }
 
 
+def _compile_validator(schema):
+    cls = validator_for(schema)
+    cls.check_schema(schema)
+    return cls(schema)
+
+
+# the schemas are checked and their validators built once per process
+INSTANCE_META_VALIDATOR = _compile_validator(INSTANCE_META_SCHEMA)
+BINDING_META_VALIDATOR = _compile_validator(BINDING_META_SCHEMA)
+ADDONS_META_VALIDATOR = _compile_validator(ADDONS_META_SCHEMA)
+
+
+def validate(validator, data):
+    """same as jsonschema.validate with a precompiled validator"""
+    error = best_match(validator.iter_errors(data))
+    if error is not None:
+        raise error
+
+
 def save_instance_meta(instance_id, data):
-    cache_key = f"helmbroker:instance:{instance_id}"
+    cache_key = INSTANCE_CACHE_KEY.format(instance_id)
     from .query import get_instance_file
-    data["last_modified_time"] = time.time()
+    data = _touch_meta(data)
     file = get_instance_file(instance_id)
-    jsonschema.validate(instance=data, schema=INSTANCE_META_SCHEMA)
+    validate(INSTANCE_META_VALIDATOR, data)
 
-    json_data = json.dumps(data, sort_keys=True, indent=2)
-    with open(file, "w") as f:
-        f.write(json_data)
-    get_valkey_client().set(cache_key, json_data)
+    write_file(file, json.dumps(data, sort_keys=True, indent=2))
+    status_key = INSTANCE_STATUS_KEY.format(instance_id)
+    indexes_key = INSTANCE_INDEXES_KEY.format(instance_id)
+
+    def save(pipe):
+        old_index_keys = [key.decode() for key in pipe.smembers(indexes_key)]
+        pipe.multi()
+        _dump_cache(pipe, cache_key, data)
+        # the pods of the previous release read the file again
+        pipe.delete(_legacy_cache_key(cache_key))
+        _dump_status(pipe, status_key, data)
+        _dump_indexes(pipe, instance_id, data, old_index_keys)
+    valkey = get_valkey_client()
+    _execute_cache(lambda: valkey.transaction(save, indexes_key), cache_key, status_key)
 
 
 def load_instance_meta(instance_id):
-    cache_key = f"helmbroker:instance:{instance_id}"
-    valkey = get_valkey_client()
+    from .query import get_instance_file
+    return _load_meta(
+        "instance", INSTANCE_CACHE_KEY.format(instance_id), get_instance_file(instance_id))
 
-    json_data = valkey.get(cache_key)
-    if not json_data:
-        from .query import get_instance_file
-        file = get_instance_file(instance_id)
-        with open(file) as f:
-            json_data = f.read()
-            valkey.set(cache_key, json_data)
-    return json.loads(json_data)
+
+def load_instances_meta(instance_ids):
+    """
+    Load the meta of many instances with one pipeline, only the cache misses
+    are read from the instance files. Unknown instances are left out.
+    """
+    from .query import get_instance_file
+    return _load_metas("instance", INSTANCE_CACHE_KEY, get_instance_file, instance_ids)
+
+
+def load_instance_last_operation(instance_id):
+    """read only the last_operation fields of the instance cache"""
+    return _load_last_operation(
+        INSTANCE_CACHE_KEY.format(instance_id), load_instance_meta, instance_id)
+
+
+def load_instance_status(instance_id):
+    """
+    Return the (state, description) of the instance last operation, or None
+    when it has no status record. Only valkey or the process cache is read.
+    """
+    return _load_status(INSTANCE_STATUS_KEY.format(instance_id))
+
+
+def save_instance_status(instance_id, last_operation):
+    """create the status record from the instance meta if it does not exist"""
+    _save_status(INSTANCE_STATUS_KEY.format(instance_id), last_operation)
 
 
 def save_binding_meta(instance_id, data):
     from .query import get_binding_file
-    cache_key = f"helmbroker:binding:{instance_id}"
-    data["last_modified_time"] = time.time()
+    cache_key = BINDING_CACHE_KEY.format(instance_id)
+    data = _touch_meta(data)
     file = get_binding_file(instance_id)
-    jsonschema.validate(instance=data, schema=BINDING_META_SCHEMA)
+    validate(BINDING_META_VALIDATOR, data)
 
-    json_data = json.dumps(data, sort_keys=True, indent=2)
-    with open(file, "w") as f:
-        f.write(json_data)
-    get_valkey_client().set(cache_key, json_data)
+    write_file(file, json.dumps(data, sort_keys=True, indent=2))
+    status_key = BINDING_STATUS_KEY.format(instance_id)
+    with get_valkey_client().pipeline() as pipe:
+        _dump_cache(pipe, cache_key, data)
+        pipe.delete(_legacy_cache_key(cache_key))
+        _dump_status(pipe, status_key, data)
+        _execute_cache(pipe.execute, cache_key, status_key)
 
 
 def load_binding_meta(instance_id):
     from .query import get_binding_file
-    cache_key = f"helmbroker:binding:{instance_id}"
+    return _load_meta(
+        "binding", BINDING_CACHE_KEY.format(instance_id), get_binding_file(instance_id))
+
+
+def load_bindings_meta(instance_ids):
+    """same as load_instances_meta for the binding meta"""
+    from .query import get_binding_file
+    return _load_metas("binding", BINDING_CACHE_KEY, get_binding_file, instance_ids)
+
+
+def load_binding_last_operation(instance_id):
+    """read only the last_operation fields of the binding cache"""
+    return _load_last_operation(
+        BINDING_CACHE_KEY.format(instance_id), load_binding_meta, instance_id)
+
+
+def load_binding_status(instance_id):
+    """same as load_instance_status for the binding"""
+    return _load_status(BINDING_STATUS_KEY.format(instance_id))
+
+
+def save_binding_status(instance_id, last_operation):
+    """same as save_instance_status for the binding"""
+    _save_status(BINDING_STATUS_KEY.format(instance_id), last_operation)
+
+
+def load_instance_render(instance_id, digest):
+    """return the cached credential template rendered from inputs of digest, or None"""
+    try:
+        data = get_valkey_client().get(INSTANCE_RENDER_KEY.format(instance_id))
+    except RedisError as e:
+        logger.warning(f"load render cache of {instance_id} error: {e}")
+        return None
+    if data is None:
+        return None
+    data = json.loads(data)
+    return data["template"] if data["digest"] == digest else None
+
+
+def save_instance_render(instance_id, digest, template):
+    try:
+        get_valkey_client().set(
+            INSTANCE_RENDER_KEY.format(instance_id),
+            json.dumps({"digest": digest, "template": template}, separators=(",", ":")),
+            ex=CACHE_TTL or None,
+        )
+    except RedisError as e:
+        logger.warning(f"save render cache of {instance_id} error: {e}")
+
+
+def push_pending_update(instance_id, details, task_id):
+    """
+    Merge the update details into the pending update of the instance, return
+    True when nothing was pending, so the task task_id must be queued to apply it.
+    """
+    pending_key = INSTANCE_PENDING_UPDATE_KEY.format(instance_id)
+
+    def push(pipe):
+        pending = pipe.get(pending_key)
+        pipe.multi()
+        if pending is None:
+            pipe.set(pending_key, _dump_pending_update(task_id, details))
+            return True
+        pending = json.loads(pending)
+        # the ttl of a running task is kept, a stream of updates does not keep an
+        # orphaned one alive
+        pipe.set(pending_key, _dump_pending_update(
+            pending["task_id"], _merge_update(pending["details"], details)), keepttl=True)
+        return False
+    return get_valkey_client().transaction(push, pending_key, value_from_callable=True)
+
+
+def claim_pending_update(instance_id, task_id, running=True):
+    """
+    Expire the pending update of the task task_id PENDING_UPDATE_TTL seconds
+    after the task starts running, or keep it without a ttl when the task is
+    queued again, return True when the task has one.
+    """
+    pending_key = INSTANCE_PENDING_UPDATE_KEY.format(instance_id)
+
+    def claim(pipe):
+        pending = pipe.get(pending_key)
+        if pending is None or json.loads(pending)["task_id"] != task_id:
+            return False
+        pipe.multi()
+        if running:
+            pipe.expire(pending_key, PENDING_UPDATE_TTL)
+        else:
+            pipe.persist(pending_key)
+        return True
+    return get_valkey_client().transaction(claim, pending_key, value_from_callable=True)
+
+
+def pop_pending_update(instance_id):
+    """take the pending update details of the instance, None when there is none"""
+    pending = get_valkey_client().getdel(INSTANCE_PENDING_UPDATE_KEY.format(instance_id))
+    return json.loads(pending)["details"] if pending is not None else None
+
+
+def drop_pending_update(instance_id, task_id):
+    """drop the pending update left by the task task_id, return True when there was one"""
+    pending_key = INSTANCE_PENDING_UPDATE_KEY.format(instance_id)
+
+    def drop(pipe):
+        pending = pipe.get(pending_key)
+        if pending is None or json.loads(pending)["task_id"] != task_id:
+            return False
+        pipe.multi()
+        pipe.delete(pending_key)
+        return True
+    return get_valkey_client().transaction(drop, pending_key, value_from_callable=True)
+
+
+def cancel_pending_update(instance_id):
+    """drop the pending update of the instance, return True when there was one"""
+    return bool(get_valkey_client().delete(INSTANCE_PENDING_UPDATE_KEY.format(instance_id)))
+
+
+def delete_instances_cache(instance_ids):
+    """drop every cache key and index entry of the instances, including their binding"""
+    instance_ids = list(instance_ids)
+    if not instance_ids:
+        return
     valkey = get_valkey_client()
-    json_data = valkey.get(cache_key)
+    with valkey.pipeline(transaction=False) as pipe:
+        for instance_id in instance_ids:
+            pipe.smembers(INSTANCE_INDEXES_KEY.format(instance_id))
+        indexes = pipe.execute()
+    with valkey.pipeline() as pipe:
+        for instance_id, index_keys in zip(instance_ids, indexes):
+            for index_key in index_keys:
+                pipe.srem(index_key, instance_id)
+            pipe.delete(
+                INSTANCE_CACHE_KEY.format(instance_id), INSTANCE_STATUS_KEY.format(instance_id),
+                _legacy_cache_key(INSTANCE_CACHE_KEY.format(instance_id)),
+                _legacy_cache_key(BINDING_CACHE_KEY.format(instance_id)),
+                INSTANCE_INDEXES_KEY.format(instance_id), INSTANCE_RENDER_KEY.format(instance_id),
+                INSTANCE_PENDING_UPDATE_KEY.format(instance_id),
+                BINDING_CACHE_KEY.format(instance_id), BINDING_STATUS_KEY.format(instance_id),
+            )
+        pipe.zrem(INSTANCE_TIME_INDEX_KEY, *instance_ids)
+        pipe.execute()
+
+
+def index_instances_meta(instances_meta):
+    """index the instances saved before the indexes existed, {instance_id: meta}"""
+    valkey = get_valkey_client()
+    instance_ids = list(instances_meta.keys())
+    with valkey.pipeline(transaction=False) as pipe:
+        for instance_id in instance_ids:
+            pipe.exists(INSTANCE_INDEXES_KEY.format(instance_id))
+        indexed = pipe.execute()
+    for instance_id, exists in zip(instance_ids, indexed):
+        if exists:
+            continue
+        indexes_key = INSTANCE_INDEXES_KEY.format(instance_id)
+
+        def index(pipe, instance_id=instance_id, indexes_key=indexes_key):
+            # a save may have indexed the instance meanwhile
+            exists = pipe.exists(indexes_key)
+            pipe.multi()
+            if not exists:
+                _dump_indexes(pipe, instance_id, instances_meta[instance_id], [])
+        valkey.transaction(index, indexes_key)
+
+
+def load_cache_stats():
+    """
+    Return the reads and misses of the instance and binding cache, a miss
+    means the meta has been read from its file.
+    """
+    counters = {
+        key.decode(): int(value)
+        for key, value in get_valkey_client().hgetall(CACHE_STATS_KEY).items()
+    }
+    stats = {}
+    for kind in ("instance", "binding"):
+        reads = counters.get(f"{kind}.reads", 0)
+        misses = counters.get(f"{kind}.misses", 0)
+        stats[kind] = {
+            "reads": reads, "hits": reads - misses, "misses": misses,
+            "hit_rate": (reads - misses) / reads if reads else None,
+        }
+    return stats
+
+
+def _dump_pending_update(task_id, details):
+    return json.dumps({"task_id": task_id, "details": details}, separators=(",", ":"))
+
+
+def _merge_update(pending, details):
+    """the latest service, plan and context win, parameters are merged as the update task does"""
+    merged = dict(pending)
+    for key, value in details.items():
+        if key != "parameters" and value:
+            merged[key] = value
+    merged["parameters"] = {
+        **(pending.get("parameters") or {}), **(details.get("parameters") or {}),
+    }
+    return merged
+
+
+def _touch_meta(data):
+    """set last_modified_time, models are saved as dict"""
+    if isinstance(data, Model):
+        data.last_modified_time = time.time()
+        return data.to_dict()
+    data["last_modified_time"] = time.time()
+    return data
+
+
+def _encode_cache(data):
+    """
+    Encode the meta as the fields of a valkey hash.
+
+    The last_operation items are plain fields, so that they can be read with
+    HGET/HMGET, the other top-level items are stored as compact json.
+    """
+    fields = {}
+    for key, value in data.items():
+        if key == "last_operation" and value:
+            for name, item in value.items():
+                fields[f"{LAST_OPERATION_PREFIX}{name}"] = item
+        else:
+            fields[key] = json.dumps(value, separators=(",", ":"))
+    return fields
+
+
+def _decode_cache(fields):
+    data = {}
+    for key, value in fields.items():
+        key, value = key.decode(), value.decode()
+        if key.startswith(LAST_OPERATION_PREFIX):
+            data.setdefault("last_operation", {})[key[len(LAST_OPERATION_PREFIX):]] = value
+        else:
+            data[key] = json.loads(value)
+    return data
+
+
+def _dump_cache(pipe, cache_key, data):
+    pipe.delete(cache_key)
+    pipe.hset(cache_key, mapping=_encode_cache(data))
+    if CACHE_TTL > 0:
+        pipe.expire(cache_key, CACHE_TTL)
+
+
+def _encode_status(last_operation):
+    if "state" not in last_operation:
+        return None
+    return json.dumps(
+        [last_operation["state"], last_operation.get("description")], separators=(",", ":"))
+
+
+def _dump_status(pipe, status_key, data):
+    json_data = _encode_status(data.get("last_operation", {}))
+    if json_data is None:
+        pipe.delete(status_key)
+    else:
+        pipe.set(status_key, json_data, ex=CACHE_TTL or None)
+
+
+def _save_status(status_key, last_operation):
+    json_data = _encode_status(last_operation)
+    if json_data is not None:
+        # never overwrite a status saved meanwhile with the meta
+        get_valkey_client().set(status_key, json_data, nx=True, ex=CACHE_TTL or None)
+
+
+def _load_status(status_key):
+    now = time.monotonic()
+    if STATUS_CACHE_TTL > 0:
+        expires, status = _status_cache.get(status_key, (0, None))
+        if expires > now:
+            return status
+    json_data = get_valkey_client().get(status_key)
+    status = tuple(json.loads(json_data)) if json_data else None
+    if STATUS_CACHE_TTL > 0 and status is not None:
+        if len(_status_cache) >= STATUS_CACHE_SIZE:
+            _status_cache.clear()
+        _status_cache[status_key] = (now + STATUS_CACHE_TTL, status)
+    return status
+
+
+def _execute_cache(execute, *cache_keys):
+    """the file is saved already, drop its cache when it can not be updated"""
+    try:
+        execute()
+    except RedisError:
+        try:
+            get_valkey_client().delete(*cache_keys)
+        except RedisError as e:
+            logger.error(f"drop cache {cache_keys} error: {e}")
+        raise
+
+
+def _index_keys(data):
+    last_operation, details = data.get("last_operation", {}), data.get("details", {})
+    index_keys = []
+    for name, value in (
+        ("state", last_operation.get("state")),
+        ("operation", last_operation.get("operation")),
+        ("service_id", details.get("service_id")),
+        ("plan_id", details.get("plan_id")),
+    ):
+        if value:
+            index_keys.append(INSTANCE_INDEX_KEY.format(name, value))
+    return index_keys
+
+
+def _dump_indexes(pipe, instance_id, data, old_index_keys):
+    index_keys = _index_keys(data)
+    for index_key in set(old_index_keys) - set(index_keys):
+        pipe.srem(index_key, instance_id)
+    for index_key in index_keys:
+        pipe.sadd(index_key, instance_id)
+    indexes_key = INSTANCE_INDEXES_KEY.format(instance_id)
+    pipe.delete(indexes_key)
+    if index_keys:
+        pipe.sadd(indexes_key, *index_keys)
+    if "last_modified_time" in data:
+        pipe.zadd(INSTANCE_TIME_INDEX_KEY, {instance_id: data["last_modified_time"]})
+
+
+def _legacy_cache_key(cache_key):
+    return cache_key.removesuffix(LEGACY_CACHE_SUFFIX)
+
+
+def _fallback_legacy_cache(valkey, cache_key, data, json_data):
+    """
+    Return the newer of the hash data and the legacy json string json_data.
+
+    The legacy key is left in place for the pods of the previous release and
+    given a ttl, a newer one has been saved by them and is copied to the hash.
+    """
     if not json_data:
-        file = get_binding_file(instance_id)
-        with open(file, 'r') as f:
-            json_data = f.read()
-            valkey.set(cache_key, json_data)
-    return json.loads(json_data)
+        return data
+    legacy = json.loads(json_data)
+    newer = data is None or \
+        legacy.get("last_modified_time", 0) > data.get("last_modified_time", 0)
+    with valkey.pipeline() as pipe:
+        pipe.expire(_legacy_cache_key(cache_key), LEGACY_CACHE_TTL, nx=True)
+        if newer:
+            _dump_cache(pipe, cache_key, legacy)
+        pipe.execute()
+    return legacy if newer else data
+
+
+def _load_meta(kind, cache_key, file):
+    valkey = get_valkey_client()
+    with valkey.pipeline(transaction=False) as pipe:
+        pipe.hgetall(cache_key)
+        pipe.get(_legacy_cache_key(cache_key))
+        pipe.hincrby(CACHE_STATS_KEY, f"{kind}.reads", 1)
+        fields, json_data, _ = pipe.execute()
+    data = _fallback_legacy_cache(
+        valkey, cache_key, _decode_cache(fields) if fields else None, json_data)
+    if data is None:
+        with open(file) as f:
+            data = json.load(f)
+        with valkey.pipeline() as pipe:
+            _dump_cache(pipe, cache_key, data)
+            pipe.hincrby(CACHE_STATS_KEY, f"{kind}.misses", 1)
+            pipe.execute()
+    return data
+
+
+def _load_metas(kind, cache_key, get_file, ids):
+    ids = list(ids)
+    if not ids:
+        return {}
+    valkey = get_valkey_client()
+    with valkey.pipeline(transaction=False) as pipe:
+        for _id in ids:
+            pipe.hgetall(cache_key.format(_id))
+            pipe.get(_legacy_cache_key(cache_key.format(_id)))
+        pipe.hincrby(CACHE_STATS_KEY, f"{kind}.reads", len(ids))
+        results = pipe.execute()[:-1]
+    metas, misses = {}, {}
+    for _id, fields, json_data in zip(ids, results[::2], results[1::2]):
+        data = _fallback_legacy_cache(
+            valkey, cache_key.format(_id), _decode_cache(fields) if fields else None, json_data)
+        if data is None:
+            file = get_file(_id)
+            if not os.path.exists(file):
+                continue
+            with open(file) as f:
+                data = json.load(f)
+            misses[cache_key.format(_id)] = data
+        metas[_id] = data
+    if misses:
+        with valkey.pipeline() as pipe:
+            for key, data in misses.items():
+                _dump_cache(pipe, key, data)
+            pipe.hincrby(CACHE_STATS_KEY, f"{kind}.misses", len(misses))
+            pipe.execute()
+    return metas
+
+
+def _load_last_operation(cache_key, load_meta, _id):
+    with get_valkey_client().pipeline(transaction=False) as pipe:
+        pipe.hmget(
+            cache_key, [f"{LAST_OPERATION_PREFIX}{name}" for name in LAST_OPERATION_FIELDS])
+        pipe.exists(_legacy_cache_key(cache_key))
+        values, legacy = pipe.execute()
+    if legacy or all(value is None for value in values):
+        return load_meta(_id).get("last_operation", {})
+    return {
+        name: value.decode() for name, value in zip(LAST_OPERATION_FIELDS, values)
+        if value is not None
+    }
 
 
 def save_addons_meta(data):
-    cache_key = "helmbroker:addons"
     os.makedirs(ADDONS_PATH, exist_ok=True)
     file = os.path.join(ADDONS_PATH, "addons.json")
-    jsonschema.validate(instance=data, schema=ADDONS_META_SCHEMA)
+    validate(ADDONS_META_VALIDATOR, data)
 
     json_data = json.dumps(data, sort_keys=True, indent=2)
-    with open(file, "w") as f:
-        f.write(json_data)
-    get_valkey_client().set(cache_key, json_data)
+    write_file(file, json_data)
+    with get_valkey_client().pipeline() as pipe:
+        pipe.set(ADDONS_CACHE_KEY, json_data)
+        pipe.incr(ADDONS_GENERATION_KEY)
+        _execute_cache(pipe.execute, ADDONS_CACHE_KEY)
 
 
 def load_addons_meta():
-    cache_key = "helmbroker:addons"
     valkey = get_valkey_client()
 
-    json_data = valkey.get(cache_key)
+    json_data = valkey.get(ADDONS_CACHE_KEY)
     if not json_data:
         file = os.path.join(ADDONS_PATH, "addons.json")
         with open(file, 'r') as f:
             json_data = f.read()
-            valkey.set(cache_key, json_data)
+            valkey.set(ADDONS_CACHE_KEY, json_data)
     return json.loads(json_data)
+
+
+class AddonsCatalog(object):
+    """
+    Addons meta indexed by addon id and plan id, valid for one generation.
+    """
+
+    def __init__(self, generation, addons_meta):
+        self.generation = generation
+        self.addons_meta = addons_meta
+        self.addons = {}
+        self.plans = {}
+        for addon in addons_meta.values():
+            self.addons[addon['id']] = addon
+            for plan in addon['plans']:
+                self.plans[(addon['id'], plan['id'])] = plan
+
+    def get_addon(self, addon_id):
+        return self.addons.get(addon_id)
+
+    def get_plan(self, addon_id, plan_id):
+        return self.plans.get((addon_id, plan_id))
+
+
+_addons_catalog = None
+
+
+def load_addons_catalog():
+    """
+    Return the per-process AddonsCatalog.
+
+    Only the generation counter is read from valkey when the catalog is fresh,
+    the whole addons meta is downloaded and indexed again after save_addons_meta.
+    The returned catalog is shared, callers must not modify it.
+    """
+    global _addons_catalog
+    valkey = get_valkey_client()
+    generation = valkey.get(ADDONS_GENERATION_KEY)
+    if generation is None:
+        valkey.setnx(ADDONS_GENERATION_KEY, 0)
+        generation = valkey.get(ADDONS_GENERATION_KEY)
+    generation = int(generation)
+    catalog = _addons_catalog
+    if catalog is None or catalog.generation != generation:
+        catalog = AddonsCatalog(generation, load_addons_meta())
+        _addons_catalog = catalog
+    return catalog
@@ -0,0 +1,112 @@
+from typing import Any, ClassVar, Dict, Optional, Type, TypeVar
+
+M = TypeVar("M", bound="Model")
+
+
+class Model(object):
+    """
+    Base of the slotted metadata records.
+
+    Items without a slot are kept in `extra`, so that to_dict returns what
+    from_dict was given, None values are left out.
+    """
+    __slots__ = ("extra", )
+    models: ClassVar[Dict[str, Type["Model"]]] = {}
+    extra: Dict[str, Any]
+
+    def __init__(self, **kwargs: Any) -> None:
+        self.extra = {}
+        for name in self.__slots__:
+            setattr(self, name, kwargs.pop(name, None))
+        self.extra.update(kwargs)
+
+    @classmethod
+    def from_dict(cls: Type[M], data: Dict[str, Any]) -> M:
+        obj = cls.__new__(cls)
+        obj.extra = {}
+        for name in cls.__slots__:
+            value = data.get(name)
+            if name in cls.models and value is not None:
+                value = cls.models[name].from_dict(value)
+            setattr(obj, name, value)
+        for key, value in data.items():
+            if key not in cls.__slots__:
+                obj.extra[key] = value
+        return obj
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = dict(self.extra)
+        for name in self.__slots__:
+            value = getattr(self, name)
+            if value is None:
+                continue
+            data[name] = value.to_dict() if name in self.models else value
+        return data
+
+    def __eq__(self, other: object) -> bool:
+        return type(self) is type(other) and self.to_dict() == other.to_dict()
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+
+class LastOperation(Model):
+    __slots__ = ("state", "operation", "description")
+    state: Optional[str]
+    operation: Optional[str]
+    description: Optional[str]
+
+
+class InstanceDetails(Model):
+    __slots__ = ("service_id", "plan_id", "context", "parameters")
+    service_id: Optional[str]
+    plan_id: Optional[str]
+    context: Optional[Dict[str, Any]]
+    parameters: Optional[Dict[str, Any]]
+
+
+class InstanceMeta(Model):
+    __slots__ = ("id", "details", "last_operation", "last_modified_time")
+    models = {"details": InstanceDetails, "last_operation": LastOperation}
+    id: Optional[str]
+    details: Optional[InstanceDetails]
+    last_operation: Optional[LastOperation]
+    last_modified_time: Optional[float]
+
+
+class BindingMeta(Model):
+    __slots__ = ("binding_id", "credentials", "last_operation", "last_modified_time")
+    models = {"last_operation": LastOperation}
+    binding_id: Optional[str]
+    credentials: Optional[Dict[str, Any]]
+    last_operation: Optional[LastOperation]
+    last_modified_time: Optional[float]
+
+
+class OperationDetails(Model):
+    """
+    The details given to the provision, update and bind tasks.
+
+    Task messages carry its dict, only the fields the tasks use, with the
+    version of the layout so that a worker rejects a payload it can not read.
+    """
+    __slots__ = ("version", "service_id", "plan_id", "context", "parameters")
+    VERSION: ClassVar[int] = 1
+    version: Optional[int]
+    service_id: Optional[str]
+    plan_id: Optional[str]
+    context: Optional[Dict[str, Any]]
+    parameters: Optional[Dict[str, Any]]
+
+    @classmethod
+    def from_details(cls, details: Any) -> "OperationDetails":
+        """load a task payload, or the details object of an openbrokerapi request"""
+        if isinstance(details, dict):
+            obj = cls.from_dict(details)
+            if obj.version != cls.VERSION:
+                raise ValueError(f"unsupported operation details version {obj.version}")
+            return obj
+        return cls(
+            version=cls.VERSION, service_id=details.service_id,
+            plan_id=details.plan_id, context=details.context, parameters=details.parameters,
+        )
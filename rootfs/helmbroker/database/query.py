@@ -1,9 +1,20 @@
 import os
+import copy
 import base64
+from concurrent.futures import ThreadPoolExecutor
 
-from ..utils import command
-from ..config import INSTANCES_PATH
-from .metadata import load_addons_meta
+from .. import jsonpath
+from ..utils import get_valkey_client
+from ..kubernetes import get_kubernetes_client, KubernetesError
+from ..config import INSTANCES_PATH, KUBERNETES_MAX_CONNECTIONS
+from .metadata import load_addons_catalog, INSTANCE_INDEX_KEY, INSTANCE_TIME_INDEX_KEY
+
+# the valueFrom refs of the credential templates and the resources they read
+CRED_RESOURCES = {
+    'serviceRef': 'services',
+    'configMapRef': 'configmaps',
+    'secretKeyRef': 'secrets',
+}
 
 
 def get_instance_path(instance_id):
@@ -47,66 +58,126 @@ def get_custom_addon_values_file(instance_id):
 
 
 def get_addon_updateable(addon_id):
-    addon_meta = get_addon_meta(addon_id)
+    addon_meta = load_addons_catalog().get_addon(addon_id)
     return addon_meta.get('plan_updateable', False)
 
 
 def get_addon_bindable(addon_id):
-    addon_meta = get_addon_meta(addon_id)
+    addon_meta = load_addons_catalog().get_addon(addon_id)
     return addon_meta.get('bindable', False)
 
 
 def get_addon_allow_params(addon_id):
-    addon_meta = get_addon_meta(addon_id)
+    addon_meta = load_addons_catalog().get_addon(addon_id)
     return addon_meta.get('allow_parameters', [])
 
 
 def get_addon_archive(addon_id):
-    addon_meta = get_addon_meta(addon_id)
+    addon_meta = load_addons_catalog().get_addon(addon_id)
     return addon_meta.get('archive', False)
 
 
-def get_cred_value(ns, source):
-    if source.get('serviceRef'):
-        return _get_service_key_value(ns, source['serviceRef'])
-    if source.get('configMapRef'):
-        return _get_config_map_key_value(ns, source['configMapRef'])
-    if source.get('secretKeyRef'):
-        return _get_secret_key_value(ns, source['secretKeyRef'])
-    return -1, 'invalid valueFrom'
-
-
-def get_addon_meta(addon_id):
-    addons_meta = load_addons_meta()
-    addons_meta = [
-        addon for addon in [addons for _, addons in addons_meta.items()]
-        if addon['id'] == addon_id
+def get_instance_ids(state=None, operation=None, service_id=None, plan_id=None,
+                     modified_after=None, modified_before=None):
+    """
+    Return the ids of the instances matching all the given filters from the
+    valkey indexes, ordered by last_modified_time.
+    """
+    index_keys = [
+        INSTANCE_INDEX_KEY.format(name, value) for name, value in (
+            ("state", state), ("operation", operation),
+            ("service_id", service_id), ("plan_id", plan_id),
+        ) if value is not None
     ]
-    return addons_meta[0] if len(addons_meta) > 0 else None
+    valkey = get_valkey_client()
+    if index_keys and modified_after is None and modified_before is None:
+        instance_ids = list(valkey.sinter(index_keys))
+        if not instance_ids:
+            return []
+        scores = valkey.zmscore(INSTANCE_TIME_INDEX_KEY, instance_ids)
+        return [
+            instance_id.decode() for _, instance_id in
+            sorted(zip([score or 0 for score in scores], instance_ids))
+        ]
+    with valkey.pipeline(transaction=False) as pipe:
+        pipe.zrangebyscore(
+            INSTANCE_TIME_INDEX_KEY,
+            "-inf" if modified_after is None else modified_after,
+            "+inf" if modified_before is None else modified_before,
+        )
+        if index_keys:
+            pipe.sinter(index_keys)
+        results = pipe.execute()
+    instance_ids = [instance_id.decode() for instance_id in results[0]]
+    if index_keys:
+        matched_ids = {instance_id.decode() for instance_id in results[1]}
+        instance_ids = [instance_id for instance_id in instance_ids if instance_id in matched_ids]
+    return instance_ids
+
+
+def get_addon_instance_ids(service_id, state=None):
+    """ids of the instances of an addon, eg. the failed instances of an addon"""
+    return get_instance_ids(state=state, service_id=service_id)
 
 
-def _get_service_key_value(ns, service_ref):
-    args = [
-        "get", "svc", service_ref['name'], "-n", ns,
-        '-o', f"jsonpath=\'{service_ref['jsonpath']}\'",
-    ]
-    return command("kubectl", *args)
+def get_cred_value(ns, source):
+    return get_cred_values(ns, [source])[0]
+
+
+def get_cred_values(ns, sources):
+    """
+    Resolve the valueFrom sources, return their (status, value) in order.
+
+    Each object is read once however many values refer to it, distinct
+    objects are read concurrently by up to KUBERNETES_MAX_CONNECTIONS threads.
+    """
+    refs = [next((ref for ref in CRED_RESOURCES if source.get(ref)), None) for source in sources]
+    keys = list(dict.fromkeys(
+        (ref, source[ref]['name']) for ref, source in zip(refs, sources) if ref))
+    if len(keys) > 1:
+        with ThreadPoolExecutor(
+                max_workers=min(len(keys), KUBERNETES_MAX_CONNECTIONS)) as executor:
+            objects = dict(zip(keys, executor.map(lambda key: get_cred_object(ns, *key), keys)))
+    else:
+        objects = {key: get_cred_object(ns, *key) for key in keys}
+    values = []
+    for ref, source in zip(refs, sources):
+        if ref is None:
+            values.append((-1, 'invalid valueFrom'))
+            continue
+        status, obj = objects[(ref, source[ref]['name'])]
+        if status != 0:
+            values.append((status, obj))
+        else:
+            values.append(get_cred_object_value(ref, obj, source[ref]['jsonpath']))
+    return values
+
+
+def get_cred_object(ns, ref, name):
+    """read the object of a valueFrom ref, return (status, object or error)"""
+    try:
+        client = get_kubernetes_client()
+    except KubernetesError as e:
+        return 1, str(e)
+    return client.get_object(CRED_RESOURCES[ref], ns, name)
+
+
+def get_cred_object_value(ref, obj, path):
+    """evaluate the jsonpath of a valueFrom ref, secret values are decoded"""
+    try:
+        value = jsonpath.render(path, obj)
+        if ref == 'secretKeyRef':
+            value = base64.b64decode(value).decode()
+    except ValueError as e:
+        return 1, f"error executing jsonpath {path}: {e}"
+    return 0, value
 
 
-def _get_config_map_key_value(ns, config_map_ref):
-    args = [
-        "get", "cm", config_map_ref['name'], "-n", ns,
-        '-o', f"jsonpath=\'{config_map_ref['jsonpath']}\'",
-    ]
-    return command("kubectl", *args)
+def get_addon_meta(addon_id):
+    addon_meta = load_addons_catalog().get_addon(addon_id)
+    return copy.deepcopy(addon_meta) if addon_meta else None
 
 
-def _get_secret_key_value(ns, secret_ref):
-    args = [
-        "get", "secret", secret_ref['name'], "-n", ns, '-o',
-        f"jsonpath=\'{secret_ref['jsonpath']}\'",
-    ]
-    status, output = command("kubectl", *args)
-    if status == 0:
-        output = base64.b64decode(output).decode()
-    return status, output
+def get_addon_plan(addon_id, plan_id):
+    plan = load_addons_catalog().get_plan(addon_id, plan_id)
+    return copy.deepcopy(plan) if plan else None
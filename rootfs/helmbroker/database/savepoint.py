@@ -1,42 +1,147 @@
 import os
+import gzip
 import json
+import stat
+import hashlib
 import logging
 import yaml
 import shutil
 import datetime
+import tempfile
 
-from ..config import CONFIG_PATH
+from ..config import CONFIG_PATH, BACKUP_RETENTION
+from .storage import write_file
 from .query import get_instance_path, get_backups_path, get_addon_meta, get_addon_values_file, \
     get_custom_addon_values_file, get_hooks_result_file
 
 logger = logging.getLogger(__name__)
+BACKUP_CHUNK_SIZE = 64 * 1024
 
 
 def backup_instance(instance_id):
-    now = datetime.datetime.now(datetime.timezone.utc)
-    backup_path = os.path.join(get_backups_path(instance_id), now.isoformat())
-    os.makedirs(backup_path, exist_ok=True)
-
-    hooks_result_file = get_hooks_result_file(instance_id)
-    if os.path.exists(hooks_result_file):
-        shutil.copy(hooks_result_file, backup_path)
-    addon_values_file = get_addon_values_file(instance_id)
-    if os.path.exists(addon_values_file):
-        shutil.copy(addon_values_file, backup_path)
-    custom_addon_values_file = get_custom_addon_values_file(instance_id)
-    if os.path.exists(custom_addon_values_file):
-        shutil.copy(custom_addon_values_file, backup_path)
+    """
+    Snapshot the instance files into its backups dir.
 
+    File contents are stored once, gzip compressed and named by their sha256,
+    a snapshot only lists the files it contains. Every file is hashed, chart
+    files keep the mtime of their archive, so it does not tell a change. No snapshot is taken when
+    nothing changed since the last one, and only the last BACKUP_RETENTION
+    snapshots are kept.
+    """
+    backups_path = get_backups_path(instance_id)
+    snapshots_path = os.path.join(backups_path, "snapshots")
+    objects_path = os.path.join(backups_path, "objects")
+    os.makedirs(snapshots_path, exist_ok=True)
+    os.makedirs(objects_path, exist_ok=True)
+
+    snapshots = list_backups(instance_id)
+    last_files = _load_snapshot(snapshots_path, snapshots[-1])["files"] if snapshots else {}
+    files = {}
+    for name, file in _backup_files(instance_id):
+        file_stat = os.stat(file)
+        files[name] = {
+            "digest": _save_backup_object(objects_path, file), "size": file_stat.st_size,
+            "mode": stat.S_IMODE(file_stat.st_mode),
+        }
+    if snapshots and _snapshot_key(files) == _snapshot_key(last_files):
+        logger.debug(f"backup instance {instance_id} unchanged since {snapshots[-1]}")
+    else:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        name = now.strftime("%Y%m%dT%H%M%S.%fZ")
+        write_file(
+            os.path.join(snapshots_path, f"{name}.json"),
+            json.dumps({"created": now.isoformat(), "files": files}, sort_keys=True),
+        )
+        snapshots.append(name)
+    if BACKUP_RETENTION > 0 and len(snapshots) > BACKUP_RETENTION:
+        _prune_backups(snapshots_path, objects_path, snapshots)
+
+
+def list_backups(instance_id):
+    """names of the instance snapshots, oldest first"""
+    snapshots_path = os.path.join(get_backups_path(instance_id), "snapshots")
+    if not os.path.exists(snapshots_path):
+        return []
+    return sorted(
+        name[:-len(".json")] for name in os.listdir(snapshots_path) if name.endswith(".json"))
+
+
+def restore_backup(instance_id, name, dest):
+    """write the files of the snapshot name into dest"""
+    backups_path = get_backups_path(instance_id)
+    snapshot = _load_snapshot(os.path.join(backups_path, "snapshots"), name)
+    for file_name, file_meta in snapshot["files"].items():
+        file = os.path.join(dest, file_name)
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        object_file = os.path.join(backups_path, "objects", f"{file_meta['digest']}.gz")
+        with gzip.open(object_file, "rb") as fsrc, open(file, "wb") as fdst:
+            shutil.copyfileobj(fsrc, fdst)
+        os.chmod(file, file_meta["mode"])
+
+
+def _backup_files(instance_id):
+    for file in (
+        get_hooks_result_file(instance_id),
+        get_addon_values_file(instance_id),
+        get_custom_addon_values_file(instance_id),
+    ):
+        if os.path.exists(file):
+            yield os.path.basename(file), file
     instance_path = get_instance_path(instance_id)
-    shutil.copytree(os.path.join(instance_path, "plan"), os.path.join(backup_path, "plan"))
-    shutil.copytree(os.path.join(instance_path, "chart"), os.path.join(backup_path, "chart"))
+    for dirname in ("plan", "chart"):
+        for root, dirs, names in os.walk(os.path.join(instance_path, dirname)):
+            dirs.sort()
+            for name in sorted(names):
+                file = os.path.join(root, name)
+                yield os.path.relpath(file, instance_path), file
+
+
+def _snapshot_key(files):
+    return {name: (meta["digest"], meta["mode"]) for name, meta in files.items()}
+
+
+def _load_snapshot(snapshots_path, name):
+    with open(os.path.join(snapshots_path, f"{name}.json")) as f:
+        return json.load(f)
+
+
+def _save_backup_object(objects_path, file):
+    sha256 = hashlib.sha256()
+    with open(file, "rb") as f:
+        for chunk in iter(lambda: f.read(BACKUP_CHUNK_SIZE), b""):
+            sha256.update(chunk)
+    digest = sha256.hexdigest()
+    object_file = os.path.join(objects_path, f"{digest}.gz")
+    if not os.path.exists(object_file):
+        fd, temp = tempfile.mkstemp(prefix=".", dir=objects_path)
+        try:
+            with (
+                open(file, "rb") as fsrc,
+                open(fd, "wb") as raw,
+                gzip.GzipFile(fileobj=raw, mode="wb") as fdst,
+            ):
+                shutil.copyfileobj(fsrc, fdst, BACKUP_CHUNK_SIZE)
+            os.replace(temp, object_file)
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
+    return digest
+
+
+def _prune_backups(snapshots_path, objects_path, snapshots):
+    for name in snapshots[:-BACKUP_RETENTION]:
+        os.remove(os.path.join(snapshots_path, f"{name}.json"))
+    digests = set()
+    for name in snapshots[-BACKUP_RETENTION:]:
+        for meta in _load_snapshot(snapshots_path, name)["files"].values():
+            digests.add(meta["digest"])
+    for name in os.listdir(objects_path):
+        if name.endswith(".gz") and name[:-len(".gz")] not in digests:
+            os.remove(os.path.join(objects_path, name))
 
 
 def save_raw_values(instance_id, data):
-    file = get_custom_addon_values_file(instance_id)
-    with open(file, "w") as f:
-        f.write(data)
-    return file
+    return write_file(get_custom_addon_values_file(instance_id), data)
 
 
 def save_addon_values(service_id, instance_id):
@@ -45,21 +150,26 @@ def save_addon_values(service_id, instance_id):
     logger.debug(f"save_addon_values service: {service}")
     if not os.path.exists(f'{CONFIG_PATH}/addon-values'):
         return None
-    with open(file, "w") as fw:
-        with open(f'{CONFIG_PATH}/addon-values', 'r') as f:
-            addons_values = yaml.load(f.read(), Loader=yaml.Loader)
-            logger.debug(f"save_addon_values addons_values: {addons_values}")
-            addon_values = addons_values.get(service["name"], {}).\
-                get(service["version"], {})
-            logger.debug(f"save_addon_values addon_values: {addon_values}")
-            if not addon_values:
-                return None
-            fw.write(yaml.dump(addon_values))
-    return file
+    with open(f'{CONFIG_PATH}/addon-values', 'r') as f:
+        addons_values = yaml.load(f.read(), Loader=yaml.Loader)
+        logger.debug(f"save_addon_values addons_values: {addons_values}")
+        addon_values = addons_values.get(service["name"], {}).\
+            get(service["version"], {})
+        logger.debug(f"save_addon_values addon_values: {addon_values}")
+    if not addon_values:
+        write_file(file, "")
+        return None
+    return write_file(file, yaml.dump(addon_values))
+
+
+def load_hooks_result(instance_id):
+    file = get_hooks_result_file(instance_id)
+    if not os.path.exists(file):
+        return []
+    with open(file) as f:
+        return json.load(f)
 
 
 def save_hooks_result(instance_id, data):
     file = get_hooks_result_file(instance_id)
-    with open(file, "w") as f:
-        f.write(json.dumps(data, sort_keys=True, indent=2))
-    return file
+    return write_file(file, json.dumps(data, sort_keys=True, indent=2))
@@ -0,0 +1,104 @@
+import os
+import logging
+import tempfile
+import threading
+
+from ..config import FSYNC
+
+logger = logging.getLogger(__name__)
+
+
+class _Batch(object):
+    __slots__ = ("fds", "done", "error")
+
+    def __init__(self):
+        self.fds = []
+        self.done = False
+        self.error = None
+
+
+class GroupCommit(object):
+    """
+    Make written files durable in groups.
+
+    A writer which finds no sync running syncs its file at once, without
+    waiting for others. The writers which arrive while a sync runs join the
+    next group, which the first of them syncs as soon as the running one is
+    done, so concurrent writers share the syncs and a lone writer never waits.
+    Each file or directory of a group is fsynced once.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._batch = _Batch()
+        self._syncing = False
+
+    def sync(self, fd):
+        with self._cond:
+            batch = self._batch
+            batch.fds.append(fd)
+            while self._syncing and not batch.done:
+                self._cond.wait()
+            leader = not batch.done
+            if leader:
+                # the later writers gather in a new group
+                self._syncing, self._batch = True, _Batch()
+        if leader:
+            try:
+                self._sync(batch.fds)
+            except Exception as e:
+                batch.error = e
+            finally:
+                with self._cond:
+                    batch.done, self._syncing = True, False
+                    self._cond.notify_all()
+        if batch.error is not None:
+            raise batch.error
+
+    def _sync(self, fds):
+        synced = set()
+        for fd in fds:
+            file_stat = os.fstat(fd)
+            if (file_stat.st_dev, file_stat.st_ino) not in synced:
+                synced.add((file_stat.st_dev, file_stat.st_ino))
+                os.fsync(fd)
+
+
+_group_commit = GroupCommit()
+
+
+def write_file(file, data):
+    """
+    Replace file with data atomically.
+
+    The data is written to a temp file of the same directory and renamed over
+    file, so a crash leaves either the old or the new content, never a
+    truncated file. With FSYNC the file is synced before the rename and its
+    directory after it, together with the other concurrent writers, so the new
+    content also survives a power loss.
+    """
+    dirname, basename = os.path.split(file)
+    fd, temp = tempfile.mkstemp(prefix=f".{basename}.", suffix=".tmp", dir=dirname)
+    try:
+        os.fchmod(fd, 0o644)
+        with os.fdopen(fd, "w") as f:
+            f.write(data)
+            f.flush()
+            if FSYNC:
+                _group_commit.sync(f.fileno())
+        os.replace(temp, file)
+    except BaseException:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+    if FSYNC:
+        _fsync_dir(dirname or ".")
+    return file
+
+
+def _fsync_dir(dirname):
+    fd = os.open(dirname, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        _group_commit.sync(fd)
+    finally:
+        os.close(fd)
@@ -0,0 +1,221 @@
+"""
+The subset of kubectl jsonpath templates used by the credential templates.
+
+A template is text mixing `{expressions}`, an expression is made of `.field`
+(a `\\.` escapes a dot of the field), `['field']`, `[index]`, `[start:end]`,
+`[*]`, `..field` and `[?(@.field == "value")]` steps. Missing keys render
+nothing, as `kubectl get -o jsonpath` does.
+"""
+import re
+import json
+
+FILTER_RE = re.compile(r"^@(?P<path>[^=!<>]*?)\s*(?:(?P<op>==|!=|<=|>=|<|>)\s*(?P<value>.+))?$")
+FILTER_OPS = {
+    "==": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+    "<": lambda a, b: a < b,
+    ">": lambda a, b: a > b,
+    "<=": lambda a, b: a <= b,
+    ">=": lambda a, b: a >= b,
+}
+
+
+class JSONPathError(ValueError):
+    pass
+
+
+def render(template, data):
+    """render the jsonpath template against data"""
+    result = []
+    for is_expression, value in _parse_template(template):
+        if is_expression:
+            result.append(" ".join(_format(item) for item in find(value, data)))
+        else:
+            result.append(value)
+    return "".join(result)
+
+
+def find(expression, data):
+    """return the values matching the jsonpath expression"""
+    nodes = [data]
+    for step in _parse_path(expression.strip()):
+        nodes = [item for node in nodes for item in _apply(step, node)]
+    return nodes
+
+
+def _parse_template(template):
+    template = template.strip()
+    if "{" not in template:
+        # kubectl accepts relaxed expressions like `.data.password`
+        return [(True, template)]
+    parts, index = [], 0
+    while index < len(template):
+        start = template.find("{", index)
+        if start < 0:
+            parts.append((False, template[index:]))
+            break
+        end = template.find("}", start)
+        if end < 0:
+            raise JSONPathError(f"unclosed expression in {template}")
+        if start > index:
+            parts.append((False, template[index:start]))
+        parts.append((True, template[start + 1:end]))
+        index = end + 1
+    return parts
+
+
+def _parse_path(expression):
+    steps, index = [], 0
+    if expression[:1] in ("$", "@"):
+        index = 1
+    while index < len(expression):
+        if expression.startswith("..", index):
+            steps.append(("recursive", None))
+            index += 2
+        elif expression[index] == ".":
+            index += 1
+        elif expression[index] == "[":
+            end = _find_bracket_end(expression, index)
+            steps.append(_parse_bracket(expression[index + 1:end].strip()))
+            index = end + 1
+        else:
+            name, index = _read_name(expression, index)
+            steps.append(("field", name))
+    return steps
+
+
+def _read_name(expression, index):
+    name = []
+    while index < len(expression) and expression[index] not in ".[":
+        if expression[index] == "\\" and index + 1 < len(expression):
+            index += 1
+        name.append(expression[index])
+        index += 1
+    return "".join(name), index
+
+
+def _find_bracket_end(expression, index):
+    depth, quote = 0, None
+    for end in range(index, len(expression)):
+        char = expression[end]
+        if quote:
+            if char == quote:
+                quote = None
+        elif char in "'\"":
+            quote = char
+        elif char == "[":
+            depth += 1
+        elif char == "]":
+            depth -= 1
+            if depth == 0:
+                return end
+    raise JSONPathError(f"unclosed bracket in {expression}")
+
+
+def _parse_bracket(value):
+    if value == "*":
+        return ("wildcard", None)
+    if value.startswith("?(") and value.endswith(")"):
+        match = FILTER_RE.match(value[2:-1].strip())
+        if not match:
+            raise JSONPathError(f"invalid filter {value}")
+        literal = match.group("value")
+        return ("filter", (
+            _parse_path(match.group("path")), match.group("op"),
+            _parse_literal(literal) if literal is not None else None,
+        ))
+    if value[:1] in ("'", '"'):
+        return ("field", value[1:-1])
+    try:
+        if ":" in value:
+            start, end = (int(item) if item.strip() else None for item in value.split(":")[:2])
+            return ("slice", (start, end))
+        return ("index", int(value))
+    except ValueError:
+        raise JSONPathError(f"invalid subscript [{value}]") from None
+
+
+def _parse_literal(value):
+    value = value.strip()
+    if value[:1] in ("'", '"'):
+        return value[1:-1]
+    try:
+        return json.loads(value)
+    except ValueError:
+        raise JSONPathError(f"invalid literal {value}") from None
+
+
+def _apply(step, node):
+    kind, arg = step
+    return STEPS[kind](arg, node)
+
+
+def _field(name, node):
+    return [node[name]] if isinstance(node, dict) and name in node else []
+
+
+def _wildcard(_, node):
+    if isinstance(node, dict):
+        return [node[key] for key in sorted(node)]
+    return list(node) if isinstance(node, list) else []
+
+
+def _index(index, node):
+    if isinstance(node, list) and -len(node) <= index < len(node):
+        return [node[index]]
+    return []
+
+
+def _slice(bounds, node):
+    return node[bounds[0]:bounds[1]] if isinstance(node, list) else []
+
+
+def _recursive(_, node):
+    return list(_descendants(node))
+
+
+def _filter(condition, node):
+    return [item for item in node if _match(condition, item)] if isinstance(node, list) else []
+
+
+STEPS = {
+    "field": _field,
+    "wildcard": _wildcard,
+    "index": _index,
+    "slice": _slice,
+    "recursive": _recursive,
+    "filter": _filter,
+}
+
+
+def _descendants(node):
+    yield node
+    children = node.values() if isinstance(node, dict) else \
+        node if isinstance(node, list) else ()
+    for child in children:
+        yield from _descendants(child)
+
+
+def _match(condition, item):
+    path, op, value = condition
+    nodes = [item]
+    for step in path:
+        nodes = [child for node in nodes for child in _apply(step, node)]
+    if op is None:
+        return bool(nodes)
+    try:
+        return any(FILTER_OPS[op](node, value) for node in nodes)
+    except TypeError:
+        return False
+
+
+def _format(value):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (int, float)):
+        return str(value)
+    if value is None:
+        return ""
+    return json.dumps(value)
@@ -0,0 +1,270 @@
+import os
+import time
+import yaml
+import base64
+import atexit
+import shutil
+import logging
+import tempfile
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .config import KUBERNETES_TIMEOUT, KUBERNETES_MAX_CONNECTIONS
+
+logger = logging.getLogger(__name__)
+SERVICE_ACCOUNT_PATH = "/var/run/secrets/kubernetes.io/serviceaccount"
+# seconds a token file is cached, projected service account tokens are rotated
+TOKEN_FILE_TTL = 60
+# the resources whose readiness a rollout waits for, as `helm --wait` does
+READY_RESOURCES = {
+    "Deployment": "/apis/apps/v1/namespaces/{}/deployments/{}",
+    "StatefulSet": "/apis/apps/v1/namespaces/{}/statefulsets/{}",
+    "DaemonSet": "/apis/apps/v1/namespaces/{}/daemonsets/{}",
+    "Pod": "/api/v1/namespaces/{}/pods/{}",
+    "PersistentVolumeClaim": "/api/v1/namespaces/{}/persistentvolumeclaims/{}",
+    "Service": "/api/v1/namespaces/{}/services/{}",
+}
+
+
+class KubernetesError(Exception):
+    pass
+
+
+class KubernetesClient(object):
+    """
+    A minimal client of the core v1 API.
+
+    Requests share one pooled session, the credentials are those of the
+    service account of the pod or of the current context of KUBECONFIG.
+    """
+
+    def __init__(self, server, token=None, token_file=None, verify=True, cert=None,
+                 auth=None):
+        self.server = server.rstrip("/")
+        self.token = token
+        self.token_file = token_file
+        self._token_expires = 0
+        retry = Retry(
+            total=3, backoff_factor=0.2, allowed_methods=("GET", ),
+            status_forcelist=(429, 500, 502, 503, 504),
+        )
+        adapter = HTTPAdapter(
+            max_retries=retry, pool_connections=1, pool_maxsize=KUBERNETES_MAX_CONNECTIONS)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.verify = verify
+        self.session.cert = cert
+        self.session.auth = auth
+
+    def get(self, path):
+        headers = {"Accept": "application/json"}
+        token = self._get_token()
+        if token:
+            headers["Authorization"] = f"Bearer {token}"
+        return self.session.get(
+            f"{self.server}{path}", headers=headers, timeout=KUBERNETES_TIMEOUT)
+
+    def get_object(self, resource, namespace, name):
+        """return (status, object), status 0 means found, the error otherwise"""
+        return self.get_json(f"/api/v1/namespaces/{namespace}/{resource}/{name}")
+
+    def get_json(self, path):
+        try:
+            response = self.get(path)
+        except requests.RequestException as e:
+            return 1, f"Unable to connect to the server: {e}"
+        if response.status_code == 200:
+            return 0, response.json()
+        try:
+            status = response.json()
+            message = f"{status.get('reason', response.reason)}: {status.get('message', '')}"
+        except ValueError:
+            message = f"{response.reason}: {response.text}"
+        return 1, f"Error from server ({message})"
+
+    def _get_token(self):
+        if self.token_file and time.monotonic() >= self._token_expires:
+            with open(self.token_file) as f:
+                self.token = f.read().strip()
+            self._token_expires = time.monotonic() + TOKEN_FILE_TTL
+        return self.token
+
+    def check_ready(self, manifest, namespace):
+        """
+        Return (ready, message) of the resources of a release manifest.
+
+        Workloads must have their replicas updated and ready, pods must be
+        ready, claims bound and load balancers provisioned.
+        """
+        not_ready = []
+        for resource in yaml.safe_load_all(manifest):
+            if not isinstance(resource, dict) or resource.get("kind") not in READY_RESOURCES:
+                continue
+            kind, metadata = resource["kind"], resource.get("metadata", {})
+            path = READY_RESOURCES[kind].format(
+                metadata.get("namespace", namespace), metadata.get("name"))
+            status, obj = self.get_json(path)
+            if status != 0:
+                not_ready.append(f"{kind}/{metadata.get('name')}: {obj}")
+            elif not _READY_CHECKS[kind](obj):
+                not_ready.append(f"{kind}/{metadata.get('name')}")
+        if not_ready:
+            return False, f"waiting for {', '.join(not_ready)}"
+        return True, "all resources are ready"
+
+
+def _generation_observed(obj):
+    return obj.get("status", {}).get("observedGeneration", 0) >= \
+        obj.get("metadata", {}).get("generation", 0)
+
+
+def _deployment_ready(obj):
+    replicas, status = obj.get("spec", {}).get("replicas", 1), obj.get("status", {})
+    return _generation_observed(obj) \
+        and status.get("updatedReplicas", 0) >= replicas \
+        and status.get("readyReplicas", 0) >= replicas
+
+
+def _statefulset_ready(obj):
+    spec, status = obj.get("spec", {}), obj.get("status", {})
+    replicas = spec.get("replicas", 1)
+    strategy = spec.get("updateStrategy", {})
+    if strategy.get("type", "RollingUpdate") == "RollingUpdate":
+        partition = strategy.get("rollingUpdate", {}).get("partition", 0)
+        if status.get("updatedReplicas", 0) < replicas - partition:
+            return False
+    return _generation_observed(obj) and status.get("readyReplicas", 0) >= replicas
+
+
+def _daemonset_ready(obj):
+    status = obj.get("status", {})
+    desired = status.get("desiredNumberScheduled", 0)
+    return _generation_observed(obj) \
+        and status.get("updatedNumberScheduled", 0) >= desired \
+        and status.get("numberReady", 0) >= desired
+
+
+def _pod_ready(obj):
+    status = obj.get("status", {})
+    if status.get("phase") == "Succeeded":
+        return True
+    return any(
+        condition.get("type") == "Ready" and condition.get("status") == "True"
+        for condition in status.get("conditions", []))
+
+
+def _pvc_ready(obj):
+    return obj.get("status", {}).get("phase") == "Bound"
+
+
+def _service_ready(obj):
+    spec = obj.get("spec", {})
+    if spec.get("type") != "LoadBalancer" or spec.get("externalIPs"):
+        return True
+    return bool(obj.get("status", {}).get("loadBalancer", {}).get("ingress"))
+
+
+_READY_CHECKS = {
+    "Deployment": _deployment_ready,
+    "StatefulSet": _statefulset_ready,
+    "DaemonSet": _daemonset_ready,
+    "Pod": _pod_ready,
+    "PersistentVolumeClaim": _pvc_ready,
+    "Service": _service_ready,
+}
+
+
+_kubernetes_client = (None, None)  # (pid, client)
+_kubernetes_client_lock = threading.Lock()
+
+
+def get_kubernetes_client():
+    """return the kubernetes client of the current process"""
+    global _kubernetes_client
+    pid, client = _kubernetes_client
+    if pid == os.getpid():
+        return client
+    with _kubernetes_client_lock:
+        pid, client = _kubernetes_client
+        if pid != os.getpid():
+            client = load_kubernetes_client()
+            _kubernetes_client = (os.getpid(), client)
+    return client
+
+
+def load_kubernetes_client():
+    """load the in cluster config, or the KUBECONFIG when out of a cluster"""
+    host, port = os.environ.get("KUBERNETES_SERVICE_HOST"), \
+        os.environ.get("KUBERNETES_SERVICE_PORT")
+    token_file = os.path.join(SERVICE_ACCOUNT_PATH, "token")
+    if host and port and os.path.exists(token_file):
+        if ":" in host:
+            host = f"[{host}]"
+        return KubernetesClient(
+            f"https://{host}:{port}", token_file=token_file,
+            verify=os.path.join(SERVICE_ACCOUNT_PATH, "ca.crt"),
+        )
+    kubeconfig = os.environ.get("KUBECONFIG", os.path.expanduser("~/.kube/config"))
+    for file in kubeconfig.split(os.pathsep):
+        if os.path.exists(file):
+            return _load_kubeconfig(file)
+    raise KubernetesError("no in cluster config nor kubeconfig found")
+
+
+def _load_kubeconfig(file):
+    with open(file) as f:
+        config = yaml.safe_load(f)
+    base = os.path.dirname(os.path.abspath(file))
+    context_name = config.get("current-context")
+    context = _find_named(config, "contexts", context_name, "context")
+    cluster = _find_named(config, "clusters", context["cluster"], "cluster")
+    user = _find_named(config, "users", context.get("user"), "user") \
+        if context.get("user") else {}
+    if "exec" in user or "auth-provider" in user:
+        raise KubernetesError(f"unsupported credentials of user {context.get('user')}")
+    verify = True
+    if cluster.get("insecure-skip-tls-verify"):
+        verify = False
+    elif cluster.get("certificate-authority") or cluster.get("certificate-authority-data"):
+        verify = _kubeconfig_file(cluster, "certificate-authority", base)
+    cert = None
+    if user.get("client-certificate") or user.get("client-certificate-data"):
+        cert = (
+            _kubeconfig_file(user, "client-certificate", base),
+            _kubeconfig_file(user, "client-key", base),
+        )
+    auth = (user["username"], user["password"]) if user.get("username") else None
+    token_file = user.get("tokenFile")
+    if token_file:
+        token_file = os.path.join(base, token_file)
+    return KubernetesClient(
+        cluster["server"], token=user.get("token"), token_file=token_file,
+        verify=verify, cert=cert, auth=auth,
+    )
+
+
+def _find_named(config, items, name, key):
+    for item in config.get(items) or []:
+        if item.get("name") == name:
+            return item.get(key) or {}
+    raise KubernetesError(f"{key} {name} not found in kubeconfig")
+
+
+_data_path = None
+
+
+def _kubeconfig_file(item, key, base):
+    """return the path of item[key], the inline item[key-data] is saved to a file"""
+    global _data_path
+    if item.get(key):
+        return os.path.join(base, item[key])
+    if _data_path is None:
+        _data_path = tempfile.mkdtemp(prefix="helmbroker-kubeconfig-")
+        atexit.register(shutil.rmtree, _data_path, ignore_errors=True)
+    fd, file = tempfile.mkstemp(dir=_data_path)
+    with os.fdopen(fd, "wb") as f:
+        f.write(base64.b64decode(item[f"{key}-data"]))
+    return file
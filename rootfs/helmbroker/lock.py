@@ -0,0 +1,161 @@
+import os
+import time
+import logging
+import threading
+
+from redis.exceptions import RedisError
+
+from .utils import get_valkey_client
+from .config import LOCK_TTL
+
+logger = logging.getLogger(__name__)
+INSTANCE_LOCK_KEY = "helmbroker:lock:instance:{}"
+# the releases before leases locked the bare instance id, it is taken as well
+# so that their workers and this release exclude each other during a rolling
+# deploy, it can be dropped by the next release
+LEGACY_LOCK_KEY = "{}"
+LOCK_STATS_KEY = "helmbroker:lock:stats"
+# seconds between two tries of a waiting acquire, doubled up to the max
+WAIT_INTERVAL = 0.05
+WAIT_INTERVAL_MAX = 0.5
+
+
+class LockTimeout(Exception):
+    pass
+
+
+class InstanceLock(object):
+    """
+    A lease on an instance, held by one task or request at a time.
+
+    The lease expires ttl seconds after it was last renewed, the holder
+    renews it every ttl / 3 seconds from a thread, so the instances of a
+    crashed worker are released after at most ttl seconds. An acquire waits
+    at most timeout seconds, None waits until the lease is free. The lease is
+    held on both INSTANCE_LOCK_KEY and LEGACY_LOCK_KEY.
+    """
+
+    def __init__(self, instance_id, ttl=LOCK_TTL, timeout=None):
+        self.instance_id = instance_id
+        self.key = INSTANCE_LOCK_KEY.format(instance_id)
+        self.keys = (self.key, LEGACY_LOCK_KEY.format(instance_id))
+        self.ttl = ttl
+        self.timeout = timeout
+        self.token = None
+        self._stopped = None
+
+    def acquire(self, blocking=True, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        token = os.urandom(16).hex()
+        valkey = get_valkey_client()
+        start = time.monotonic()
+        interval, contended = WAIT_INTERVAL, False
+        while not self._set(valkey, token):
+            contended = True
+            wait_time = time.monotonic() - start
+            if not blocking:
+                # a routine back off of a caller which retries later, not a timeout
+                _count_stats(contended=True, busy=1)
+                return False
+            if timeout is not None and wait_time + interval > timeout:
+                _count_stats(contended=True, timeouts=1, wait_time=wait_time)
+                return False
+            time.sleep(interval)
+            interval = min(interval * 2, WAIT_INTERVAL_MAX)
+        _count_stats(
+            acquired=1, contended=contended, wait_time=time.monotonic() - start)
+        self.token = token
+        self._stopped = threading.Event()
+        threading.Thread(target=self._renew, args=(token, self._stopped), daemon=True).start()
+        return True
+
+    def release(self):
+        if self.token is None:
+            return
+        self._stopped.set()
+        token, self.token = self.token, None
+        try:
+            self._delete(get_valkey_client(), token)
+        except RedisError as e:
+            logger.warning(f"release lock of {self.instance_id} error: {e}, it expires")
+
+    def extend(self, token=None):
+        """renew the lease, return False when it has been lost"""
+        token = (token or self.token).encode()
+
+        def extend(pipe):
+            if any(value != token for value in pipe.mget(self.keys)):
+                return False
+            pipe.multi()
+            for key in self.keys:
+                pipe.pexpire(key, int(self.ttl * 1000))
+            return True
+        return get_valkey_client().transaction(extend, *self.keys, value_from_callable=True)
+
+    def _set(self, valkey, token):
+        with valkey.pipeline(transaction=False) as pipe:
+            for key in self.keys:
+                pipe.set(key, token, nx=True, px=int(self.ttl * 1000))
+            acquired = pipe.execute()
+        if all(acquired):
+            return True
+        if any(acquired):
+            # give back the keys taken, another holder has the others
+            self._delete(valkey, token)
+        return False
+
+    def _delete(self, valkey, token):
+        token = token.encode()
+
+        def delete(pipe):
+            keys = [key for key, value in zip(self.keys, pipe.mget(self.keys)) if value == token]
+            pipe.multi()
+            if keys:
+                pipe.delete(*keys)
+        valkey.transaction(delete, *self.keys)
+
+    def _renew(self, token, stopped):
+        while not stopped.wait(self.ttl / 3):
+            try:
+                if not self.extend(token):
+                    logger.error(f"lock of {self.instance_id} lost, it has expired")
+                    _count_stats(lost=1)
+                    return
+            except RedisError as e:
+                logger.warning(f"renew lock of {self.instance_id} error: {e}")
+
+    def __enter__(self):
+        if not self.acquire():
+            raise LockTimeout(f"instance {self.instance_id} is locked by another operation")
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def load_lock_stats():
+    """
+    Return the lock counters, wait_time is the seconds spent waiting for leases.
+
+    busy counts the non blocking acquires which found the lease taken.
+    """
+    stats = {
+        "acquired": 0, "contended": 0, "busy": 0, "timeouts": 0, "lost": 0, "wait_time": 0.0}
+    for key, value in get_valkey_client().hgetall(LOCK_STATS_KEY).items():
+        key = key.decode()
+        stats[key] = float(value) if key == "wait_time" else int(value)
+    return stats
+
+
+def _count_stats(contended=False, wait_time=0.0, **counters):
+    try:
+        with get_valkey_client().pipeline(transaction=False) as pipe:
+            for name, value in counters.items():
+                pipe.hincrby(LOCK_STATS_KEY, name, value)
+            if contended:
+                pipe.hincrby(LOCK_STATS_KEY, "contended", 1)
+            if wait_time:
+                pipe.hincrbyfloat(LOCK_STATS_KEY, "wait_time", wait_time)
+            pipe.execute()
+    except RedisError as e:
+        logger.warning(f"count lock stats error: {e}")
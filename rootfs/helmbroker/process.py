@@ -0,0 +1,194 @@
+import os
+import time
+import shlex
+import select
+import signal
+import logging
+import threading
+import subprocess
+import collections
+
+from .config import COMMAND_TIMEOUT, COMMAND_OUTPUT_LIMIT
+
+logger = logging.getLogger(__name__)
+READ_SIZE = 64 * 1024
+POLL_INTERVAL = 0.1
+# seconds a timed out or cancelled command is given to exit before it is killed
+KILL_GRACE = 5
+# a log file bigger than this is moved to `<log_file>.1` before it is written
+LOG_ROTATE_SIZE = 16 * 1024 ** 2
+
+
+class OutputBuffer(object):
+    """keep the last `limit` bytes written, older bytes are dropped"""
+    __slots__ = ("limit", "size", "truncated", "_chunks")
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.size = 0
+        self.truncated = False
+        self._chunks = collections.deque()
+
+    def write(self, data):
+        self._chunks.append(data)
+        self.size += len(data)
+        while self.size > self.limit:
+            extra, chunk = self.size - self.limit, self._chunks[0]
+            if len(chunk) <= extra:
+                self._chunks.popleft()
+                self.size -= len(chunk)
+            else:
+                self._chunks[0] = chunk[extra:]
+                self.size -= extra
+            self.truncated = True
+
+    def getvalue(self):
+        return b"".join(self._chunks)
+
+
+class CommandResult(object):
+    __slots__ = (
+        "args", "status", "stdout", "stderr", "wall_time", "cpu_time", "timed_out", "cancelled")
+
+    def __init__(self, args, status, stdout="", stderr="", wall_time=0.0, cpu_time=0.0,
+                 timed_out=False, cancelled=False):
+        self.args = args
+        self.status = status
+        self.stdout = stdout
+        self.stderr = stderr
+        self.wall_time = wall_time
+        self.cpu_time = cpu_time
+        self.timed_out = timed_out
+        self.cancelled = cancelled
+
+    @property
+    def output(self):
+        """stdout, followed by stderr when the command failed"""
+        if self.status == 0 or not self.stderr:
+            return self.stdout
+        return f"{self.stdout}\n{self.stderr}" if self.stdout else self.stderr
+
+    def __repr__(self):
+        return (
+            f"CommandResult(args={self.args!r}, status={self.status}, "
+            f"wall_time={self.wall_time:.3f}, cpu_time={self.cpu_time:.3f})")
+
+
+def run(args, timeout=COMMAND_TIMEOUT, cancel=None, log_file=None, log_stdout=True,
+        log_args=None, limit=COMMAND_OUTPUT_LIMIT, cwd=None, env=None):
+    """
+    Execute the argument vector args without a shell.
+
+    stdout and stderr are read as they are produced into buffers keeping
+    their last `limit` bytes, and appended to log_file when it is given,
+    stdout only with log_stdout. The log shows the command as log_args, args
+    by default. The command is terminated after timeout seconds or when the
+    cancel event is set, together with the processes it started.
+    """
+    args = [str(arg) for arg in args]
+    start = time.monotonic()
+    log = _open_log(log_file, args if log_args is None else log_args) if log_file else None
+    try:
+        try:
+            proc = subprocess.Popen(
+                args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE, cwd=cwd, env=env, start_new_session=True)
+        except OSError as e:
+            # the status a shell returns for a command it can not run
+            return CommandResult(args, 127, stderr=str(e), wall_time=time.monotonic() - start)
+        buffers = OutputBuffer(limit), OutputBuffer(limit)
+        log_lock = threading.Lock()
+        logs = log if log_stdout else None, log
+        readers = [
+            threading.Thread(target=_read_pipe, args=(pipe, buffer, out, log_lock), daemon=True)
+            for pipe, buffer, out in zip((proc.stdout, proc.stderr), buffers, logs)
+        ]
+        for reader in readers:
+            reader.start()
+        status, rusage, stopped = _wait(proc, timeout, cancel)
+        for reader in readers:
+            reader.join()
+    finally:
+        if log:
+            log.close()
+    stdout, stderr = (buffer.getvalue().decode(errors="replace") for buffer in buffers)
+    if stopped == "timeout":
+        stderr += f"\ncommand timed out after {timeout}s"
+    elif stopped == "cancel":
+        stderr += "\ncommand cancelled"
+    result = CommandResult(
+        args, status, stdout, stderr,
+        wall_time=time.monotonic() - start,
+        cpu_time=rusage.ru_utime + rusage.ru_stime,
+        timed_out=stopped == "timeout", cancelled=stopped == "cancel",
+    )
+    logger.debug(
+        f"command {args[0]} exited {status} in {result.wall_time:.3f}s, "
+        f"cpu {result.cpu_time:.3f}s")
+    return result
+
+
+def _open_log(log_file, args):
+    os.makedirs(os.path.dirname(log_file), exist_ok=True)
+    if os.path.exists(log_file) and os.path.getsize(log_file) > LOG_ROTATE_SIZE:
+        os.replace(log_file, f"{log_file}.1")
+    log = open(log_file, "ab")
+    log.write(f"$ {shlex.join(str(arg) for arg in args)}\n".encode())
+    log.flush()
+    return log
+
+
+def _read_pipe(pipe, buffer, log, log_lock):
+    with pipe:
+        for data in iter(lambda: pipe.read1(READ_SIZE), b""):
+            buffer.write(data)
+            if log:
+                with log_lock:
+                    log.write(data)
+                    log.flush()
+
+
+def _wait(proc, timeout, cancel):
+    """reap proc with its resource usage, stop it on timeout or cancel"""
+    deadline = time.monotonic() + timeout if timeout else None
+    stopped, kill_at = None, None
+    pidfd = _pidfd_open(proc.pid)
+    try:
+        while True:
+            pid, waitstatus, rusage = os.wait4(proc.pid, os.WNOHANG)
+            if pid:
+                proc.returncode = os.waitstatus_to_exitcode(waitstatus)
+                return proc.returncode, rusage, stopped
+            now = time.monotonic()
+            if stopped is None:
+                if cancel is not None and cancel.is_set():
+                    stopped = "cancel"
+                elif deadline is not None and now >= deadline:
+                    stopped = "timeout"
+                if stopped:
+                    _kill(proc, signal.SIGTERM)
+                    kill_at = now + KILL_GRACE
+            elif kill_at is not None and now >= kill_at:
+                _kill(proc, signal.SIGKILL)
+                kill_at = None
+            if pidfd is not None:
+                select.select([pidfd], [], [], POLL_INTERVAL)
+            else:
+                time.sleep(POLL_INTERVAL)
+    finally:
+        if pidfd is not None:
+            os.close(pidfd)
+
+
+def _pidfd_open(pid):
+    try:
+        return os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        return None
+
+
+def _kill(proc, sig):
+    try:
+        os.killpg(proc.pid, sig)
+    except ProcessLookupError:
+        pass
@@ -1,45 +1,59 @@
 import os
 import time
-import yaml
 import logging
-import shutil
 
-from openbrokerapi.service_broker import ProvisionDetails, OperationState, \
-    UpdateDetails, BindDetails
+from openbrokerapi.service_broker import OperationState
 
 from .celery import app
-from .utils import helm, format_params_to_helm_args, new_instance_lock, run_instance_hooks
+from .config import ROLLOUT_MODE, ROLLOUT_TIMEOUT, ROLLOUT_CHECK_INTERVAL, LOCK_TIMEOUT, \
+    LOCK_RETRY_INTERVAL
+from .kubernetes import get_kubernetes_client, KubernetesError
+from .lock import LockTimeout
+from .utils import helm, format_params_to_helm_args, new_instance_lock, run_instance_hooks, \
+    run_instance_post_hook, render_bind_template
 
 from .database.metadata import save_instance_meta, save_binding_meta, load_instance_meta, \
-    load_binding_meta
+    load_binding_meta, claim_pending_update, pop_pending_update, drop_pending_update, \
+    cancel_pending_update
 from .database.savepoint import save_addon_values, backup_instance
-from .database.query import get_plan_path, get_chart_path, get_cred_value, get_binding_file
+from .database.dependency import update_dependencies
+from .database.models import OperationDetails
+from .database.query import get_plan_path, get_chart_path, get_cred_values, get_binding_file, \
+    get_instance_file
 
 logger = logging.getLogger(__name__)
 
 
-@app.task(serializer='pickle')
-def provision(instance_id: str, details: ProvisionDetails):
+@app.task
+def provision(instance_id: str, details: dict):
+    details = OperationDetails.from_details(details)
+    # create instance.json
+    data = {
+        "id": instance_id, "last_operation": {},
+        "details": {
+            "service_id": details.service_id, "plan_id": details.plan_id,
+            "context": details.context,
+            "parameters": details.parameters if details.parameters else {},
+        },
+    }
     logger.debug(f"*** task provision instance: {instance_id}, before lock")
-    with (
-        new_instance_lock(instance_id),
-        run_instance_hooks(instance_id, "provision") as (status, output)
-    ):
+    try:
+        with new_instance_lock(instance_id):
+            _provision(instance_id, details, data)
+    except LockTimeout as e:
+        _retry_locked(provision, instance_id, e)
+
+
+def _provision(instance_id, details, data):
+    with run_instance_hooks(
+            instance_id, "provision", post=ROLLOUT_MODE != "poll") as (status, output):
         logger.debug(f"*** task provision instance: {instance_id}")
         backup_instance(instance_id)
-        # create instance.json
-        data = {
-            "id": instance_id, "last_operation": {},
-            "details": {
-                "service_id": details.service_id, "plan_id": details.plan_id,
-                "context": details.context,
-                "parameters": details.parameters if details.parameters else {},
-            },
-        }
         if status != 0:
             data["last_operation"]["state"] = OperationState.FAILED.value
             data["last_operation"]["description"] = f"provision {instance_id} error: {output}"
             save_instance_meta(instance_id, data)
+            _run_deferred_post_hook(instance_id, "provision")
             return
         data["last_operation"]["state"] = OperationState.IN_PROGRESS.value
         data["last_operation"]["operation"] = "provision"
@@ -50,20 +64,18 @@ def provision(instance_id: str, details: ProvisionDetails):
         bind_yaml = f'{chart_path}/templates/bind.yaml'
         if os.path.exists(bind_yaml):
             os.remove(bind_yaml)
-        if os.path.exists(f'{chart_path}/Chart.yaml'):
-            args = ["dependency", "update", chart_path]
-            helm(instance_id, *args)
+        update_dependencies(instance_id, chart_path)
         values_file = os.path.join(get_plan_path(instance_id), "values.yaml")
         args = [
             "install", details.context["instance_name"], chart_path,
             "--namespace", details.context["namespace"], "--create-namespace",
-            "--wait", "--timeout", "25m0s", "-f", values_file,
+            *_rollout_args(), "-f", values_file,
             "--set", f"fullnameOverride=helmbroker-{details.context['instance_name']}"
         ]
         addon_values_file = save_addon_values(details.service_id, instance_id)
         if addon_values_file:
-            args.insert(9, "-f")
-            args.insert(10, addon_values_file)
+            index = args.index("-f")
+            args[index:index] = ["-f", addon_values_file]
         logger.debug(f"helm install parameters: {details.parameters}")
         args = format_params_to_helm_args(instance_id, details.parameters, args)
         logger.debug(f"helm install args: {args}")
@@ -71,20 +83,73 @@ def provision(instance_id: str, details: ProvisionDetails):
         if status != 0:
             data["last_operation"]["state"] = OperationState.FAILED.value
             data["last_operation"]["description"] = f"provision {instance_id} error: {output}"
+        elif ROLLOUT_MODE == "poll":
+            data["last_operation"]["description"] = (
+                f"provision {instance_id} waiting for rollout at {time.time()}")
         else:
             data["last_operation"]["state"] = OperationState.SUCCEEDED.value
             data["last_operation"]["description"] = (
                 f"provision {instance_id} succeeded at {time.time()}")
         save_instance_meta(instance_id, data)
+        if status != 0:
+            _run_deferred_post_hook(instance_id, "provision")
+        elif ROLLOUT_MODE == "poll":
+            _schedule_check_rollout(instance_id, "provision", data)
+
 
+@app.task
+def update(instance_id: str, details: dict = None):
+    """
+    Upgrade the release with the pending update of the instance.
 
-@app.task(serializer='pickle')
-def update(instance_id: str, details: UpdateDetails):
+    The updates queued while a task waits are merged into its pending
+    update, so they are applied by one upgrade, and a deprovision cancels it.
+    A task which fails before taking its pending update drops it, so that the
+    next update queues a task rather than merging into an orphaned one, a task
+    which is retried for the lock keeps it, the retry has the same task id.
+    """
     logger.debug(f"*** task update instance: {instance_id}, before lock")
-    with (
-        new_instance_lock(instance_id),
-        run_instance_hooks(instance_id, "update") as (status, output)
-    ):
+    task_id, retried = update.request.id, False
+    try:
+        if task_id:
+            claim_pending_update(instance_id, task_id)
+        with new_instance_lock(instance_id):
+            if details is None:
+                details = pop_pending_update(instance_id)
+            if details is None:
+                logger.debug(f"*** task update instance: {instance_id}, no pending update")
+                _end_lost_update(instance_id)
+                return
+            _update(instance_id, OperationDetails.from_details(details))
+    except LockTimeout as e:
+        retried = True
+        if task_id:
+            claim_pending_update(instance_id, task_id, running=False)
+        _retry_locked(update, instance_id, e)
+    finally:
+        if task_id and not retried and drop_pending_update(instance_id, task_id):
+            logger.warning(f"*** task update instance: {instance_id}, pending update dropped")
+
+
+def _end_lost_update(instance_id):
+    """fail the update saved in progress by the api, its pending update has expired"""
+    if not os.path.exists(get_instance_file(instance_id)):
+        return
+    data = load_instance_meta(instance_id)
+    last_operation = data["last_operation"]
+    # a deprovision which cancelled the update has saved its own operation
+    if last_operation.get("state") != OperationState.IN_PROGRESS.value or \
+            not last_operation.get("description", "").startswith(
+                f"update {instance_id} in progress"):
+        return
+    last_operation["state"] = OperationState.FAILED.value
+    last_operation["description"] = f"update {instance_id} failed: the update was lost"
+    save_instance_meta(instance_id, data)
+
+
+def _update(instance_id, details):
+    with run_instance_hooks(
+            instance_id, "update", post=ROLLOUT_MODE != "poll") as (status, output):
         logger.debug(f"*** task update instance: {instance_id}")
         backup_instance(instance_id)
         data = load_instance_meta(instance_id)
@@ -103,19 +168,20 @@ def update(instance_id: str, details: UpdateDetails):
             data["last_operation"]["state"] = OperationState.FAILED.value
             data["last_operation"]["description"] = f"update {instance_id} failed: {output}"
             save_instance_meta(instance_id, data)
+            _run_deferred_post_hook(instance_id, "update")
             return
         chart_path = get_chart_path(instance_id)
         values_file = os.path.join(get_plan_path(instance_id), "values.yaml")
         args = [
             "upgrade", details.context["instance_name"], chart_path,
             "--namespace", details.context["namespace"], "--create-namespace",
-            "--wait", "--timeout", "25m0s", "--reset-then-reuse-values", "-f", values_file,
+            *_rollout_args(), "--reset-then-reuse-values", "-f", values_file,
             "--set", f"fullnameOverride=helmbroker-{details.context['instance_name']}"
         ]
         addon_values_file = save_addon_values(details.service_id, instance_id)
         if addon_values_file:
-            args.insert(10, "-f")
-            args.insert(11, addon_values_file)
+            index = args.index("-f")
+            args[index:index] = ["-f", addon_values_file]
         params = data['details']['parameters']
         logger.debug(f"helm upgrade parameters: {params}")
         args = format_params_to_helm_args(instance_id, params, args)
@@ -124,22 +190,112 @@ def update(instance_id: str, details: UpdateDetails):
         if status != 0:
             data["last_operation"]["state"] = OperationState.FAILED.value
             data["last_operation"]["description"] = f"update {time.time()} failed: {output}"
+        elif ROLLOUT_MODE == "poll":
+            data["last_operation"]["description"] = (
+                f"update {instance_id} waiting for rollout at {time.time()}")
         else:
             data["last_operation"]["state"] = OperationState.SUCCEEDED.value
             data["last_operation"]["description"] = (
                 f"update {instance_id} succeeded at {time.time()}")
         save_instance_meta(instance_id, data)
+        if status != 0:
+            _run_deferred_post_hook(instance_id, "update")
+        elif ROLLOUT_MODE == "poll":
+            _schedule_check_rollout(instance_id, "update", data)
 
 
-@app.task(serializer='pickle')
+@app.task
+def check_rollout(instance_id: str, operation: str, modified_time: float, deadline: float):
+    """
+    Check the readiness of a release applied by provision or update.
+
+    The check is rescheduled until the release is ready or the deadline is
+    passed, then the post hook of the operation runs. It stops when the
+    instance has been saved by another operation.
+    """
+    lock = new_instance_lock(instance_id)
+    if not lock.acquire(blocking=False):
+        check_rollout.apply_async(
+            (instance_id, operation, modified_time, deadline), countdown=ROLLOUT_CHECK_INTERVAL)
+        return
+    try:
+        if not os.path.exists(get_instance_file(instance_id)):
+            return
+        data = load_instance_meta(instance_id)
+        if data.get("last_modified_time") != modified_time:
+            logger.debug(f"check rollout of {instance_id} superseded")
+            return
+        context = data["details"]["context"]
+        status, output = helm(
+            instance_id, "get", "manifest", context["instance_name"],
+            "--namespace", context["namespace"])
+        if status == 0:
+            ready, message = get_kubernetes_client().check_ready(output, context["namespace"])
+        else:
+            ready, message = False, output
+        if ready:
+            data["last_operation"]["state"] = OperationState.SUCCEEDED.value
+            data["last_operation"]["description"] = (
+                f"{operation} {instance_id} succeeded at {time.time()}")
+        elif time.time() >= deadline:
+            data["last_operation"]["state"] = OperationState.FAILED.value
+            data["last_operation"]["description"] = (
+                f"{operation} {instance_id} failed: timed out {message}")
+        else:
+            check_rollout.apply_async(
+                (instance_id, operation, modified_time, deadline),
+                countdown=ROLLOUT_CHECK_INTERVAL)
+            return
+        save_instance_meta(instance_id, data)
+        run_instance_post_hook(instance_id, operation)
+    except KubernetesError as e:
+        data["last_operation"]["state"] = OperationState.FAILED.value
+        data["last_operation"]["description"] = f"{operation} {instance_id} failed: {e}"
+        save_instance_meta(instance_id, data)
+        run_instance_post_hook(instance_id, operation)
+    finally:
+        lock.release()
+
+
+def _retry_locked(task, instance_id, e):
+    """
+    Queue the task again, another operation holds the instance, which may run
+    a `helm --wait` longer than LOCK_TIMEOUT. The instance is left as it is.
+    """
+    operation = task.name.rsplit(".", 1)[-1]
+    logger.warning(f"*** task {operation} instance: {instance_id}, {e}, retry")
+    raise task.retry(countdown=LOCK_RETRY_INTERVAL, max_retries=None)
+
+
+def _rollout_args():
+    if ROLLOUT_MODE == "poll":
+        return ["--timeout", f"{ROLLOUT_TIMEOUT}s"]
+    return ["--wait", "--timeout", f"{ROLLOUT_TIMEOUT}s"]
+
+
+def _run_deferred_post_hook(instance_id, operation):
+    """a polled rollout runs its post hook once it ends, here when it failed to start"""
+    if ROLLOUT_MODE == "poll":
+        run_instance_post_hook(instance_id, operation)
+
+
+def _schedule_check_rollout(instance_id, operation, data):
+    check_rollout.apply_async(
+        (instance_id, operation, data["last_modified_time"], time.time() + ROLLOUT_TIMEOUT),
+        countdown=ROLLOUT_CHECK_INTERVAL)
+
+
+@app.task
 def bind(instance_id: str,
          binding_id: str,
-         details: BindDetails,
+         details: dict,
          async_allowed: bool,
+         lock_timeout: float = LOCK_TIMEOUT,
          **kwargs):
+    details = OperationDetails.from_details(details)
     logger.debug(f"*** task bind instance: {instance_id}, before lock")
     with (
-        new_instance_lock(instance_id),
+        new_instance_lock(instance_id, timeout=lock_timeout),
         run_instance_hooks(instance_id, "bind") as (status, output)
     ):
         logger.debug(f"*** task bind instance: {instance_id}")
@@ -153,10 +309,8 @@ def bind(instance_id: str,
         save_binding_meta(instance_id, data)
         chart_path, plan_path = (
             get_chart_path(instance_id), get_plan_path(instance_id))
-        shutil.copy(f'{plan_path}/bind.yaml', f'{chart_path}/templates')
-        values_file = os.path.join(get_plan_path(instance_id), "values.yaml")
+        values_file = os.path.join(plan_path, "values.yaml")
         args = [
-            "template", details.context["instance_name"], chart_path,
             "-f", values_file,
             "--set", f"fullnameOverride=helmbroker-{details.context['instance_name']}",
             "--namespace", details.context["namespace"],
@@ -166,20 +320,24 @@ def bind(instance_id: str,
         logger.debug(f"helm template parameters: {params}")
         args = format_params_to_helm_args(instance_id, params, args)
         logger.debug(f"helm template args: {args}")
-        status, templates = helm(instance_id, *args)  # output: templates.yaml
+        status, credential_template = render_bind_template(
+            instance_id, details.context["instance_name"], chart_path,
+            f'{plan_path}/bind.yaml', args)
         if status != 0:
             data["last_operation"]["state"] = OperationState.FAILED.value
-            data["last_operation"]["description"] = f"binding {instance_id} failed: {templates}"
-        credential_template = {}
-        templates = yaml.load_all(templates, Loader=yaml.SafeLoader)
-        credential_template = next(
-            (item for item in templates if isinstance(item, dict) and "credential" in item), {}
-        )
+            data["last_operation"]["description"] = (
+                f"binding {instance_id} failed: {credential_template}")
+            credential_template = {}
         success_flag = True
         errors = []
-        for _ in credential_template.get('credential', {}):
+        credentials = credential_template.get('credential', {})
+        cred_values = iter(get_cred_values(
+            details.context["namespace"],
+            [_['valueFrom'] for _ in credentials if _.get('valueFrom')],
+        ))
+        for _ in credentials:
             if _.get('valueFrom'):
-                status, val = get_cred_value(details.context["namespace"], _['valueFrom'])
+                status, val = next(cred_values)
             elif _.get('value'):
                 status, val = 0,  _['value']
             else:
@@ -197,19 +355,21 @@ def bind(instance_id: str,
             data['last_operation']['state'] = OperationState.FAILED.value
             data['last_operation']['description'] = (
                 f"binding {instance_id} failed: {','.join(errors)}")
-        bind_yaml = f'{chart_path}/templates/bind.yaml'
-        if os.path.exists(bind_yaml):
-            os.remove(bind_yaml)
         save_binding_meta(instance_id, data)
 
 
-@app.task(serializer='pickle')
+@app.task
 def unbind(instance_id):
     logger.debug(f"*** task unbind instance: {instance_id}, before lock")
-    with (
-        new_instance_lock(instance_id),
-        run_instance_hooks(instance_id, "unbind") as (status, output)
-    ):
+    try:
+        with new_instance_lock(instance_id):
+            _unbind(instance_id)
+    except LockTimeout as e:
+        _retry_locked(unbind, instance_id, e)
+
+
+def _unbind(instance_id):
+    with run_instance_hooks(instance_id, "unbind") as (status, output):
         logger.debug(f"*** task unbind instance: {instance_id}")
         backup_instance(instance_id)
         data = load_binding_meta(instance_id)
@@ -226,14 +386,21 @@ def unbind(instance_id):
         save_binding_meta(instance_id, data)
 
 
-@app.task(serializer='pickle')
+@app.task
 def deprovision(instance_id: str):
     logger.debug(f"*** task deprovision instance: {instance_id}, before lock")
-    with (
-        new_instance_lock(instance_id),
-        run_instance_hooks(instance_id, "deprovision") as (status, output)
-    ):
+    try:
+        with new_instance_lock(instance_id):
+            _deprovision(instance_id)
+    except LockTimeout as e:
+        _retry_locked(deprovision, instance_id, e)
+
+
+def _deprovision(instance_id):
+    with run_instance_hooks(instance_id, "deprovision") as (status, output):
         logger.debug(f"*** task deprovision instance: {instance_id}")
+        if cancel_pending_update(instance_id):
+            logger.info(f"*** task deprovision instance: {instance_id}, update cancelled")
         backup_instance(instance_id)
         data = load_instance_meta(instance_id)
         if status != 0:
@@ -1,32 +1,53 @@
 import os
+import re
+import time
 import yaml
 import json
-import subprocess
 import base64
 import copy
+import shutil
+import hashlib
 import logging
+import tempfile
+import threading
 from urllib.parse import urlparse, parse_qs
 from contextlib import contextmanager
+from queue import LifoQueue, Empty
 from redis.client import Redis
-from redis.sentinel import Sentinel
-from .config import VALKEY_URL
+from redis.connection import BlockingConnectionPool
+from redis.sentinel import Sentinel, SentinelConnectionPool
+from .config import VALKEY_URL, VALKEY_MAX_CONNECTIONS, VALKEY_POOL_TIMEOUT, LOCK_TIMEOUT
+from .process import run
 
 logger = logging.getLogger(__name__)
 REGISTRY_CONFIG_SUFFIX = '.config/helm/registry.json'
 REPOSITORY_CACHE_SUFFIX = '.cache/helm/repository'
 REPOSITORY_CONFIG_SUFFIX = '.config/helm/repository'
+HELM_LOG_SUFFIX = 'logs/helm.log'
+# helm commands whose output holds the secrets of a release are not logged at all
+HELM_UNLOGGED_COMMANDS = (("get", "manifest"), ("template", ))
+# the options whose values may be credentials, they are masked in the log
+HELM_SECRET_OPTIONS = ("--set", "--set-string", "--set-json", "--set-file", "--set-literal")
+BIND_TEMPLATE = 'templates/bind.yaml'
+HELM_DEFINE_RE = re.compile(rb"\{\{-?\s*define\s")
 
 
-def command(cmd, *args, output_type="text"):
-    status, output = subprocess.getstatusoutput("%s %s" % (cmd, " ".join(args)))
+def command(cmd, *args, output_type="text", **kwargs):
+    """
+    Run cmd with args, the keyword arguments are passed to `process.run`.
+
+    Return (status, output) for text, otherwise the parsed stdout.
+    """
+    result = run([cmd, *args], **kwargs)
     if output_type == "yaml":
-        return yaml.load(output, Loader=yaml.Loader)
+        return yaml.load(result.stdout, Loader=yaml.Loader)
     elif output_type == "json":
-        return json.loads(output)
-    return status, output
+        return json.loads(result.stdout)
+    output = result.output
+    return result.status, output[:-1] if output.endswith("\n") else output
 
 
-def helm(instance_id, *args, output_type="text"):
+def helm(instance_id, *args, output_type="text", repository_cache=None, **kwargs):
     from .database.query import get_instance_path
     instance_path = get_instance_path(instance_id)
     new_args = []
@@ -35,14 +56,151 @@ def helm(instance_id, *args, output_type="text"):
         "--registry-config",
         os.path.join(instance_path, REGISTRY_CONFIG_SUFFIX),
         "--repository-cache",
-        os.path.join(instance_path, REPOSITORY_CACHE_SUFFIX),
+        repository_cache or os.path.join(instance_path, REPOSITORY_CACHE_SUFFIX),
         "--repository-config",
         os.path.join(instance_path, REPOSITORY_CONFIG_SUFFIX),
     ])
-    return command("helm", *new_args, output_type=output_type)
+    if not any(args[:len(cmd)] == cmd for cmd in HELM_UNLOGGED_COMMANDS):
+        # only stderr is logged, stdout may hold rendered values
+        kwargs.setdefault("log_file", os.path.join(instance_path, HELM_LOG_SUFFIX))
+        kwargs.setdefault("log_stdout", False)
+        kwargs.setdefault("log_args", ["helm", *_mask_helm_args(new_args)])
+    return command("helm", *new_args, output_type=output_type, **kwargs)
+
+
+def _mask_helm_args(args):
+    """mask the values given by HELM_SECRET_OPTIONS, the keys are kept"""
+    masked = []
+    for index, arg in enumerate(args):
+        if index > 0 and args[index - 1] in HELM_SECRET_OPTIONS:
+            arg = ",".join(f"{item.split('=', 1)[0]}=***" for item in str(arg).split(","))
+        elif any(str(arg).startswith(f"{option}=") for option in HELM_SECRET_OPTIONS):
+            option, value = str(arg).split("=", 1)
+            arg = f"{option}={_mask_helm_args([option, value])[1]}"
+        masked.append(arg)
+    return masked
+
+
+def render_bind_template(instance_id, name, chart_path, bind_file, args):
+    """
+    Render bind_file as a template of the chart, return (status, credential template).
+
+    The template is rendered in an overlay of the chart that holds none of
+    its other templates, so only the helpers and the bind template are
+    rendered and the chart itself is left untouched. The result is cached
+    per instance by the digest of the chart, the template and the args.
+    """
+    from .database.query import get_instance_path
+    from .database.metadata import load_instance_render, save_instance_render
+    digest = _render_digest(chart_path, bind_file, name, args)
+    template = load_instance_render(instance_id, digest)
+    if template is not None:
+        return 0, template
+    with tempfile.TemporaryDirectory(
+            prefix=".render-", dir=get_instance_path(instance_id)) as temp:
+        overlay_path = os.path.join(temp, os.path.basename(chart_path))
+        _bind_chart_overlay(chart_path, bind_file, overlay_path)
+        status, output = helm(
+            instance_id, "template", name, overlay_path,
+            "--show-only", BIND_TEMPLATE, *args)
+    if status != 0:
+        return status, output
+    template = next((
+        item for item in yaml.load_all(output, Loader=yaml.SafeLoader)
+        if isinstance(item, dict) and "credential" in item
+    ), {})
+    save_instance_render(instance_id, digest, template)
+    return status, template
+
+
+class _StatsLifoQueue(LifoQueue):
+    """the free connections of a pool, counting the gets and the time spent waiting"""
+
+    def __init__(self, maxsize=0):
+        super().__init__(maxsize)
+        self.stats_lock = threading.Lock()
+        self.acquired = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+
+    def get(self, block=True, timeout=None):
+        start = time.monotonic()
+        try:
+            item = super().get(block, timeout)
+        except Empty:
+            with self.stats_lock:
+                self.timeouts += 1
+                self.wait_time += time.monotonic() - start
+            raise
+        with self.stats_lock:
+            self.acquired += 1
+            self.wait_time += time.monotonic() - start
+        return item
+
+
+class _ConnectionPool(BlockingConnectionPool):
+    """
+    A pool of at most max_connections, a command waits timeout seconds for a
+    free connection, then fails with a ConnectionError.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault("queue_class", _StatsLifoQueue)
+        super().__init__(**kwargs)
+
+
+class _SentinelConnectionPool(SentinelConnectionPool, _ConnectionPool):
+    pass
+
+
+_valkey_client = (None, None)  # (pid, client)
+_valkey_client_lock = threading.Lock()
 
 
 def get_valkey_client():
+    """
+    Return the valkey client of the current process.
+
+    The client and its connection pool are created once per process, a forked
+    process creates its own. With sentinel the master address is discovered
+    when a connection is made and discovered again after a failover.
+    """
+    global _valkey_client
+    pid, client = _valkey_client
+    if pid == os.getpid():
+        return client
+    with _valkey_client_lock:
+        pid, client = _valkey_client
+        if pid != os.getpid():
+            client = _new_valkey_client()
+            _valkey_client = (os.getpid(), client)
+    return client
+
+
+def get_valkey_pool_stats():
+    """
+    Return the connection counters of the pool of the current process.
+
+    wait_time is the seconds spent waiting for a free connection, without the
+    time to connect, timeouts counts the waits which gave up.
+    """
+    pool = get_valkey_client().connection_pool
+    queue = pool.pool
+    with queue.stats_lock:
+        acquired, timeouts, wait_time = queue.acquired, queue.timeouts, queue.wait_time
+    created, in_use = len(pool._connections), pool.max_connections - queue.qsize()
+    return {
+        "pid": os.getpid(),
+        "created": created,
+        "in_use": in_use,
+        "available": max(created - in_use, 0),
+        "acquired": acquired,
+        "timeouts": timeouts,
+        "wait_time": wait_time,
+    }
+
+
+def _new_valkey_client():
     url = urlparse(VALKEY_URL)
     query = parse_qs(url.query)
     if 'master_set' in query:
@@ -53,16 +211,30 @@ def get_valkey_client():
             sentinel_kwargs={'password': password},
             password=password,
         )
-        return sentinel.master_for(query['master_set'][0], socket_timeout=1)
-    return Redis.from_url(VALKEY_URL)
+        return sentinel.master_for(
+            query['master_set'][0], socket_timeout=1,
+            connection_pool_class=_SentinelConnectionPool,
+            max_connections=VALKEY_MAX_CONNECTIONS, timeout=VALKEY_POOL_TIMEOUT,
+        )
+    return Redis(connection_pool=_ConnectionPool.from_url(
+        VALKEY_URL, max_connections=VALKEY_MAX_CONNECTIONS, timeout=VALKEY_POOL_TIMEOUT))
 
 
-def new_instance_lock(instance_id):
-    return get_valkey_client().lock(instance_id)
+def new_instance_lock(instance_id, timeout=LOCK_TIMEOUT):
+    """return the lease lock of an instance, see `lock.InstanceLock`"""
+    from .lock import InstanceLock
+    return InstanceLock(instance_id, timeout=timeout)
 
 
 @contextmanager
-def run_instance_hooks(instance_id, stage):
+def run_instance_hooks(instance_id, stage, post=True):
+    """
+    Run the pre hook of stage before the block and its post hook after it.
+
+    With post False the post hook is left to `run_instance_post_hook`, for the
+    operations which end after the block, like a polled rollout, unless the
+    block raises.
+    """
     if stage not in ["provision", "bind", "unbind", "update", "deprovision"]:
         raise ValueError(f"Unknown stage {stage}")
     from .database.query import get_hooks_path
@@ -73,22 +245,54 @@ def run_instance_hooks(instance_id, stage):
     result = []
     try:
         if os.path.exists(pre_script_file):
-            status, output = subprocess.getstatusoutput(pre_script_file)
-            result.append({"script": pre_script_file, "status": status, "output": output})
+            hook_result = _run_hook(instance_id, pre_script_file)
+            status, output = hook_result["status"], hook_result["output"]
+            result.append(hook_result)
         else:
             status, output = 0, f"skip running {pre_script_file}"
             logger.debug(output)
         yield status, output
+    except BaseException:
+        post = True
+        raise
     finally:
-        if os.path.exists(pre_script_file):
-            status, output = subprocess.getstatusoutput(post_script_file)
-            result.append({"script": pre_script_file, "status": status, "output": output})
+        if not post:
+            logger.debug(f"defer running {post_script_file}")
+        elif os.path.exists(post_script_file):
+            result.append(_run_hook(instance_id, post_script_file))
         else:
             logger.debug(f"skip running {post_script_file}")
         save_hooks_result(instance_id, result)
     logger.debug(f"instance hook completed: {instance_id}, {instance_id}")
 
 
+def run_instance_post_hook(instance_id, stage):
+    """run the deferred post hook of stage, its result is added to those of the pre hook"""
+    from .database.query import get_hooks_path
+    from .database.savepoint import load_hooks_result, save_hooks_result
+    post_script_file = os.path.join(get_hooks_path(instance_id), f"post_{stage}.sh")
+    if not os.path.exists(post_script_file):
+        logger.debug(f"skip running {post_script_file}")
+        return
+    result = load_hooks_result(instance_id)
+    result.append(_run_hook(instance_id, post_script_file))
+    save_hooks_result(instance_id, result)
+
+
+def _run_hook(instance_id, script_file):
+    """run a hook script by its shebang, with sh when it is not executable"""
+    result = run([script_file] if os.access(script_file, os.X_OK) else ["sh", script_file])
+    output = result.output
+    logger.info(
+        f"instance hook {script_file} of {instance_id} exited {result.status} "
+        f"in {result.wall_time:.3f}s, cpu {result.cpu_time:.3f}s")
+    return {
+        "script": script_file, "status": result.status,
+        "output": output[:-1] if output.endswith("\n") else output,
+        "wall_time": round(result.wall_time, 3), "cpu_time": round(result.cpu_time, 3),
+    }
+
+
 def verify_parameters(allow_parameters, parameters):
     """verify parameters allowed or not"""
     def merge_parameters(parameters):
@@ -125,6 +329,54 @@ def format_params_to_helm_args(instance_id, parameters, args):
     return args
 
 
+def _render_digest(chart_path, bind_file, name, args):
+    """the chart files are identified by their size and mtime, values files by content"""
+    sha256 = hashlib.sha256()
+    for root, dirs, files in os.walk(chart_path):
+        dirs.sort()
+        for file in sorted(files):
+            path = os.path.join(root, file)
+            file_stat = os.stat(path)
+            sha256.update(
+                f"{os.path.relpath(path, chart_path)}\0{file_stat.st_size}\0"
+                f"{file_stat.st_mtime_ns}\n".encode())
+    values_files = [args[index + 1] for index, arg in enumerate(args[:-1]) if arg == "-f"]
+    for file in (bind_file, *values_files):
+        with open(file, "rb") as f:
+            sha256.update(hashlib.sha256(f.read()).digest())
+    sha256.update(json.dumps([name, *args]).encode())
+    return sha256.hexdigest()
+
+
+def _bind_chart_overlay(chart_path, bind_file, overlay_path):
+    """
+    Fill overlay_path with the chart, keeping only the templates which may
+    hold helpers: partials, `.tpl` files and those with a define block.
+    """
+    from .database.archive import link_file
+    templates_path = os.path.join(chart_path, "templates")
+
+    def ignore(path, names):
+        if path != templates_path and not path.startswith(templates_path + os.sep):
+            return []
+        return [
+            name for name in names
+            if not os.path.isdir(os.path.join(path, name))
+            and not _is_helpers_template(os.path.join(path, name))
+        ]
+    shutil.copytree(chart_path, overlay_path, ignore=ignore, copy_function=link_file)
+    os.makedirs(os.path.join(overlay_path, "templates"), exist_ok=True)
+    link_file(bind_file, os.path.join(overlay_path, BIND_TEMPLATE))
+
+
+def _is_helpers_template(file):
+    name = os.path.basename(file)
+    if name.startswith("_") or name.endswith(".tpl"):
+        return True
+    with open(file, "rb") as f:
+        return HELM_DEFINE_RE.search(f.read()) is not None
+
+
 def _raw_values_format_keys(raw_values, prefix=''):
     """
     {'a': {'b': 1, 'c': {'d': 2, 'e': 3}}, 'f': 4}
@@ -0,0 +1,5 @@
+import os
+
+# broker credentials are read by helmbroker.config at import time
+os.environ.setdefault("HELMBROKER_USERNAME", "admin")
+os.environ.setdefault("HELMBROKER_PASSWORD", "admin")
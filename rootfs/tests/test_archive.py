@@ -0,0 +1,94 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import requests_mock
+
+from helmbroker.database import archive
+from tests.test_fetch import make_addon_archive
+
+ARCHIVE_URL = "https://charts.example.com/addons/mysql-8.0.tgz"
+
+
+class TestArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp.cleanup)
+        patcher = mock.patch.object(archive, "ARCHIVES_CACHE_PATH", self.temp.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_open_addon_archive(self):
+        with requests_mock.Mocker() as mocker:
+            mocker.get(ARCHIVE_URL, content=make_addon_archive("mysql", "8.0"))
+            with archive.open_addon_archive(ARCHIVE_URL, "digest") as path:
+                self.assertTrue(os.path.exists(f"{path}/chart/mysql/Chart.yaml"))
+                self.assertTrue(os.path.exists(f"{path}/meta.json"))
+            with archive.open_addon_archive(ARCHIVE_URL, "digest") as cached_path:
+                self.assertEqual(cached_path, path)
+            self.assertEqual(mocker.call_count, 1)
+            with archive.open_addon_archive(ARCHIVE_URL, "new-digest") as new_path:
+                self.assertNotEqual(new_path, path)
+            self.assertEqual(mocker.call_count, 2)
+        dest = os.path.join(self.temp.name, "instance", "plan")
+        archive.copy_archive_tree(os.path.join(path, "plans", "standard"), dest)
+        with open(os.path.join(dest, "values.yaml")) as f:
+            self.assertEqual(f.read(), "replicas: 1\n")
+
+    def test_evict_addon_archives(self):
+        paths = []
+        with requests_mock.Mocker() as mocker:
+            mocker.get(ARCHIVE_URL, content=make_addon_archive("mysql", "8.0"))
+            for digest in ("a", "b", "c"):
+                with archive.open_addon_archive(ARCHIVE_URL, digest) as path:
+                    paths.append(path)
+                    os.utime(os.path.join(path, archive.ARCHIVE_INDEX_FILE), (len(paths), ) * 2)
+        with mock.patch.object(archive, "ARCHIVES_CACHE_SIZE", 1):
+            with archive.lock_cache_entry(paths[1]) as found:
+                self.assertTrue(found)
+                # an entry being read is kept
+                archive.evict_addon_archives(keep=paths[0])
+                self.assertEqual(
+                    [os.path.exists(path) for path in paths], [True, True, False])
+            archive.evict_addon_archives(keep=paths[0])
+        self.assertEqual([os.path.exists(path) for path in paths], [True, False, False])
+        self.assertEqual(len(os.listdir(self.temp.name)), 1)
+        with archive.lock_cache_entry(paths[1]) as found:
+            self.assertFalse(found)
+
+    def test_no_digest(self):
+        with requests_mock.Mocker() as mocker:
+            mocker.get(ARCHIVE_URL, content=make_addon_archive("mysql", "8.0"))
+            for _ in range(2):
+                with archive.open_addon_archive(ARCHIVE_URL, None) as path:
+                    self.assertTrue(os.path.exists(f"{path}/plans/standard/meta.yaml"))
+            self.assertEqual(mocker.call_count, 2)
+        self.assertEqual(os.listdir(self.temp.name), [])
+
+    def test_hardlink(self):
+        src = os.path.join(self.temp.name, "src")
+        os.makedirs(src)
+        for name in ("Chart.yaml", "Chart.lock"):
+            with open(os.path.join(src, name), "w") as f:
+                f.write(name)
+        with mock.patch.object(archive, "ARCHIVES_CACHE_LINK", "hardlink"):
+            archive.save_cache_entry(src, os.path.join(self.temp.name, "entry"), {})
+            dst = os.path.join(self.temp.name, "dst")
+            archive.copy_archive_tree(os.path.join(self.temp.name, "entry"), dst)
+        self.assertEqual(os.stat(os.path.join(dst, "Chart.yaml")).st_nlink, 2)
+        lock_file = os.path.join(dst, "Chart.lock")
+        self.assertEqual(os.stat(lock_file).st_nlink, 1)
+        self.assertTrue(os.stat(lock_file).st_mode & 0o200)
+
+    def test_cache_disabled(self):
+        with (
+            requests_mock.Mocker() as mocker,
+            mock.patch.object(archive, "ARCHIVES_CACHE_SIZE", 0),
+        ):
+            mocker.get(ARCHIVE_URL, content=make_addon_archive("mysql", "8.0"))
+            with archive.open_addon_archive(ARCHIVE_URL) as path:
+                self.assertTrue(os.path.exists(f"{path}/plans/standard/meta.yaml"))
+            self.assertFalse(os.path.exists(path))
+            self.assertEqual(os.listdir(self.temp.name), [])
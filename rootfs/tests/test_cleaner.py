@@ -0,0 +1,59 @@
+import os
+import json
+import tempfile
+import unittest
+from unittest import mock
+
+import fakeredis
+
+from helmbroker import cleaner
+from helmbroker.database import metadata, query
+
+
+class TestCleaner(unittest.TestCase):
+
+    def setUp(self):
+        self.valkey = fakeredis.FakeRedis()
+        self.instances_path = tempfile.TemporaryDirectory()
+        self.addCleanup(self.instances_path.cleanup)
+        for patcher in [
+            mock.patch.object(cleaner, "get_valkey_client", return_value=self.valkey),
+            mock.patch.object(metadata, "get_valkey_client", return_value=self.valkey),
+            mock.patch.object(query, "get_valkey_client", return_value=self.valkey),
+            mock.patch.object(cleaner, "INSTANCES_PATH", self.instances_path.name),
+            mock.patch.object(query, "INSTANCES_PATH", self.instances_path.name),
+            mock.patch.object(cleaner, "BATCH_SIZE", 2),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def create_instance(self, instance_id, operation, modified_time):
+        os.makedirs(query.get_instance_path(instance_id))
+        with open(query.get_instance_file(instance_id), "w") as f:
+            json.dump({
+                "id": instance_id,
+                "details": {"service_id": "s", "plan_id": "p", "context": {}},
+                "last_operation": {"state": "succeeded", "operation": operation},
+                "last_modified_time": modified_time,
+            }, f)
+
+    def test_clean_instance(self):
+        self.create_instance("a", "deprovision", 0)
+        self.create_instance("b", "provision", 0)
+        self.create_instance("c", "deprovision", 0)
+        os.makedirs(query.get_instance_path("d"))
+        stats = cleaner.clean_instance()
+        self.assertEqual(sorted(os.listdir(self.instances_path.name)), ["b"])
+        self.assertEqual(
+            (stats["examined"], stats["deleted"], stats["skipped"]), (4, 3, 1))
+        self.assertIsNone(self.valkey.get(cleaner.CHECKPOINT_KEY))
+        # the kept instances are indexed
+        self.assertEqual(query.get_instance_ids(operation="provision"), ["b"])
+
+    def test_clean_instance_resume(self):
+        self.create_instance("a", "deprovision", 0)
+        self.create_instance("b", "deprovision", 0)
+        self.valkey.set(cleaner.CHECKPOINT_KEY, "a")
+        stats = cleaner.clean_instance()
+        self.assertEqual(os.listdir(self.instances_path.name), ["a"])
+        self.assertEqual(stats["examined"], 1)
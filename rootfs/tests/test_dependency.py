@@ -0,0 +1,60 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import yaml
+
+from helmbroker.database import dependency
+
+DEPENDENCIES = [{"name": "common", "version": "2.x.x", "repository": "oci://registry/charts"}]
+
+
+class TestDependency(unittest.TestCase):
+
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp.cleanup)
+        for name in ("DEPENDENCIES_CACHE_PATH", "REPOSITORY_CACHE_PATH", "LOCKS_PATH"):
+            patcher = mock.patch.object(dependency, name, os.path.join(self.temp.name, name))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(dependency, "helm", side_effect=self.helm)
+        self.helm = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def helm(self, instance_id, *args, **kwargs):
+        chart_path = args[2]
+        os.makedirs(os.path.join(chart_path, "charts"), exist_ok=True)
+        with open(os.path.join(chart_path, "charts", "common-2.0.0.tgz"), "w") as f:
+            f.write("common")
+        with open(os.path.join(chart_path, "Chart.lock"), "w") as f:
+            yaml.dump({"dependencies": DEPENDENCIES}, f)
+        return 0, "updated"
+
+    def make_chart(self, name, dependencies):
+        chart_path = os.path.join(self.temp.name, name, "chart")
+        os.makedirs(chart_path)
+        with open(os.path.join(chart_path, "Chart.yaml"), "w") as f:
+            yaml.dump({"name": "mysql", "dependencies": dependencies}, f)
+        return chart_path
+
+    def test_update_dependencies(self):
+        chart_path = self.make_chart("instance-1", DEPENDENCIES)
+        self.assertEqual(dependency.update_dependencies("instance-1", chart_path), (0, "updated"))
+        chart_path = self.make_chart("instance-2", DEPENDENCIES)
+        status, _ = dependency.update_dependencies("instance-2", chart_path)
+        self.assertEqual(status, 0)
+        self.assertEqual(self.helm.call_count, 1)
+        with open(os.path.join(chart_path, "charts", "common-2.0.0.tgz")) as f:
+            self.assertEqual(f.read(), "common")
+        self.assertTrue(os.path.exists(os.path.join(chart_path, "Chart.lock")))
+
+    def test_update_dependencies_not_shared(self):
+        local = [{"name": "common", "version": "2.0.0", "repository": "file://../common"}]
+        self.assertIsNone(dependency.get_dependencies_digest(self.make_chart("local", local)))
+        self.assertIsNone(dependency.get_dependencies_digest(self.make_chart("none", None)))
+        for name in ("instance-1", "instance-2"):
+            dependency.update_dependencies(name, self.make_chart(name, local))
+        self.assertEqual(self.helm.call_count, 2)
+        self.assertFalse(os.path.exists(dependency.DEPENDENCIES_CACHE_PATH))
@@ -0,0 +1,118 @@
+import io
+import os
+import tarfile
+import tempfile
+import unittest
+
+import yaml
+import requests_mock
+
+from helmbroker.database import fetch
+
+REPOSITORY_URL = "https://charts.example.com/addons/index.yaml"
+
+
+def make_addon_archive(name, version, plans=("standard", )):
+    files = {
+        "meta.yaml": yaml.dump({
+            "id": f"{name}-{version}-id", "name": name, "version": version,
+            "displayName": f"{name}-{version}", "description": name,
+            "bindable": True, "tags": "db, cache",
+        }),
+        f"chart/{name}/Chart.yaml": yaml.dump({"name": name, "version": version}),
+    }
+    for plan in plans:
+        files[f"plans/{plan}/meta.yaml"] = yaml.dump(
+            {"id": f"{plan}-id", "name": plan, "description": plan})
+        files[f"plans/{plan}/values.yaml"] = "replicas: 1\n"
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode="w:gz") as tar:
+        for filename, content in files.items():
+            content = content.encode()
+            tarinfo = tarfile.TarInfo(filename)
+            tarinfo.size = len(content)
+            tar.addfile(tarinfo, io.BytesIO(content))
+    return data.getvalue()
+
+
+def mock_repository(mocker, url, addons, headers=None):
+    entries = {}
+    for name, version in addons:
+        entries.setdefault(name, []).append(
+            {"version": version, "digest": f"{name}-{version}-digest"})
+        mocker.get(
+            f"{url.rsplit('/', 1)[0]}/{name}-{version}.tgz",
+            content=make_addon_archive(name, version))
+    mocker.get(
+        url, text=yaml.dump({"entries": entries}, sort_keys=False), headers=headers or {})
+
+
+class TestFetch(unittest.TestCase):
+
+    def test_fetch_addons(self):
+        addons = [("redis", "7.0"), ("mysql", "8.0"), ("mysql", "8.4"), ("kafka", "3.7")]
+        with requests_mock.Mocker() as mocker:
+            mock_repository(mocker, REPOSITORY_URL, addons)
+            addons_meta = fetch.fetch_addons({"name": "test", "url": REPOSITORY_URL})
+        # the order of index.yaml is kept whatever the download order is
+        self.assertEqual(
+            list(addons_meta.keys()), ["redis-7.0", "mysql-8.0", "mysql-8.4", "kafka-3.7"])
+        mysql = addons_meta["mysql-8.4"]
+        self.assertEqual(mysql["url"], "https://charts.example.com/addons/mysql-8.4.tgz")
+        self.assertEqual(mysql["tags"], ["db", "cache"])
+        self.assertEqual([plan["id"] for plan in mysql["plans"]], ["standard-id"])
+
+    def test_fetch_addons_error(self):
+        with requests_mock.Mocker() as mocker:
+            mock_repository(mocker, REPOSITORY_URL, [("redis", "7.0")])
+            mocker.get("https://charts.example.com/addons/redis-7.0.tgz", status_code=404)
+            with self.assertRaises(Exception):
+                fetch.fetch_addons({"name": "test", "url": REPOSITORY_URL})
+
+    def test_fetch_addons_incremental(self):
+        manifest, repository = {}, {"name": "test", "url": REPOSITORY_URL}
+        with requests_mock.Mocker() as mocker:
+            mock_repository(
+                mocker, REPOSITORY_URL, [("redis", "7.0"), ("mysql", "8.0")],
+                headers={"ETag": '"v1"'})
+            addons_meta = fetch.fetch_addons(repository, manifest=manifest)
+            self.assertEqual(mocker.call_count, 3)
+        self.assertEqual(manifest["etag"], '"v1"')
+        self.assertEqual(list(manifest["charts"].keys()), ["redis-7.0", "mysql-8.0"])
+        # only the new chart is downloaded
+        with requests_mock.Mocker() as mocker:
+            mock_repository(
+                mocker, REPOSITORY_URL, [("redis", "7.0"), ("mysql", "8.0"), ("mysql", "8.4")],
+                headers={"ETag": '"v2"'})
+            new_addons_meta = fetch.fetch_addons(repository, manifest=manifest)
+            self.assertEqual(mocker.last_request.url, f"{REPOSITORY_URL[:-10]}mysql-8.4.tgz")
+            self.assertEqual(mocker.call_count, 2)
+            self.assertEqual(mocker.request_history[0].headers["If-None-Match"], '"v1"')
+        self.assertEqual(new_addons_meta["redis-7.0"], addons_meta["redis-7.0"])
+        self.assertEqual(list(new_addons_meta.keys()), ["redis-7.0", "mysql-8.0", "mysql-8.4"])
+        # index.yaml not modified
+        with requests_mock.Mocker() as mocker:
+            mocker.get(REPOSITORY_URL, status_code=304)
+            self.assertEqual(fetch.fetch_addons(repository, manifest=manifest), new_addons_meta)
+            self.assertEqual(mocker.call_count, 1)
+
+    def test_fetch_addon_members(self):
+        url = "https://charts.example.com/addons/mysql-8.0.tgz"
+        with requests_mock.Mocker() as mocker, tempfile.TemporaryDirectory() as dest:
+            mocker.get(url, content=make_addon_archive("mysql", "8.0", ("small", "large")))
+            fetch._fetch_addon(url, dest, fetch.META_MEMBERS)
+            self.assertTrue(os.path.exists(f"{dest}/meta.json"))
+            self.assertTrue(os.path.exists(f"{dest}/plans/large/meta.yaml"))
+            self.assertFalse(os.path.exists(f"{dest}/plans/large/values.yaml"))
+            self.assertFalse(os.path.exists(f"{dest}/chart"))
+        with requests_mock.Mocker() as mocker, tempfile.TemporaryDirectory() as dest:
+            mocker.get(url, content=make_addon_archive("mysql", "8.0", ("small", "large")))
+            fetch._fetch_addon(url, dest, ("chart/mysql", "plans/small"))
+            self.assertTrue(os.path.exists(f"{dest}/chart/mysql/Chart.yaml"))
+            self.assertTrue(os.path.exists(f"{dest}/plans/small/values.yaml"))
+            self.assertFalse(os.path.exists(f"{dest}/plans/large"))
+
+    def test_get_session(self):
+        session = fetch.get_session("https://charts.example.com/a/index.yaml")
+        self.assertIs(session, fetch.get_session("https://charts.example.com/b.tgz"))
+        self.assertIsNot(session, fetch.get_session("https://other.example.com/b.tgz"))
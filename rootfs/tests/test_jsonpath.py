@@ -0,0 +1,37 @@
+import unittest
+
+from helmbroker import jsonpath
+
+SERVICE = {
+    "metadata": {"name": "mysql", "annotations": {"drycc.cc/port": "3306"}},
+    "spec": {
+        "clusterIP": "10.0.0.1",
+        "ports": [{"name": "mysql", "port": 3306}, {"name": "metrics", "port": 9104}],
+    },
+}
+
+
+class TestJSONPath(unittest.TestCase):
+
+    def test_render(self):
+        for template, value in (
+            ("{.spec.clusterIP}", "10.0.0.1"),
+            (".spec.clusterIP", "10.0.0.1"),
+            ("{.spec.ports[0].port}", "3306"),
+            ("{.spec.ports[-1].name}", "metrics"),
+            ("{.spec.ports[*].port}", "3306 9104"),
+            ('{.spec.ports[?(@.name=="metrics")].port}', "9104"),
+            ("{.spec.ports[?(@.port > 4000)].name}", "metrics"),
+            ("{.metadata.annotations.drycc\\.cc/port}", "3306"),
+            ("{.metadata.annotations['drycc.cc/port']}", "3306"),
+            ("{..port}", "3306 9104"),
+            ("{.spec.clusterIP}:{.spec.ports[0].port}", "10.0.0.1:3306"),
+            ("{.spec.ports[0]}", '{"name": "mysql", "port": 3306}'),
+            ("{.spec.missing}", ""),
+        ):
+            self.assertEqual(jsonpath.render(template, SERVICE), value, template)
+
+    def test_render_error(self):
+        for template in ("{.spec.ports[0}", "{.spec.ports[x]}", "{.spec"):
+            with self.assertRaises(jsonpath.JSONPathError):
+                jsonpath.render(template, SERVICE)
@@ -0,0 +1,140 @@
+import os
+import json
+import base64
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import yaml
+
+from helmbroker import kubernetes
+from helmbroker.database import query
+
+OBJECTS = {
+    "/api/v1/namespaces/demo/secrets/mysql": {
+        "data": {"password": base64.b64encode(b"secret").decode()},
+    },
+    "/api/v1/namespaces/demo/configmaps/mysql": {"data": {"database": "demo"}},
+    "/api/v1/namespaces/demo/services/mysql": {
+        "spec": {"clusterIP": "10.0.0.1", "ports": [{"name": "mysql", "port": 3306}]},
+    },
+    "/apis/apps/v1/namespaces/demo/deployments/proxy": {
+        "metadata": {"generation": 2},
+        "spec": {"replicas": 2},
+        "status": {"observedGeneration": 2, "updatedReplicas": 2, "readyReplicas": 2},
+    },
+    "/apis/apps/v1/namespaces/demo/statefulsets/mysql": {
+        "metadata": {"generation": 1},
+        "spec": {"replicas": 3},
+        "status": {"observedGeneration": 1, "updatedReplicas": 3, "readyReplicas": 1},
+    },
+}
+MANIFEST = """
+---
+kind: ConfigMap
+metadata:
+  name: mysql
+---
+kind: Deployment
+metadata:
+  name: proxy
+---
+kind: Service
+metadata:
+  name: mysql
+"""
+
+
+class FakeAPIHandler(BaseHTTPRequestHandler):
+    requests = []
+
+    def do_GET(self):
+        self.requests.append((self.path, self.headers.get("Authorization")))
+        if self.path in OBJECTS:
+            status, body = 200, OBJECTS[self.path]
+        else:
+            status, body = 404, {
+                "kind": "Status", "reason": "NotFound",
+                "message": f"{self.path.rsplit('/', 1)[-1]} not found",
+            }
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestKubernetes(unittest.TestCase):
+
+    def setUp(self):
+        FakeAPIHandler.requests = []
+        server = ThreadingHTTPServer(("127.0.0.1", 0), FakeAPIHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        temp = tempfile.TemporaryDirectory()
+        self.addCleanup(temp.cleanup)
+        kubeconfig = os.path.join(temp.name, "config")
+        with open(kubeconfig, "w") as f:
+            yaml.dump({
+                "current-context": "fake",
+                "contexts": [{"name": "fake", "context": {"cluster": "fake", "user": "admin"}}],
+                "clusters": [{
+                    "name": "fake",
+                    "cluster": {"server": f"http://127.0.0.1:{server.server_port}"},
+                }],
+                "users": [{"name": "admin", "user": {"token": "fake-token"}}],
+            }, f)
+        for patcher in (
+            mock.patch.dict(os.environ, {"KUBECONFIG": kubeconfig}),
+            mock.patch.object(kubernetes, "_kubernetes_client", (None, None)),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        os.environ.pop("KUBERNETES_SERVICE_HOST", None)
+
+    def test_get_cred_value(self):
+        for source, value in (
+            ({"secretKeyRef": {"name": "mysql", "jsonpath": "{.data.password}"}}, "secret"),
+            ({"configMapRef": {"name": "mysql", "jsonpath": "{.data.database}"}}, "demo"),
+            ({"serviceRef": {"name": "mysql", "jsonpath": "{.spec.ports[0].port}"}}, "3306"),
+        ):
+            self.assertEqual(query.get_cred_value("demo", source), (0, value))
+        self.assertEqual(len(FakeAPIHandler.requests), 3)
+        self.assertEqual(FakeAPIHandler.requests[0][1], "Bearer fake-token")
+        self.assertIs(kubernetes.get_kubernetes_client(), kubernetes.get_kubernetes_client())
+
+    def test_get_cred_value_error(self):
+        status, value = query.get_cred_value(
+            "demo", {"secretKeyRef": {"name": "redis", "jsonpath": "{.data.password}"}})
+        self.assertEqual(status, 1)
+        self.assertEqual(value, "Error from server (NotFound: redis not found)")
+        self.assertEqual(query.get_cred_value("demo", {}), (-1, "invalid valueFrom"))
+        status, _ = query.get_cred_value(
+            "demo", {"configMapRef": {"name": "mysql", "jsonpath": "{.data[x]}"}})
+        self.assertEqual(status, 1)
+
+    def test_get_cred_values(self):
+        secret = {"secretKeyRef": {"name": "mysql", "jsonpath": "{.data.password}"}}
+        service = {"serviceRef": {"name": "mysql", "jsonpath": "{.spec.clusterIP}"}}
+        port = {"serviceRef": {"name": "mysql", "jsonpath": "{.spec.ports[0].port}"}}
+        missing = {"configMapRef": {"name": "redis", "jsonpath": "{.data.database}"}}
+        values = query.get_cred_values("demo", [secret, service, port, missing, secret, {}])
+        self.assertEqual(values[:3], [(0, "secret"), (0, "10.0.0.1"), (0, "3306")])
+        self.assertEqual(values[3][0], 1)
+        self.assertEqual(values[4:], [(0, "secret"), (-1, "invalid valueFrom")])
+        # one request per distinct object
+        self.assertEqual(len(FakeAPIHandler.requests), 3)
+
+    def test_check_ready(self):
+        client = kubernetes.get_kubernetes_client()
+        self.assertEqual(client.check_ready(MANIFEST, "demo"), (True, "all resources are ready"))
+        manifest = MANIFEST + "---\nkind: StatefulSet\nmetadata:\n  name: mysql\n"
+        self.assertEqual(
+            client.check_ready(manifest, "demo"), (False, "waiting for StatefulSet/mysql"))
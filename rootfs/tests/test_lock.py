@@ -0,0 +1,67 @@
+import time
+import unittest
+from unittest import mock
+
+import fakeredis
+
+from helmbroker import lock
+
+
+class TestInstanceLock(unittest.TestCase):
+
+    def setUp(self):
+        self.valkey = fakeredis.FakeRedis()
+        patcher = mock.patch.object(lock, "get_valkey_client", return_value=self.valkey)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_lock(self):
+        with lock.InstanceLock("instance-1", timeout=0) as instance_lock:
+            self.assertEqual(self.valkey.get("helmbroker:lock:instance:instance-1"),
+                             instance_lock.token.encode())
+            self.assertEqual(self.valkey.get("instance-1"), instance_lock.token.encode())
+            self.assertFalse(lock.InstanceLock("instance-1").acquire(blocking=False))
+            with self.assertRaises(lock.LockTimeout):
+                with lock.InstanceLock("instance-1", timeout=0.1):
+                    pass
+            self.assertTrue(lock.InstanceLock("instance-2").acquire(blocking=False))
+        self.assertFalse(self.valkey.exists("helmbroker:lock:instance:instance-1", "instance-1"))
+        stats = lock.load_lock_stats()
+        self.assertEqual(stats["acquired"], 2)
+        self.assertEqual(stats["contended"], 2)
+        self.assertEqual(stats["busy"], 1)
+        self.assertEqual(stats["timeouts"], 1)
+        self.assertGreater(stats["wait_time"], 0)
+
+    def test_lock_renew(self):
+        instance_lock = lock.InstanceLock("instance-1", ttl=0.3)
+        self.assertTrue(instance_lock.acquire())
+        time.sleep(0.5)
+        # renewed by the holder
+        self.assertFalse(lock.InstanceLock("instance-1").acquire(blocking=False))
+        instance_lock.release()
+        self.assertTrue(instance_lock.acquire(blocking=False))
+        instance_lock.release()
+
+    def test_lock_lost(self):
+        instance_lock = lock.InstanceLock("instance-1")
+        instance_lock.acquire()
+        self.valkey.set("helmbroker:lock:instance:instance-1", "other")
+        self.assertFalse(instance_lock.extend())
+        instance_lock.release()
+        # the lease of another holder is kept
+        self.assertEqual(self.valkey.get("helmbroker:lock:instance:instance-1"), b"other")
+
+    def test_lock_legacy(self):
+        # held by a worker of the previous release
+        self.valkey.set("instance-1", "legacy")
+        self.assertFalse(lock.InstanceLock("instance-1").acquire(blocking=False))
+        self.assertFalse(self.valkey.exists("helmbroker:lock:instance:instance-1"))
+        self.valkey.delete("instance-1")
+        instance_lock = lock.InstanceLock("instance-1")
+        self.assertTrue(instance_lock.acquire(blocking=False))
+        self.valkey.set("instance-1", "legacy")
+        self.assertFalse(instance_lock.extend())
+        instance_lock.release()
+        self.assertEqual(self.valkey.get("instance-1"), b"legacy")
+        self.assertFalse(self.valkey.exists("helmbroker:lock:instance:instance-1"))
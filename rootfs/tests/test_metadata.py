@@ -0,0 +1,260 @@
+import os
+import json
+import tempfile
+import unittest
+from unittest import mock
+
+import fakeredis
+from jsonschema import ValidationError
+
+from helmbroker.database import metadata, models, query
+
+
+ADDONS_META = {
+    "mysql": {
+        "id": "mysql-id", "name": "mysql", "version": "8.0", "description": "mysql",
+        "bindable": True, "tags": ["db"],
+        "plans": [{"id": "standard-id", "name": "standard", "description": "standard"}],
+    },
+    "redis": {
+        "id": "redis-id", "name": "redis", "version": "7.0", "description": "redis",
+        "bindable": False, "tags": [],
+        "plans": [{"id": "small-id", "name": "small", "description": "small"}],
+    },
+}
+
+
+class TestAddonsCatalog(unittest.TestCase):
+
+    def setUp(self):
+        self.valkey = fakeredis.FakeRedis()
+        self.addons_path = tempfile.TemporaryDirectory()
+        patchers = [
+            mock.patch.object(metadata, "get_valkey_client", return_value=self.valkey),
+            mock.patch.object(metadata, "ADDONS_PATH", self.addons_path.name),
+            mock.patch.object(metadata, "_addons_catalog", None),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(self.addons_path.cleanup)
+
+    def test_catalog_index(self):
+        metadata.save_addons_meta(ADDONS_META)
+        catalog = metadata.load_addons_catalog()
+        self.assertEqual(catalog.get_addon("mysql-id")["name"], "mysql")
+        self.assertEqual(catalog.get_plan("redis-id", "small-id")["name"], "small")
+        self.assertIsNone(catalog.get_addon("unknown"))
+        self.assertIsNone(catalog.get_plan("mysql-id", "small-id"))
+
+    def test_catalog_generation(self):
+        metadata.save_addons_meta(ADDONS_META)
+        catalog = metadata.load_addons_catalog()
+        self.assertIs(metadata.load_addons_catalog(), catalog)
+        addons_meta = json.loads(json.dumps(ADDONS_META))
+        addons_meta["mysql"]["version"] = "8.4"
+        metadata.save_addons_meta(addons_meta)
+        new_catalog = metadata.load_addons_catalog()
+        self.assertIsNot(new_catalog, catalog)
+        self.assertEqual(new_catalog.generation, catalog.generation + 1)
+        self.assertEqual(new_catalog.get_addon("mysql-id")["version"], "8.4")
+
+    def test_catalog_without_generation(self):
+        self.valkey.set(metadata.ADDONS_CACHE_KEY, json.dumps(ADDONS_META))
+        catalog = metadata.load_addons_catalog()
+        self.assertEqual(catalog.generation, 0)
+        self.assertIs(metadata.load_addons_catalog(), catalog)
+
+
+class TestInstanceMeta(unittest.TestCase):
+
+    def setUp(self):
+        self.valkey = fakeredis.FakeRedis()
+        self.instances_path = tempfile.TemporaryDirectory()
+        patchers = [
+            mock.patch.object(metadata, "get_valkey_client", return_value=self.valkey),
+            mock.patch.object(query, "INSTANCES_PATH", self.instances_path.name),
+            mock.patch.object(query, "get_valkey_client", return_value=self.valkey),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(self.instances_path.cleanup)
+
+    def save_instance_meta(self, instance_id, state="succeeded"):
+        os.makedirs(query.get_instance_path(instance_id), exist_ok=True)
+        metadata.save_instance_meta(instance_id, {
+            "id": instance_id,
+            "details": {"service_id": "mysql-id", "plan_id": "standard-id", "context": {}},
+            "last_operation": {
+                "state": state, "operation": "provision", "description": state},
+        })
+
+    def test_load_instances_meta(self):
+        for instance_id in ("a", "b", "c"):
+            self.save_instance_meta(instance_id)
+        self.valkey.delete(metadata.INSTANCE_CACHE_KEY.format("b"))
+        instances_meta = metadata.load_instances_meta(["a", "b", "c", "unknown"])
+        self.assertEqual(sorted(instances_meta.keys()), ["a", "b", "c"])
+        self.assertEqual(instances_meta["b"]["last_operation"]["state"], "succeeded")
+        # the cache misses are written back
+        self.assertTrue(self.valkey.exists(metadata.INSTANCE_CACHE_KEY.format("b")))
+        self.assertEqual(metadata.load_instances_meta([]), {})
+
+    def test_instance_cache_hash(self):
+        self.save_instance_meta("a", state="in progress")
+        cache_key = metadata.INSTANCE_CACHE_KEY.format("a")
+        self.assertEqual(self.valkey.type(cache_key), b"hash")
+        self.assertEqual(self.valkey.hget(cache_key, "last_operation.state"), b"in progress")
+        self.assertEqual(
+            metadata.load_instance_last_operation("a"),
+            {"state": "in progress", "operation": "provision", "description": "in progress"})
+        data = metadata.load_instance_meta("a")
+        self.assertEqual(data["details"]["plan_id"], "standard-id")
+        with open(query.get_instance_file("a")) as f:
+            self.assertEqual(data, json.load(f))
+
+    def test_instance_legacy_cache(self):
+        self.save_instance_meta("a")
+        self.save_instance_meta("b")
+        with open(query.get_instance_file("a")) as f:
+            data = json.load(f)
+        # written by a pod of the previous release
+        legacy = dict(data, last_modified_time=data["last_modified_time"] + 1)
+        legacy["last_operation"] = dict(data["last_operation"], state="failed")
+        self.valkey.set("helmbroker:instance:a", json.dumps(legacy))
+        self.valkey.set("helmbroker:instance:b", json.dumps(dict(data, id="b")))
+        self.valkey.delete(metadata.INSTANCE_CACHE_KEY.format("b"))
+        self.assertEqual(metadata.load_instance_last_operation("a")["state"], "failed")
+        self.assertEqual(metadata.load_instance_meta("a"), legacy)
+        self.assertEqual(
+            self.valkey.hget(metadata.INSTANCE_CACHE_KEY.format("a"), "last_operation.state"),
+            b"failed")
+        self.assertEqual(metadata.load_instances_meta(["b"])["b"]["id"], "b")
+        self.assertEqual(self.valkey.type(metadata.INSTANCE_CACHE_KEY.format("b")), b"hash")
+        # the legacy keys are kept for the previous release and expire
+        for instance_id in ("a", "b"):
+            self.assertEqual(self.valkey.type(f"helmbroker:instance:{instance_id}"), b"string")
+            self.assertGreater(self.valkey.ttl(f"helmbroker:instance:{instance_id}"), 0)
+        # a save drops the legacy string, an older one is ignored
+        self.save_instance_meta("a", state="succeeded")
+        self.assertFalse(self.valkey.exists("helmbroker:instance:a"))
+        self.valkey.set("helmbroker:instance:a", json.dumps(data))
+        self.assertEqual(metadata.load_instance_meta("a")["last_operation"]["state"], "succeeded")
+        metadata.delete_instances_cache(["a"])
+        self.assertFalse(self.valkey.exists("helmbroker:instance:a"))
+
+    def test_instance_status(self):
+        self.assertIsNone(metadata.load_instance_status("a"))
+        self.save_instance_meta("a", state="in progress")
+        self.assertEqual(metadata.load_instance_status("a"), ("in progress", "in progress"))
+        # backfilling never overwrites the saved status
+        metadata.save_instance_status("a", {"state": "failed", "description": "failed"})
+        self.assertEqual(metadata.load_instance_status("a"), ("in progress", "in progress"))
+        with (
+            mock.patch.object(metadata, "STATUS_CACHE_TTL", 60),
+            mock.patch.object(metadata, "_status_cache", {}),
+        ):
+            self.assertEqual(metadata.load_instance_status("a")[0], "in progress")
+            self.save_instance_meta("a", state="succeeded")
+            self.assertEqual(metadata.load_instance_status("a")[0], "in progress")
+        self.assertEqual(metadata.load_instance_status("a")[0], "succeeded")
+
+    def test_save_instance_model(self):
+        os.makedirs(query.get_instance_path("a"))
+        meta = models.InstanceMeta.from_dict({
+            "id": "a", "details": {"service_id": "s", "plan_id": "p", "context": {}},
+            "last_operation": {"state": "succeeded", "description": "ok"},
+        })
+        metadata.save_instance_meta("a", meta)
+        self.assertIsNotNone(meta.last_modified_time)
+        self.assertEqual(metadata.load_instance_meta("a"), meta.to_dict())
+        meta.details.plan_id = 1
+        with self.assertRaises(ValidationError):
+            metadata.save_instance_meta("a", meta)
+
+    def test_cache_lifecycle(self):
+        self.save_instance_meta("a")
+        self.save_instance_meta("b")
+        cache_key = metadata.INSTANCE_CACHE_KEY.format("a")
+        self.assertGreater(self.valkey.ttl(cache_key), 0)
+        self.assertGreater(self.valkey.ttl(metadata.INSTANCE_STATUS_KEY.format("a")), 0)
+        self.valkey.delete(cache_key)
+        metadata.load_instance_meta("a")
+        metadata.load_instance_meta("a")
+        metadata.load_instances_meta(["a", "b"])
+        stats = metadata.load_cache_stats()["instance"]
+        self.assertEqual((stats["reads"], stats["hits"], stats["misses"]), (4, 3, 1))
+        self.assertEqual(stats["hit_rate"], 0.75)
+        self.assertIsNone(metadata.load_cache_stats()["binding"]["hit_rate"])
+        metadata.delete_instances_cache(["a"])
+        self.assertFalse(self.valkey.exists(cache_key))
+        self.assertIsNone(metadata.load_instance_status("a"))
+        self.assertTrue(self.valkey.exists(metadata.INSTANCE_CACHE_KEY.format("b")))
+
+    def test_instance_indexes(self):
+        self.save_instance_meta("a", state="failed")
+        self.save_instance_meta("b", state="succeeded")
+        self.save_instance_meta("c", state="failed")
+        self.assertEqual(query.get_instance_ids(), ["a", "b", "c"])
+        self.assertEqual(query.get_instance_ids(state="failed"), ["a", "c"])
+        self.assertEqual(query.get_addon_instance_ids("mysql-id", state="succeeded"), ["b"])
+        self.assertEqual(query.get_instance_ids(service_id="redis-id"), [])
+        self.save_instance_meta("a", state="succeeded")
+        self.assertEqual(query.get_instance_ids(state="failed"), ["c"])
+        self.assertEqual(query.get_instance_ids(state="succeeded"), ["b", "a"])
+        modified_time = metadata.load_instance_meta("b")["last_modified_time"]
+        self.assertEqual(
+            query.get_instance_ids(state="succeeded", modified_before=modified_time), ["b"])
+        self.assertEqual(query.get_instance_ids(modified_after=modified_time), ["b", "c", "a"])
+        metadata.delete_instances_cache(["a"])
+        self.assertEqual(query.get_instance_ids(), ["b", "c"])
+        self.assertEqual(query.get_instance_ids(state="succeeded"), ["b"])
+
+    def test_index_instances_meta(self):
+        self.save_instance_meta("a", state="failed")
+        self.valkey.flushall()
+        self.assertEqual(query.get_instance_ids(state="failed"), [])
+        metadata.index_instances_meta(metadata.load_instances_meta(["a"]))
+        self.assertEqual(query.get_instance_ids(state="failed"), ["a"])
+
+
+class TestPendingUpdate(unittest.TestCase):
+
+    def setUp(self):
+        self.valkey = fakeredis.FakeRedis()
+        patcher = mock.patch.object(metadata, "get_valkey_client", return_value=self.valkey)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_pending_update(self):
+        self.assertTrue(metadata.push_pending_update("instance-1", {
+            "version": 1, "service_id": "mysql-id", "plan_id": "standard-id",
+            "parameters": {"replicas": 3, "image": "mysql:8.0"},
+        }, "task-1"))
+        # queued for as long as it takes
+        self.assertEqual(self.valkey.ttl("helmbroker:instance:instance-1:pending_update"), -1)
+        self.assertFalse(metadata.claim_pending_update("instance-1", "task-2"))
+        self.assertTrue(metadata.claim_pending_update("instance-1", "task-1"))
+        self.assertGreater(self.valkey.ttl("helmbroker:instance:instance-1:pending_update"), 0)
+        self.assertTrue(metadata.claim_pending_update("instance-1", "task-1", running=False))
+        self.assertEqual(self.valkey.ttl("helmbroker:instance:instance-1:pending_update"), -1)
+        self.valkey.expire("helmbroker:instance:instance-1:pending_update", 100)
+        self.assertFalse(metadata.push_pending_update("instance-1", {
+            "version": 1, "service_id": "mysql-id", "plan_id": None,
+            "context": {"namespace": "ns"}, "parameters": {"replicas": 5, "tls": ""},
+        }, "task-2"))
+        self.assertLessEqual(self.valkey.ttl("helmbroker:instance:instance-1:pending_update"), 100)
+        self.assertFalse(metadata.drop_pending_update("instance-1", "task-2"))
+        self.assertEqual(metadata.pop_pending_update("instance-1"), {
+            "version": 1, "service_id": "mysql-id", "plan_id": "standard-id",
+            "context": {"namespace": "ns"},
+            "parameters": {"replicas": 5, "image": "mysql:8.0", "tls": ""},
+        })
+        self.assertIsNone(metadata.pop_pending_update("instance-1"))
+        self.assertTrue(metadata.push_pending_update("instance-1", {"parameters": {}}, "task-3"))
+        self.assertTrue(metadata.drop_pending_update("instance-1", "task-3"))
+        self.assertFalse(metadata.drop_pending_update("instance-1", "task-3"))
+        self.assertTrue(metadata.push_pending_update("instance-1", {"parameters": {}}, "task-4"))
+        self.assertTrue(metadata.cancel_pending_update("instance-1"))
+        self.assertFalse(metadata.cancel_pending_update("instance-1"))
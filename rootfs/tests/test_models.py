@@ -0,0 +1,55 @@
+import json
+import unittest
+
+from openbrokerapi.service_broker import ProvisionDetails
+
+from helmbroker.database import models
+
+
+class TestModels(unittest.TestCase):
+
+    def test_instance_meta(self):
+        data = {
+            "id": "a",
+            "details": {
+                "service_id": "mysql-id", "plan_id": "standard-id",
+                "context": {"namespace": "ns"}, "parameters": {},
+            },
+            "last_operation": {"state": "succeeded", "operation": "provision"},
+            "last_modified_time": 1.0,
+            "unknown": [1],
+        }
+        meta = models.InstanceMeta.from_dict(data)
+        self.assertEqual(meta.details.context["namespace"], "ns")
+        self.assertEqual(meta.last_operation.state, "succeeded")
+        self.assertIsNone(meta.last_operation.description)
+        self.assertEqual(meta.extra, {"unknown": [1]})
+        self.assertEqual(meta.to_dict(), data)
+        self.assertEqual(models.InstanceMeta.from_dict(meta.to_dict()), meta)
+        with self.assertRaises(AttributeError):
+            meta.credentials = {}
+
+    def test_binding_meta(self):
+        meta = models.BindingMeta(
+            binding_id="b", credentials={"password": "secret"},
+            last_operation=models.LastOperation(state="failed", description="error"))
+        self.assertEqual(meta.to_dict(), {
+            "binding_id": "b", "credentials": {"password": "secret"},
+            "last_operation": {"state": "failed", "description": "error"},
+        })
+
+    def test_operation_details(self):
+        details = ProvisionDetails(
+            service_id="mysql-id", plan_id="standard-id", organization_guid="org",
+            space_guid="space", context={"instance_name": "mysql", "namespace": "ns"},
+            parameters={"replicas": 3})
+        payload = models.OperationDetails.from_details(details).to_dict()
+        self.assertEqual(payload, {
+            "version": 1, "service_id": "mysql-id", "plan_id": "standard-id",
+            "context": {"instance_name": "mysql", "namespace": "ns"},
+            "parameters": {"replicas": 3},
+        })
+        loaded = models.OperationDetails.from_details(json.loads(json.dumps(payload)))
+        self.assertEqual(loaded.context["namespace"], "ns")
+        with self.assertRaises(ValueError):
+            models.OperationDetails.from_details(dict(payload, version=2))
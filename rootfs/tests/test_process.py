@@ -0,0 +1,55 @@
+import os
+import time
+import tempfile
+import threading
+import unittest
+
+from helmbroker import process, utils
+
+
+class TestProcess(unittest.TestCase):
+
+    def test_run(self):
+        result = process.run(["sh", "-c", 'echo "$0"; echo error >&2; exit 3', "a 'b' c"])
+        self.assertEqual(result.status, 3)
+        self.assertEqual(result.stdout, "a 'b' c\n")
+        self.assertEqual(result.stderr, "error\n")
+        self.assertEqual(result.output, "a 'b' c\n\nerror\n")
+        self.assertGreater(result.wall_time, 0)
+        self.assertGreaterEqual(result.cpu_time, 0)
+
+    def test_run_not_found(self):
+        result = process.run(["helmbroker-not-found"])
+        self.assertEqual(result.status, 127)
+
+    def test_run_timeout(self):
+        start = time.monotonic()
+        result = process.run(["sh", "-c", "sleep 10 & sleep 10"], timeout=0.2)
+        self.assertTrue(result.timed_out)
+        self.assertNotEqual(result.status, 0)
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_run_cancel(self):
+        cancel = threading.Event()
+        threading.Timer(0.2, cancel.set).start()
+        result = process.run(["sleep", "10"], cancel=cancel)
+        self.assertTrue(result.cancelled)
+        self.assertIn("cancelled", result.output)
+
+    def test_run_output_limit(self):
+        with tempfile.TemporaryDirectory() as temp:
+            log_file = os.path.join(temp, "logs", "command.log")
+            result = process.run(
+                ["sh", "-c", "seq 1 10000"], limit=10, log_file=log_file)
+            self.assertEqual(result.stdout, "999\n10000\n")
+            with open(log_file) as f:
+                self.assertEqual(len(f.read().splitlines()), 10001)
+            process.run(
+                ["sh", "-c", "echo secret; echo error >&2"], log_file=log_file,
+                log_stdout=False, log_args=["sh", "-c", "***"])
+            with open(log_file) as f:
+                self.assertEqual(f.read().splitlines()[10001:], ["$ sh -c '***'", "error"])
+
+    def test_command(self):
+        self.assertEqual(utils.command("echo", "a  b", "$HOME"), (0, "a  b $HOME"))
+        self.assertEqual(utils.command("echo", '{"a": 1}', output_type="json"), {"a": 1})
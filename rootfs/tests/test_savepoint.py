@@ -0,0 +1,88 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from helmbroker.database import query, savepoint
+
+
+class TestBackupInstance(unittest.TestCase):
+
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp.cleanup)
+        patcher = mock.patch.object(query, "INSTANCES_PATH", self.temp.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.instance_path = query.get_instance_path("instance-1")
+        for name, data in (
+            ("chart/mysql/Chart.yaml", "name: mysql\n"),
+            ("chart/mysql/values.yaml", "replicas: 1\n"),
+            ("plan/values.yaml", "replicas: 1\n"),
+            ("addon-values.yaml", ""),
+        ):
+            self.write(name, data)
+
+    def write(self, name, data):
+        file = os.path.join(self.instance_path, name)
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        with open(file, "w") as f:
+            f.write(data)
+
+    def objects(self):
+        return os.listdir(os.path.join(query.get_backups_path("instance-1"), "objects"))
+
+    def test_backup_instance(self):
+        savepoint.backup_instance("instance-1")
+        savepoint.backup_instance("instance-1")
+        self.assertEqual(len(savepoint.list_backups("instance-1")), 1)
+        # equal files share one object
+        self.assertEqual(len(self.objects()), 3)
+        self.write("plan/values.yaml", "replicas: 3\n")
+        savepoint.backup_instance("instance-1")
+        backups = savepoint.list_backups("instance-1")
+        self.assertEqual(len(backups), 2)
+        self.assertEqual(len(self.objects()), 4)
+
+        dest = os.path.join(self.temp.name, "restore")
+        savepoint.restore_backup("instance-1", backups[0], dest)
+        with open(os.path.join(dest, "plan/values.yaml")) as f:
+            self.assertEqual(f.read(), "replicas: 1\n")
+        with open(os.path.join(dest, "chart/mysql/Chart.yaml")) as f:
+            self.assertEqual(f.read(), "name: mysql\n")
+        self.assertTrue(os.path.exists(os.path.join(dest, "addon-values.yaml")))
+
+    def test_backup_same_size_and_mtime(self):
+        file = os.path.join(self.instance_path, "chart/mysql/Chart.yaml")
+        self.write("chart/mysql/Chart.yaml", "version: 8.0.1\n")
+        os.utime(file, ns=(0, 0))
+        savepoint.backup_instance("instance-1")
+        # an archive built with fixed timestamps
+        self.write("chart/mysql/Chart.yaml", "version: 8.0.2\n")
+        os.utime(file, ns=(0, 0))
+        savepoint.backup_instance("instance-1")
+        backups = savepoint.list_backups("instance-1")
+        self.assertEqual(len(backups), 2)
+        dest = os.path.join(self.temp.name, "restore")
+        savepoint.restore_backup("instance-1", backups[-1], dest)
+        with open(os.path.join(dest, "chart/mysql/Chart.yaml")) as f:
+            self.assertEqual(f.read(), "version: 8.0.2\n")
+
+    def test_restore_backup(self):
+        data = os.urandom(256 * 1024)
+        with open(os.path.join(self.instance_path, "chart/mysql/charts.tgz"), "wb") as f:
+            f.write(data)
+        savepoint.backup_instance("instance-1")
+        dest = os.path.join(self.temp.name, "restore")
+        savepoint.restore_backup("instance-1", savepoint.list_backups("instance-1")[-1], dest)
+        with open(os.path.join(dest, "chart/mysql/charts.tgz"), "rb") as f:
+            self.assertEqual(f.read(), data)
+
+    def test_backup_retention(self):
+        with mock.patch.object(savepoint, "BACKUP_RETENTION", 2):
+            for replicas in range(4):
+                self.write("plan/values.yaml", f"replicas: {replicas + 5}\n")
+                savepoint.backup_instance("instance-1")
+        self.assertEqual(len(savepoint.list_backups("instance-1")), 2)
+        # objects of the pruned snapshots are removed
+        self.assertEqual(len(self.objects()), 5)
@@ -0,0 +1,73 @@
+import os
+import time
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from helmbroker.database import storage
+
+
+class TestStorage(unittest.TestCase):
+
+    def test_write_file(self):
+        with tempfile.TemporaryDirectory() as temp:
+            file = os.path.join(temp, "instance.json")
+            storage.write_file(file, "old")
+            self.assertEqual(storage.write_file(file, "new"), file)
+            with open(file) as f:
+                self.assertEqual(f.read(), "new")
+            with mock.patch.object(storage.os, "replace", side_effect=OSError("crash")):
+                with self.assertRaises(OSError):
+                    storage.write_file(file, "lost")
+            with open(file) as f:
+                self.assertEqual(f.read(), "new")
+            self.assertEqual(os.listdir(temp), ["instance.json"])
+
+    def test_write_file_fsync(self):
+        with (
+            tempfile.TemporaryDirectory() as temp,
+            mock.patch.object(storage, "FSYNC", True),
+            mock.patch.object(storage.os, "fsync", wraps=os.fsync) as fsync,
+        ):
+            storage.write_file(os.path.join(temp, "instance.json"), "new")
+            self.assertEqual(fsync.call_count, 2)
+        with (
+            tempfile.TemporaryDirectory() as temp,
+            mock.patch.object(storage, "FSYNC", False),
+            mock.patch.object(storage.os, "fsync") as fsync,
+        ):
+            storage.write_file(os.path.join(temp, "instance.json"), "new")
+            fsync.assert_not_called()
+
+    def test_group_commit(self):
+        group_commit = storage.GroupCommit()
+        synced, started, release = [], threading.Event(), threading.Event()
+
+        def sync(fds):
+            synced.append(list(fds))
+            started.set()
+            release.wait()
+
+        with mock.patch.object(group_commit, "_sync", side_effect=sync):
+            # a lone writer syncs at once
+            release.set()
+            group_commit.sync(1)
+            self.assertEqual(synced, [[1]])
+            # the writers arriving during a sync are synced together after it
+            started.clear()
+            release.clear()
+            leader = threading.Thread(target=group_commit.sync, args=(2, ))
+            leader.start()
+            started.wait()
+            threads = [threading.Thread(target=group_commit.sync, args=(fd, )) for fd in (3, 4, 5)]
+            for thread in threads:
+                thread.start()
+            while len(group_commit._batch.fds) < 3:
+                time.sleep(0.01)
+            release.set()
+            for thread in (leader, *threads):
+                thread.join()
+        self.assertEqual(synced[1], [2])
+        self.assertEqual(sorted(synced[2]), [3, 4, 5])
+        self.assertEqual(len(synced), 3)
@@ -0,0 +1,187 @@
+import time
+import unittest
+from unittest import mock
+
+from celery.exceptions import Retry
+
+from helmbroker import tasks
+from helmbroker.lock import LockTimeout
+
+INSTANCE_META = {
+    "id": "instance-1",
+    "details": {
+        "service_id": "mysql-id", "plan_id": "standard-id",
+        "context": {"instance_name": "mysql", "namespace": "demo"}, "parameters": {},
+    },
+    "last_operation": {
+        "state": "in progress", "operation": "provision",
+        "description": "provision instance-1 waiting for rollout",
+    },
+    "last_modified_time": 100.0,
+}
+
+
+class TestCheckRollout(unittest.TestCase):
+
+    def setUp(self):
+        self.ready = (False, "waiting for StatefulSet/mysql")
+        self.saved = []
+        client = mock.Mock()
+        client.check_ready.side_effect = lambda manifest, namespace: self.ready
+        self.apply_async = mock.Mock()
+        self.post_hook = mock.Mock()
+        for patcher in (
+            mock.patch.object(tasks, "run_instance_post_hook", self.post_hook),
+            mock.patch.object(tasks, "new_instance_lock"),
+            mock.patch.object(tasks.os.path, "exists", return_value=True),
+            mock.patch.object(
+                tasks, "load_instance_meta",
+                side_effect=lambda instance_id: {**INSTANCE_META, "last_operation": dict(
+                    INSTANCE_META["last_operation"])}),
+            mock.patch.object(tasks, "save_instance_meta", side_effect=self.save),
+            mock.patch.object(tasks, "helm", return_value=(0, "kind: StatefulSet")),
+            mock.patch.object(tasks, "get_kubernetes_client", return_value=client),
+            mock.patch.object(tasks.check_rollout, "apply_async", self.apply_async),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def save(self, instance_id, data):
+        self.saved.append(data["last_operation"])
+
+    def test_check_rollout(self):
+        deadline = time.time() + 60
+        tasks.check_rollout("instance-1", "provision", 100.0, deadline)
+        self.assertEqual(self.saved, [])
+        self.apply_async.assert_called_once_with(
+            ("instance-1", "provision", 100.0, deadline),
+            countdown=tasks.ROLLOUT_CHECK_INTERVAL)
+        self.post_hook.assert_not_called()
+        self.ready = (True, "all resources are ready")
+        tasks.check_rollout("instance-1", "provision", 100.0, deadline)
+        self.assertEqual(self.saved[-1]["state"], "succeeded")
+        self.post_hook.assert_called_once_with("instance-1", "provision")
+
+    def test_check_rollout_timeout(self):
+        tasks.check_rollout("instance-1", "update", 100.0, time.time() - 1)
+        self.assertEqual(self.saved[-1]["state"], "failed")
+        self.assertIn("waiting for StatefulSet/mysql", self.saved[-1]["description"])
+        self.apply_async.assert_not_called()
+        self.post_hook.assert_called_once_with("instance-1", "update")
+
+    def test_check_rollout_superseded(self):
+        tasks.check_rollout("instance-1", "update", 99.0, time.time() + 60)
+        self.assertEqual(self.saved, [])
+        self.apply_async.assert_not_called()
+        self.post_hook.assert_not_called()
+
+
+class TestUpdate(unittest.TestCase):
+
+    def setUp(self):
+        self.pending = [{"version": 1, "service_id": "mysql-id", "parameters": {"replicas": 5}}]
+        self.meta = {**INSTANCE_META, "last_operation": {
+            "state": "in progress", "operation": "provision",
+            "description": "update instance-1 in progress at 100.0",
+        }}
+        self.saved = []
+        for patcher in (
+            mock.patch.object(tasks, "new_instance_lock"),
+            mock.patch.object(tasks, "claim_pending_update"),
+            mock.patch.object(
+                tasks, "pop_pending_update",
+                side_effect=lambda instance_id: self.pending.pop() if self.pending else None),
+            mock.patch.object(tasks, "get_instance_file", return_value=__file__),
+            mock.patch.object(tasks, "load_instance_meta", side_effect=lambda _: self.meta),
+            mock.patch.object(
+                tasks, "save_instance_meta",
+                side_effect=lambda instance_id, data: self.saved.append(
+                    dict(data["last_operation"]))),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_update_coalesced(self):
+        with mock.patch.object(tasks, "_update") as update:
+            tasks.update("instance-1")
+            tasks.update("instance-1")
+        update.assert_called_once()
+        self.assertEqual(update.call_args[0][1].parameters, {"replicas": 5})
+
+    def test_update_lost(self):
+        tasks.update.push_request(id="task-1")
+        self.addCleanup(tasks.update.pop_request)
+        self.pending = []
+        with mock.patch.object(tasks, "drop_pending_update", return_value=False):
+            tasks.update.run("instance-1")
+        tasks.claim_pending_update.assert_called_once_with("instance-1", "task-1")
+        self.assertEqual(self.saved[-1]["state"], "failed")
+        self.assertEqual(self.saved[-1]["operation"], "provision")
+        # a deprovision which cancelled it is left alone
+        self.meta["last_operation"] = {
+            "state": "in progress", "operation": "deprovision",
+            "description": "deprovision instance-1 in progress at 101.0",
+        }
+        tasks.update("instance-1")
+        self.assertEqual(len(self.saved), 1)
+
+    def test_update_lock_failed(self):
+        tasks.update.push_request(id="task-1")
+        self.addCleanup(tasks.update.pop_request)
+        with mock.patch.object(tasks, "drop_pending_update") as drop_pending_update:
+            tasks.new_instance_lock.return_value.__enter__.side_effect = RuntimeError("valkey")
+            with self.assertRaises(RuntimeError):
+                # run keeps the request pushed above, a call pushes its own
+                tasks.update.run("instance-1")
+        drop_pending_update.assert_called_once_with("instance-1", "task-1")
+        self.assertEqual(len(self.pending), 1)
+
+
+class TestLockTimeout(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = {}
+        for patcher in (
+            mock.patch.object(tasks, "new_instance_lock"),
+            mock.patch.object(
+                tasks, "save_instance_meta",
+                side_effect=lambda instance_id, data: self.saved.update(data)),
+            mock.patch.object(tasks, "save_binding_meta"),
+            mock.patch.object(tasks, "run_instance_hooks"),
+            mock.patch.object(tasks, "claim_pending_update"),
+            mock.patch.object(tasks, "drop_pending_update"),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        tasks.new_instance_lock.return_value.__enter__.side_effect = LockTimeout(
+            "instance instance-1 is locked by another operation")
+
+    def assertRetried(self, task, *args):
+        with mock.patch.object(task, "retry", return_value=Retry()) as retry:
+            with self.assertRaises(Retry):
+                task.run(*args)
+        retry.assert_called_once_with(countdown=tasks.LOCK_RETRY_INTERVAL, max_retries=None)
+        # the instance is left to the operation holding it
+        self.assertEqual(self.saved, {})
+        tasks.save_binding_meta.assert_not_called()
+        tasks.run_instance_hooks.assert_not_called()
+
+    def test_provision(self):
+        self.assertRetried(tasks.provision, "instance-1", {
+            "version": 1, "service_id": "mysql-id", "plan_id": "standard-id",
+            "context": {"instance_name": "mysql", "namespace": "demo"},
+        })
+
+    def test_update(self):
+        tasks.update.push_request(id="task-1")
+        self.addCleanup(tasks.update.pop_request)
+        self.assertRetried(tasks.update, "instance-1")
+        # the retry applies the pending update, however long it is queued
+        tasks.drop_pending_update.assert_not_called()
+        tasks.claim_pending_update.assert_called_with("instance-1", "task-1", running=False)
+
+    def test_unbind(self):
+        self.assertRetried(tasks.unbind, "instance-1")
+
+    def test_deprovision(self):
+        self.assertRetried(tasks.deprovision, "instance-1")
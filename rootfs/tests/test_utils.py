@@ -1,5 +1,13 @@
+import os
+import sys
+import tempfile
 import unittest
+from unittest import mock
+
+import fakeredis
+
 from helmbroker import utils
+from helmbroker.database import metadata, query
 
 
 class TestUtils(unittest.TestCase):
@@ -50,3 +58,154 @@ class TestUtils(unittest.TestCase):
         )
         self.assertEqual(required_keys, 'deployment.image')
         self.assertEqual(not_allow_keys, 'deployment.test1.test9')
+
+    def test_helm_log(self):
+        with mock.patch.object(utils, "command", return_value=(0, "")) as command:
+            utils.helm("instance-1", "upgrade", "mysql", "chart", "--set", "password=a,user=b")
+            kwargs = command.call_args[1]
+            self.assertTrue(kwargs["log_file"].endswith(utils.HELM_LOG_SUFFIX))
+            self.assertFalse(kwargs["log_stdout"])
+            self.assertEqual(kwargs["log_args"][:6], [
+                "helm", "upgrade", "mysql", "chart", "--set", "password=***,user=***"])
+            for args in (("get", "manifest", "mysql"), ("template", "mysql", "chart")):
+                utils.helm("instance-1", *args)
+                self.assertNotIn("log_file", command.call_args[1])
+
+    def test_get_valkey_client(self):
+        with mock.patch.object(utils, "_valkey_client", (None, None)):
+            client = utils.get_valkey_client()
+            self.assertIs(utils.get_valkey_client(), client)
+            pool = client.connection_pool
+            self.assertIsInstance(pool, utils.BlockingConnectionPool)
+            self.assertEqual(pool.timeout, utils.VALKEY_POOL_TIMEOUT)
+            stats = utils.get_valkey_pool_stats()
+            self.assertEqual(stats["created"], 0)
+            self.assertEqual(stats["in_use"], 0)
+            pool.max_connections, pool.timeout = 1, 0.05
+            pool.reset()
+            connection = pool.make_connection()
+            pool.pool.get()
+            with self.assertRaises(utils.Empty):
+                pool.pool.get(timeout=pool.timeout)
+            pool.release(connection)
+            stats = utils.get_valkey_pool_stats()
+            self.assertEqual(
+                (stats["created"], stats["in_use"], stats["available"]), (1, 0, 1))
+            self.assertEqual((stats["acquired"], stats["timeouts"]), (1, 1))
+            self.assertGreaterEqual(stats["wait_time"], 0.05)
+            # a forked process gets its own client
+            with mock.patch.object(utils.os, "getpid", return_value=-1):
+                self.assertIsNot(utils.get_valkey_client(), client)
+
+    def test_get_valkey_sentinel_client(self):
+        valkey_url = "redis://:password@valkey:26379/0?master_set=drycc"
+        with (
+            mock.patch.object(utils, "_valkey_client", (None, None)),
+            mock.patch.object(utils, "VALKEY_URL", valkey_url),
+        ):
+            client = utils.get_valkey_client()
+            pool = client.connection_pool
+            self.assertIsInstance(pool, utils._SentinelConnectionPool)
+            self.assertIsInstance(pool, utils.BlockingConnectionPool)
+            self.assertIsInstance(pool.pool, utils._StatsLifoQueue)
+            self.assertEqual(pool.service_name, "drycc")
+            self.assertEqual(pool.max_connections, utils.VALKEY_MAX_CONNECTIONS)
+            self.assertEqual(pool.timeout, utils.VALKEY_POOL_TIMEOUT)
+
+
+class TestRenderBindTemplate(unittest.TestCase):
+
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp.cleanup)
+        for patcher in (
+            mock.patch.object(query, "INSTANCES_PATH", self.temp.name),
+            mock.patch.object(metadata, "get_valkey_client", return_value=fakeredis.FakeRedis()),
+            mock.patch.object(utils, "helm", side_effect=self.helm),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.instance_path = query.get_instance_path("instance-1")
+        for name, data in (
+            ("chart/Chart.yaml", "name: mysql\n"),
+            ("chart/templates/_helpers.tpl", "{{- define \"mysql.name\" -}}{{- end -}}\n"),
+            ("chart/templates/statefulset.yaml", "kind: StatefulSet\n"),
+            ("chart/templates/helpers.tpl", "{{ define \"mysql.port\" }}3306{{ end }}\n"),
+            ("chart/templates/service.yaml", "{{- define \"mysql.host\" -}}{{- end -}}\n"),
+            ("plan/bind.yaml", "credential: []\n"),
+            ("plan/values.yaml", "replicas: 1\n"),
+        ):
+            file = os.path.join(self.instance_path, name)
+            os.makedirs(os.path.dirname(file), exist_ok=True)
+            with open(file, "w") as f:
+                f.write(data)
+        self.templates = []
+
+    def helm(self, instance_id, *args, **kwargs):
+        self.templates.append(sorted(os.listdir(os.path.join(args[2], "templates"))))
+        return 0, "---\nkind: Secret\n---\ncredential:\n- name: password\n  value: secret\n"
+
+    def render(self):
+        chart_path = os.path.join(self.instance_path, "chart")
+        return utils.render_bind_template(
+            "instance-1", "mysql", chart_path, os.path.join(self.instance_path, "plan/bind.yaml"),
+            ["-f", os.path.join(self.instance_path, "plan/values.yaml")])
+
+    def test_render_bind_template(self):
+        template = {"credential": [{"name": "password", "value": "secret"}]}
+        self.assertEqual(self.render(), (0, template))
+        self.assertEqual(
+            self.templates, [["_helpers.tpl", "bind.yaml", "helpers.tpl", "service.yaml"]])
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(self.instance_path, "chart/templates"))),
+            ["_helpers.tpl", "helpers.tpl", "service.yaml", "statefulset.yaml"])
+        self.assertEqual(self.render(), (0, template))
+        self.assertEqual(len(self.templates), 1)
+        with open(os.path.join(self.instance_path, "plan/values.yaml"), "w") as f:
+            f.write("replicas: 3\n")
+        self.render()
+        self.assertEqual(len(self.templates), 2)
+
+
+class TestInstanceHooks(unittest.TestCase):
+
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp.cleanup)
+        patcher = mock.patch.object(query, "INSTANCES_PATH", self.temp.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        hooks_path = query.get_hooks_path("instance-1")
+        os.makedirs(hooks_path)
+        # a hook which is not executable is run with sh, one which is by its shebang
+        with open(os.path.join(hooks_path, "pre_update.sh"), "w") as f:
+            f.write("echo pre\n")
+        file = os.path.join(hooks_path, "post_update.sh")
+        with open(file, "w") as f:
+            f.write(f"#!{sys.executable}\nprint('post')\n")
+        os.chmod(file, 0o755)
+
+    def load_outputs(self):
+        from helmbroker.database.savepoint import load_hooks_result
+        return [item["output"] for item in load_hooks_result("instance-1")]
+
+    def test_run_instance_hooks(self):
+        with utils.run_instance_hooks("instance-1", "update") as (status, output):
+            self.assertEqual((status, output), (0, "pre"))
+        self.assertEqual(self.load_outputs(), ["pre", "post"])
+        from helmbroker.database.savepoint import load_hooks_result
+        for item in load_hooks_result("instance-1"):
+            self.assertTrue(item["script"].endswith(f"{item['output']}_update.sh"))
+            self.assertEqual(
+                sorted(item), ["cpu_time", "output", "script", "status", "wall_time"])
+
+    def test_run_instance_hooks_deferred(self):
+        with utils.run_instance_hooks("instance-1", "update", post=False):
+            pass
+        self.assertEqual(self.load_outputs(), ["pre"])
+        utils.run_instance_post_hook("instance-1", "update")
+        self.assertEqual(self.load_outputs(), ["pre", "post"])
+        with self.assertRaises(RuntimeError):
+            with utils.run_instance_hooks("instance-1", "update", post=False):
+                raise RuntimeError("helm crashed")
+        self.assertEqual(self.load_outputs(), ["pre", "post"])
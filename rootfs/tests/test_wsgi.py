@@ -0,0 +1,62 @@
+import base64
+import tempfile
+import unittest
+from unittest import mock
+
+import fakeredis
+
+from helmbroker import wsgi
+from helmbroker.database import metadata
+from tests.test_metadata import ADDONS_META
+
+
+class TestCatalog(unittest.TestCase):
+
+    def setUp(self):
+        self.valkey = fakeredis.FakeRedis()
+        self.addons_path = tempfile.TemporaryDirectory()
+        patchers = [
+            mock.patch.object(metadata, "get_valkey_client", return_value=self.valkey),
+            mock.patch.object(metadata, "ADDONS_PATH", self.addons_path.name),
+            mock.patch.object(metadata, "_addons_catalog", None),
+            mock.patch.object(wsgi.broker, "_catalog", (None, None, None, None)),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(self.addons_path.cleanup)
+        metadata.save_addons_meta(ADDONS_META)
+        self.client = wsgi.application.test_client()
+        auth = base64.b64encode(f"{wsgi.USERNAME}:{wsgi.PASSWORD}".encode()).decode()
+        self.headers = {"X-Broker-Api-Version": "2.13", "Authorization": f"Basic {auth}"}
+
+    def test_catalog_etag(self):
+        response = self.client.get("/v2/catalog", headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        services = response.get_json()["services"]
+        self.assertEqual([service["id"] for service in services], ["mysql-id", "redis-id"])
+        self.assertEqual(services[0]["plans"][0]["id"], "standard-id")
+        etag = response.headers["ETag"]
+        response = self.client.get(
+            "/v2/catalog", headers=dict(self.headers, **{"If-None-Match": etag}))
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.get_data(), b"")
+        # the addons meta of the catalog cache is left untouched
+        self.assertIsInstance(
+            metadata.load_addons_catalog().get_addon("mysql-id")["plans"][0], dict)
+
+    def test_catalog_changed(self):
+        etag = self.client.get("/v2/catalog", headers=self.headers).headers["ETag"]
+        addons_meta = dict(ADDONS_META)
+        addons_meta.pop("redis")
+        metadata.save_addons_meta(addons_meta)
+        response = self.client.get(
+            "/v2/catalog", headers=dict(self.headers, **{"If-None-Match": etag}))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers["ETag"], etag)
+        self.assertEqual(len(response.get_json()["services"]), 1)
+
+    def test_catalog_auth(self):
+        response = self.client.get(
+            "/v2/catalog", headers={"X-Broker-Api-Version": "2.13"})
+        self.assertEqual(response.status_code, 401)